@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+#
+# Copyright 2017-2018 Government of Canada - Public Services and Procurement Canada - buyandsell.gc.ca
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Compare the encoded size and encode/decode time of the exchange message codecs
+against plain pickle, using representative Indy service messages.
+"""
+
+import argparse
+import pickle
+import time
+
+from vonx.common import codec
+
+from samples import sample_messages
+
+parser = argparse.ArgumentParser(
+    description='Benchmark the von-x exchange message codecs')
+parser.add_argument('-n', '--iterations', type=int, default=2000,
+    help='the number of times to encode and decode each message')
+parser.add_argument('-c', '--compress-threshold', type=int, default=16384,
+    help='the minimum encoded size for zlib compression by the compact codec')
+
+args = parser.parse_args()
+
+
+def measure(encode, decode, message):
+    data = encode(message)
+    start = time.perf_counter()
+    for _ in range(args.iterations):
+        encode(message)
+    encoded = time.perf_counter() - start
+    start = time.perf_counter()
+    for _ in range(args.iterations):
+        decode(data)
+    decoded = time.perf_counter() - start
+    scale = 1e6 / args.iterations
+    return len(data), encoded * scale, decoded * scale
+
+
+def main():
+    compact = codec.CompactCodec(compress_threshold=args.compress_threshold)
+    codecs = (
+        ('pickle', lambda msg: pickle.dumps(msg, pickle.HIGHEST_PROTOCOL), pickle.loads),
+        ('compact', compact.encode, compact.decode),
+    )
+    print('{:<24} {:<8} {:>8} {:>10} {:>10}'.format(
+        'message', 'codec', 'bytes', 'enc usec', 'dec usec'))
+    for message in sample_messages():
+        for name, encode, decode in codecs:
+            size, enc, dec = measure(encode, decode, message)
+            print('{:<24} {:<8} {:>8} {:>10.1f} {:>10.1f}'.format(
+                type(message).__name__, name, size, enc, dec))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+#
+# Copyright 2017-2018 Government of Canada - Public Services and Procurement Canada - buyandsell.gc.ca
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Compare the asyncio and uvloop event loops selected by the `EVENT_LOOP` setting.
+
+For each loop the round-trip latency of requests sent through the Exchange by a
+RequestExecutor is reported, followed by the throughput of an aiohttp server
+handling `/issue-credential` posts. The handler stands in for the issuer view,
+decoding the JSON body and awaiting a reply from a service over the exchange,
+so that no ledger or wallet is needed. Each loop is measured in its own process,
+as the event loop policy is shared by the whole process.
+"""
+
+import argparse
+import asyncio
+import json
+import multiprocessing as mp
+import time
+
+from vonx.common import eventloop
+from vonx.common.exchange import Exchange, HelloProcessor, RequestExecutor
+
+parser = argparse.ArgumentParser(
+    description='Benchmark the von-x exchange and web server under each event loop')
+parser.add_argument('-l', '--loops', default='asyncio,uvloop',
+    help='comma-separated event loops to test')
+parser.add_argument('-n', '--requests', type=int, default=2000,
+    help='the number of requests to send for each measurement')
+parser.add_argument('-c', '--concurrency', type=int, default=32,
+    help='the number of concurrent HTTP clients')
+parser.add_argument('-p', '--port', type=int, default=8765,
+    help='the local port used by the web server')
+
+args = parser.parse_args()
+
+CREDENTIAL = {"attr1": "Test", "attr2": "Second Value"}
+
+
+async def measure_latency(executor):
+    samples = []
+    for _ in range(args.requests):
+        start = time.perf_counter()
+        await executor.submit('hello', 'ping')
+        samples.append(time.perf_counter() - start)
+    samples.sort()
+    return samples[len(samples) // 2], samples[int(len(samples) * 0.99)]
+
+
+async def measure_web(executor):
+    from aiohttp import ClientSession, web
+
+    async def issue_credential(request):
+        params = await request.json()
+        reply = await executor.submit('hello', params)
+        return web.json_response({"success": True, "result": reply})
+
+    app = web.Application()
+    app.router.add_post('/issue-credential', issue_credential)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', args.port)
+    await site.start()
+
+    url = 'http://127.0.0.1:{}/issue-credential'.format(args.port)
+    remain = [args.requests]
+    async def client(session):
+        while remain[0] > 0:
+            remain[0] -= 1
+            async with session.post(url, json=CREDENTIAL) as response:
+                await response.read()
+
+    async with ClientSession() as session:
+        start = time.perf_counter()
+        await asyncio.gather(*(client(session) for _ in range(args.concurrency)))
+        elapsed = time.perf_counter() - start
+    await runner.cleanup()
+    return args.requests / elapsed
+
+
+def run(loop_name, results):
+    name = eventloop.init_event_loop({"EVENT_LOOP": loop_name})
+    exchange = Exchange()
+    exchange.start(False)
+    service = HelloProcessor('hello', exchange)
+    service.start()
+    executor = RequestExecutor('bench', exchange)
+    executor.start()
+
+    loop = eventloop.new_event_loop()
+    asyncio.set_event_loop(loop)
+    p50, p99 = loop.run_until_complete(measure_latency(executor))
+    rate = loop.run_until_complete(measure_web(executor))
+    loop.close()
+
+    executor.stop()
+    service.stop()
+    exchange.stop()
+    results.put((loop_name, name, p50, p99, rate))
+
+
+def main():
+    print('{:>8} {:>8} {:>12} {:>12} {:>14}'.format(
+        'setting', 'loop', 'p50 usec', 'p99 usec', 'requests/sec'))
+    results = mp.Queue()
+    for loop_name in args.loops.split(','):
+        proc = mp.Process(target=run, args=(loop_name, results))
+        proc.start()
+        setting, name, p50, p99, rate = results.get()
+        proc.join()
+        print('{:>8} {:>8} {:>12.0f} {:>12.0f} {:>14.0f}'.format(
+            setting, name, p50 * 1e6, p99 * 1e6, rate))
+
+
+if __name__ == '__main__':
+    main()
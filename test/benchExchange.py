@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+#
+# Copyright 2017-2018 Government of Canada - Public Services and Procurement Canada - buyandsell.gc.ca
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Measure Exchange message throughput as the number of registered receivers grows.
+
+Each receiver runs in its own process, like the per-worker executors started by
+the web server, and blocks in `recv` until a message arrives for its identifier.
+With `--threads` or `--local` the receivers and senders run as threads instead,
+as in a single-process deployment.
+"""
+
+import argparse
+import multiprocessing as mp
+import resource
+import threading
+import time
+
+from vonx.common.codec import get_codec
+from vonx.common.exchange import (
+    Exchange, LocalExchange, MessageWrapper, QueuedMessage, ShardedExchange, StopMessage)
+
+parser = argparse.ArgumentParser(
+    description='Benchmark message throughput of the von-x Exchange')
+parser.add_argument('-m', '--messages', type=int, default=2000,
+    help='the number of messages to send for each run')
+parser.add_argument('-r', '--receivers', default='1,2,4,8,16',
+    help='comma-separated receiver counts to test')
+parser.add_argument('-w', '--wake-slots', type=int, default=16,
+    help='the number of wakeup slots (1 wakes every receiver on each send)')
+parser.add_argument('-t', '--transport', default='pipe', choices=('pipe', 'shm'),
+    help='the exchange message transport')
+parser.add_argument('-b', '--batch', type=int, default=1,
+    help='the number of messages moved by each send and recv command')
+parser.add_argument('-s', '--size', type=int, default=0,
+    help='the size in bytes of the payload carried by each message')
+parser.add_argument('-c', '--codec', choices=('none', 'pickle', 'compact'), default='none',
+    help='the codec used to encode message payloads')
+parser.add_argument('--shm-threshold', type=int, default=0,
+    help='the minimum encoded size of payloads passed through shared memory')
+parser.add_argument('--shards', type=int, default=1,
+    help='the number of exchange shards (each runs in its own process)')
+parser.add_argument('--senders', type=int, default=1,
+    help='the number of sending processes')
+parser.add_argument('-p', '--process', action='store_true',
+    help='run the exchange in a separate process instead of a thread')
+parser.add_argument('--threads', action='store_true',
+    help='run the receivers and senders as threads instead of processes')
+parser.add_argument('--local', action='store_true',
+    help='use the in-memory LocalExchange (implies --threads)')
+
+args = parser.parse_args()
+if args.local:
+    args.threads = True
+
+
+def start_worker(target, *params):
+    worker = threading.Thread(target=target, args=params) if args.threads \
+        else mp.Process(target=target, args=params)
+    worker.start()
+    return worker
+
+
+def receive(exchange, pid, ready):
+    exchange.register(pid)
+    ready.release()
+    while True:
+        if args.batch > 1:
+            received = exchange.recv_many(pid, args.batch)
+        else:
+            received = [exchange.recv(pid)]
+        if isinstance(received[-1].message, StopMessage):
+            break
+
+
+def payload(idx):
+    return {'idx': idx, 'data': 'x' * args.size} if args.size else idx
+
+
+def send(exchange, pids, first, last):
+    if args.batch > 1:
+        for start in range(first, last, args.batch):
+            exchange.send_many([
+                QueuedMessage(pids[idx % len(pids)], MessageWrapper('bench', None, payload(idx)))
+                for idx in range(start, min(start + args.batch, last))])
+    else:
+        for idx in range(first, last):
+            exchange.send(pids[idx % len(pids)], MessageWrapper('bench', None, payload(idx)))
+
+
+def run(receivers):
+    params = {
+        'wake_slots': args.wake_slots,
+        'codec': get_codec(args.codec),
+        'shm_threshold': args.shm_threshold,
+    }
+    if args.local:
+        exchange = LocalExchange()
+        exchange.start()
+    elif args.shards > 1:
+        exchange = ShardedExchange(args.shards, **params)
+        exchange.start(True, args.transport)
+    else:
+        exchange = Exchange(**params)
+        exchange.start(args.process, args.transport)
+    pids = ['bench-{}'.format(idx) for idx in range(receivers)]
+    ready = threading.Semaphore(0) if args.threads else mp.Semaphore(0)
+    procs = [start_worker(receive, exchange, pid, ready) for pid in pids]
+    for _ in procs:
+        ready.acquire()
+
+    start = time.perf_counter()
+    if args.senders > 1:
+        step = args.messages // args.senders
+        senders = [
+            start_worker(
+                send, exchange, pids, idx * step,
+                args.messages if idx == args.senders - 1 else (idx + 1) * step)
+            for idx in range(args.senders)]
+        for proc in senders:
+            proc.join()
+    else:
+        send(exchange, pids, 0, args.messages)
+    for pid in pids:
+        exchange.send(pid, MessageWrapper('bench', None, StopMessage()))
+    for proc in procs:
+        proc.join()
+    elapsed = time.perf_counter() - start
+
+    exchange.stop()
+    exchange.join()
+    return elapsed
+
+
+def max_rss() -> float:
+    # peak resident memory of this process and the largest receiver, in megabytes
+    return max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / 1024
+
+
+def main():
+    print('{:>10} {:>10} {:>12} {:>12}'.format(
+        'receivers', 'seconds', 'msgs/sec', 'peak MB'))
+    for receivers in map(int, args.receivers.split(',')):
+        elapsed = run(receivers)
+        print('{:>10} {:>10.3f} {:>12.0f} {:>12.1f}'.format(
+            receivers, elapsed, args.messages / elapsed, max_rss()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+#
+# Copyright 2017-2018 Government of Canada - Public Services and Procurement Canada - buyandsell.gc.ca
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Measure the cost of constructing exchange messages, reading their fields and
+pickling them, using the message types passed most often to the Indy service.
+"""
+
+import argparse
+import pickle
+import time
+
+from samples import sample_credential
+from vonx.indy.messages import (
+    CredentialOffer,
+    CredentialRequest,
+    IssueCredentialReq,
+    StoredCredential,
+)
+
+parser = argparse.ArgumentParser(
+    description='Benchmark the von-x exchange message classes')
+parser.add_argument('-n', '--iterations', type=int, default=100000,
+    help='the number of times to repeat each operation')
+
+args = parser.parse_args()
+
+
+def sample_messages() -> list:
+    cred = sample_credential(1)
+    offer = CredentialOffer({"nonce": "1234"}, "6qnvgJtqwK44D8LFYnV5Yf:3:CL:17")
+    return [
+        (IssueCredentialReq, (
+            "conn-1", "my-registration.empr", "1.0.0", None,
+            {"legal_name": "Company 1", "corp_num": 1})),
+        (CredentialOffer, (offer.data, offer.cred_def_id)),
+        (CredentialRequest, (offer, '{"blinded_ms": "1"}', {"master_secret": "2"})),
+        (StoredCredential, (cred, "cred-1", "holder-1")),
+    ]
+
+
+def measure(proc) -> float:
+    start = time.perf_counter()
+    for _ in range(args.iterations):
+        proc()
+    return (time.perf_counter() - start) * 1e9 / args.iterations
+
+
+def main():
+    print('{:<22} {:>12} {:>12} {:>12} {:>12}'.format(
+        'message', 'init nsec', 'attr nsec', 'pickle nsec', 'pickle bytes'))
+    for cls, values in sample_messages():
+        message = cls(*values)
+        name = message._field_names[-1]
+        encoded = pickle.dumps(message, pickle.HIGHEST_PROTOCOL)
+        init = measure(lambda: cls(*values))
+        attr = measure(lambda: getattr(message, name))
+        dump = measure(lambda: pickle.loads(pickle.dumps(message, pickle.HIGHEST_PROTOCOL)))
+        print('{:<22} {:>12.0f} {:>12.0f} {:>12.0f} {:>12}'.format(
+            cls.__name__, init, attr, dump, len(encoded)))
+
+
+if __name__ == '__main__':
+    main()
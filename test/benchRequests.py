@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+#
+# Copyright 2017-2018 Government of Canada - Public Services and Procurement Canada - buyandsell.gc.ca
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Measure the cost of matching responses to outstanding requests in a
+RequestExecutor as the number of requests in flight grows.
+
+All requests are submitted (each with a timeout) to a recipient which does not
+reply, then the responses are sent back in a burst and the time taken for the
+executor to resolve every request is reported per response.
+"""
+
+import argparse
+import asyncio
+import time
+
+from vonx.common.exchange import Exchange, MessageWrapper, QueuedMessage, RequestExecutor
+
+parser = argparse.ArgumentParser(
+    description='Benchmark request correlation in the von-x RequestExecutor')
+parser.add_argument('-n', '--in-flight', default='1000,10000,20000,50000',
+    help='comma-separated numbers of requests in flight to test')
+parser.add_argument('-t', '--timeout', type=float, default=300,
+    help='the timeout assigned to each request')
+parser.add_argument('-b', '--batch', type=int, default=256,
+    help='the number of responses sent by each exchange command')
+
+args = parser.parse_args()
+
+
+def collect(exchange, pid, count):
+    received = []
+    while len(received) < count:
+        received.extend(exchange.recv_many(pid, count - len(received)))
+    return received
+
+
+def run(loop, exchange, executor, count):
+    futures = executor.submit_many('sink', ['ping'] * count, args.timeout)
+    requests = collect(exchange, 'sink', count)
+    start = time.perf_counter()
+    for first in range(0, count, args.batch):
+        exchange.send_many([
+            QueuedMessage(executor.pid, MessageWrapper('sink', None, 'pong', wrapper.ident))
+            for wrapper in requests[first:first + args.batch]])
+    results = loop.run_until_complete(asyncio.gather(*futures))
+    elapsed = time.perf_counter() - start
+    assert len(results) == count
+    return elapsed
+
+
+def main():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    exchange = Exchange()
+    exchange.start(False)
+    exchange.register('sink')
+    executor = RequestExecutor('bench', exchange)
+    executor.start()
+    while not exchange.is_registered(executor.pid):
+        time.sleep(0.01)
+
+    print('{:>10} {:>10} {:>14}'.format('in flight', 'seconds', 'usec/response'))
+    for count in map(int, args.in_flight.split(',')):
+        elapsed = run(loop, exchange, executor, count)
+        print('{:>10} {:>10.3f} {:>14.1f}'.format(count, elapsed, elapsed * 1e6 / count))
+
+    executor.stop()
+    exchange.stop()
+    exchange.join()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+#
+# Copyright 2017-2018 Government of Canada - Public Services and Procurement Canada - buyandsell.gc.ca
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Measure the rate at which coroutines can be submitted to an eventloop.Runner
+from another thread, as by the web server threads submitting requests to a
+RequestExecutor.
+
+For each submission method the time the submitting thread spends submitting
+the tasks is reported, along with the time until every task has run.
+"""
+
+import argparse
+import threading
+import time
+
+from vonx.common.eventloop import Runner
+
+parser = argparse.ArgumentParser(
+    description='Benchmark cross-thread task submission to the von-x event loop Runner')
+parser.add_argument('-n', '--tasks', type=int, default=20000,
+    help='the number of tasks to submit for each method')
+parser.add_argument('-b', '--batch', type=int, default=64,
+    help='the number of tasks passed to each run_tasks call')
+
+args = parser.parse_args()
+
+
+class Counter:
+    def __init__(self, count):
+        self.remain = count
+        self.done = threading.Event()
+
+    async def task(self):
+        self.remain -= 1
+        if not self.remain:
+            self.done.set()
+
+
+def submit_run_task(runner, counter):
+    for _ in range(args.tasks):
+        runner.run_task(counter.task())
+
+
+def submit_submit(runner, counter):
+    for _ in range(args.tasks):
+        runner.submit(counter.task())
+
+
+def submit_run_tasks(runner, counter):
+    for first in range(0, args.tasks, args.batch):
+        runner.run_tasks(counter.task() for _ in range(min(args.batch, args.tasks - first)))
+
+
+METHODS = (
+    ('run_task', submit_run_task),
+    ('submit', submit_submit),
+    ('run_tasks', submit_run_tasks),
+)
+
+
+def main():
+    runner = Runner()
+    runner.start()
+    print('{:>10} {:>12} {:>14} {:>12}'.format(
+        'method', 'submit sec', 'submits/sec', 'total sec'))
+    for name, method in METHODS:
+        counter = Counter(args.tasks)
+        start = time.perf_counter()
+        method(runner, counter)
+        submitted = time.perf_counter() - start
+        counter.done.wait()
+        total = time.perf_counter() - start
+        print('{:>10} {:>12.3f} {:>14.0f} {:>12.3f}'.format(
+            name, submitted, args.tasks / submitted, total))
+    runner.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+#
+# Copyright 2017-2018 Government of Canada - Public Services and Procurement Canada - buyandsell.gc.ca
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Sample messages shared by the tests and benchmarks
+"""
+
+import os
+
+from vonx.common.exchange import ExchangeFail
+from vonx.common.service import ServiceStatus, ServiceStatusReq
+from vonx.indy.messages import (
+    ConstructedProof,
+    ConstructProofReq,
+    Credential,
+    IssueCredentialBatchReq,
+    ProofRequest,
+    StoredCredential,
+    StoredCredentialBatch,
+)
+
+
+def sample_credential(idx: int) -> Credential:
+    return Credential(
+        {
+            "schema_id": "6qnvgJtqwK44D8LFYnV5Yf:2:my-registration.empr:1.0.0",
+            "cred_def_id": "6qnvgJtqwK44D8LFYnV5Yf:3:CL:17",
+            "values": {
+                "legal_name": {"raw": "Company {}".format(idx), "encoded": str(idx * 7919)},
+                "effective_date": {"raw": "2018-01-01", "encoded": "1514764800"},
+            },
+            "signature": {"p_credential": {"m_2": "5" * 80, "a": "7" * 600, "e": "9" * 120}},
+        },
+        {"master_secret_blinding_data": {"v_prime": "3" * 500, "vr_prime": None}},
+        None)
+
+
+def shared_segments() -> set:
+    # the shared memory segments currently allocated, where this can be determined
+    if os.path.isdir('/dev/shm'):
+        return set(os.listdir('/dev/shm'))
+    return None
+
+
+def sample_messages() -> list:
+    creds = [sample_credential(idx) for idx in range(20)]
+    return [
+        ServiceStatusReq(),
+        ServiceStatus({"id": "indy", "ready": True, "stats": {"requests": 12}}),
+        IssueCredentialBatchReq(
+            "conn-1", "my-registration.empr", "1.0.0", None,
+            [{"legal_name": "Company {}".format(idx), "corp_num": idx} for idx in range(100)]),
+        creds[0],
+        StoredCredential(creds[1], "cred-1", "holder-1"),
+        StoredCredentialBatch(
+            [StoredCredential(cred, "cred-{}".format(idx)) for idx, cred in enumerate(creds)],
+            []),
+        ConstructProofReq("holder-1", ProofRequest({"nonce": "1234", "name": "proof"}), {"a"}),
+        ConstructedProof({"proof": {"proofs": [{"primary_proof": "8" * 4000}]}}),
+        ExchangeFail("Exception during message processing", False),
+        "isthereanybodyoutthere",
+        {"plain": ["values", 1, 2.5, None]},
+    ]
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+#
+# Copyright 2017-2018 Government of Canada - Public Services and Procurement Canada - buyandsell.gc.ca
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Round-trip tests for the exchange message codecs
+"""
+
+from decimal import Decimal
+import unittest
+
+from vonx.common import codec
+from vonx.common.service import ServiceAck, ServiceStatus, ServiceStatusReq
+from vonx.indy.messages import (
+    Credential,
+    StoredCredential,
+    StoredCredentialBatch,
+)
+
+from .samples import sample_messages
+
+
+class TestCodecs(unittest.TestCase):
+
+    def assertRoundTrip(self, instance: codec.Codec, message):
+        encoded = instance.encode(message)
+        self.assertIsInstance(encoded, bytes)
+        decoded = instance.decode(encoded)
+        self.assertIs(type(decoded), type(message))
+        self.assertEqual(repr(decoded), repr(message))
+        return decoded
+
+    def test_pickle_round_trip(self):
+        instance = codec.PickleCodec()
+        for message in sample_messages():
+            self.assertRoundTrip(instance, message)
+
+    def test_compact_round_trip(self):
+        instance = codec.CompactCodec()
+        for message in sample_messages():
+            self.assertRoundTrip(instance, message)
+
+    def test_compact_nested_messages(self):
+        instance = codec.CompactCodec()
+        batch = sample_messages()[5]
+        decoded = self.assertRoundTrip(instance, batch)
+        self.assertIsInstance(decoded.results[0], StoredCredential)
+        self.assertIsInstance(decoded.results[0].cred, Credential)
+        self.assertEqual(decoded.results[3].cred.cred_data, batch.results[3].cred.cred_data)
+
+    def test_compact_is_smaller(self):
+        compact = codec.CompactCodec(compress_threshold=None)
+        pickled = codec.PickleCodec()
+        for message in sample_messages()[:2] + sample_messages()[6:9]:
+            self.assertLess(len(compact.encode(message)), len(pickled.encode(message)))
+
+    def test_compression(self):
+        instance = codec.CompactCodec(compress_threshold=1024)
+        message = sample_messages()[7]
+        encoded = instance.encode(message)
+        self.assertTrue(encoded[1] & 1)
+        self.assertLess(len(encoded), 4000)
+        self.assertRoundTrip(instance, message)
+        small = codec.CompactCodec(compress_threshold=1 << 20).encode(message)
+        self.assertFalse(small[1] & 1)
+
+    def test_pickle_fallback(self):
+        instance = codec.CompactCodec()
+        # arbitrary objects are not supported by marshal
+        message = ServiceStatus({"found": Decimal("1.5")})
+        encoded = instance.encode(message)
+        self.assertEqual(encoded[0], 0)
+        self.assertEqual(instance.decode(encoded).status["found"], Decimal("1.5"))
+        # as are lists of messages combined with other values
+        for results in ([ServiceAck(), "x"], ["x", ServiceAck()]):
+            message = StoredCredentialBatch(results, [])
+            encoded = instance.encode(message)
+            self.assertEqual(encoded[0], 0)
+            self.assertEqual(repr(instance.decode(encoded)), repr(message))
+
+    def test_unknown_type(self):
+        instance = codec.CompactCodec()
+        encoded = bytearray(instance.encode(ServiceStatusReq()))
+        # corrupt the type identifier
+        broken = bytes(encoded).replace(
+            codec.message_type_id(ServiceStatusReq).to_bytes(4, 'little'), b'\xff' * 4)
+        with self.assertRaises(ValueError):
+            instance.decode(broken)
+
+    def test_get_codec(self):
+        self.assertIsNone(codec.get_codec(None))
+        self.assertIsNone(codec.get_codec('none'))
+        self.assertIsInstance(codec.get_codec('compact'), codec.CompactCodec)
+        self.assertIsInstance(codec.get_codec('pickle'), codec.PickleCodec)
+        with self.assertRaises(ValueError):
+            codec.get_codec('json')
+
+
+if __name__ == '__main__':
+    unittest.main()
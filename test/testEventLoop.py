@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+#
+# Copyright 2017-2018 Government of Canada - Public Services and Procurement Canada - buyandsell.gc.ca
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Tests for the event loop runner and thread pools
+"""
+
+import asyncio
+from threading import Event
+import time
+import unittest
+
+from vonx.common import eventloop
+from vonx.common.eventloop import Runner
+
+
+class TestEventLoop(unittest.TestCase):
+
+    def test_runner_tasks(self):
+        runner = Runner()
+        runner.start()
+        cancelled = Event()
+        async def task(value, delay=0):
+            try:
+                await asyncio.sleep(delay)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+            if isinstance(value, Exception):
+                raise value
+            return value
+        # tasks submitted from another thread run without blocking the caller
+        futures = runner.run_tasks([task(1), task(ValueError('failed')), task(3, 60)])
+        self.assertEqual(runner.submit(task(4)).result(1), 4)
+        self.assertEqual(futures[0].result(1), 1)
+        with self.assertRaises(ValueError):
+            futures[1].result(1)
+        # cancelling the future cancels the task
+        self.assertTrue(futures[2].cancel())
+        self.assertTrue(cancelled.wait(1))
+        runner.stop()
+
+    def test_runner_stop(self):
+        runner = Runner()
+        runner.start()
+        future = runner.submit(asyncio.sleep(60))
+        time.sleep(0.1)
+        # tasks still running are cancelled when the runner stops
+        runner.stop()
+        self.assertTrue(future.cancelled())
+        self.assertEqual(runner.abandoned, 1)
+
+    def test_thread_pool_stats(self):
+        pool = eventloop.ThreadPool(1, 'test')
+        release = Event()
+        blocked = pool.submit(release.wait, 5)
+        queued = pool.submit(lambda: 2)
+        stats = pool.stats()
+        self.assertEqual(stats["queued"] + stats["active"], 2)
+        self.assertEqual(stats["saturated"], 1)
+        release.set()
+        self.assertTrue(blocked.result(1))
+        self.assertEqual(queued.result(1), 2)
+        pool.shutdown()
+        stats = pool.stats()
+        self.assertEqual((stats["active"], stats["queued"], stats["completed"]), (0, 0, 2))
+        self.assertEqual(stats["max_active"], 1)
+        self.assertEqual(stats["wait"]["count"], 2)
+
+    def test_event_loop_factory(self):
+        created = []
+        def factory():
+            loop = asyncio.new_event_loop()
+            created.append(loop)
+            return loop
+        eventloop.set_loop_factory(factory)
+        try:
+            runner = Runner()
+            runner.start()
+            self.assertIs(runner.loop, created[0])
+            runner.stop()
+        finally:
+            eventloop.set_loop_factory(None)
+        # asyncio is used unless another loop is selected, and the choice is logged
+        with self.assertLogs('vonx.common.eventloop', 'INFO') as logs:
+            self.assertEqual(eventloop.init_event_loop({}), 'asyncio')
+        self.assertIn('Using the asyncio event loop', logs.output[0])
+        with self.assertRaises(ValueError):
+            eventloop.init_event_loop({"EVENT_LOOP": "tornado"})
+
+
+if __name__ == '__main__':
+    unittest.main()
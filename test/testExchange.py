@@ -0,0 +1,519 @@
+#!/usr/bin/env python3
+#
+# Copyright 2017-2018 Government of Canada - Public Services and Procurement Canada - buyandsell.gc.ca
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Tests for the message exchange and its queues
+"""
+
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+from threading import Thread
+import time
+import unittest
+
+from vonx.common import codec
+from vonx.common.exchange import (
+    ExchangeFullError, Exchange, HelloProcessor, LocalExchange, MessageWrapper,
+    PRIORITY_BULK, PRIORITY_CONTROL, PRIORITY_INTERACTIVE, QueuedMessage, RequestExecutor,
+    ShardedExchange, StopMessage)
+from vonx.common.payload import shared_payloads_supported
+from vonx.common.service import ServiceStatus, ServiceStatusReq
+from vonx.common.telemetry import QueueTelemetry, RATE_WINDOW
+from vonx.indy.messages import (
+    GenerateProofRequestReq,
+    ResolveNymReq,
+)
+
+from .samples import sample_messages, shared_segments
+
+
+# a journaled payload is delivered to another process, which releases the segment
+JOURNAL_SHARED_PAYLOAD = """
+import multiprocessing as mp
+import tempfile
+from vonx.common import codec
+from vonx.common.exchange import Exchange, MessageWrapper
+
+def receive(exchange):
+    assert len(exchange.recv('codec').message) == 1000
+
+if __name__ == '__main__':
+    with tempfile.TemporaryDirectory() as path:
+        exchange = Exchange(
+            codec=codec.get_codec('pickle'), shm_threshold=100, journal_path=path,
+            drain_timeout=0.1)
+        exchange.start(False)
+        exchange.register('codec')
+        proc = mp.Process(target=receive, args=(exchange,))
+        proc.start()
+        exchange.send('codec', MessageWrapper('test', None, 'x' * 1000))
+        proc.join()
+        assert proc.exitcode == 0
+        exchange.stop()
+        exchange.join()
+"""
+
+
+class TestExchange(unittest.TestCase):
+
+    def test_exchange_priority(self):
+        for transport in ('pipe', 'shm'):
+            exchange = Exchange(lane_burst=2)
+            exchange.start(False, transport)
+            exchange.register('codec')
+            for idx in range(4):
+                exchange.send('codec', MessageWrapper(
+                    'test', 'bulk-{}'.format(idx), ServiceStatus({}), None, PRIORITY_BULK))
+            for idx in range(4):
+                exchange.send('codec', MessageWrapper('test', 'int-{}'.format(idx), ServiceStatus({})))
+            exchange.send('codec', MessageWrapper('test', 'ctl', ServiceStatusReq()))
+            received = exchange.recv_many('codec', 9)
+            self.assertEqual(received[0].ident, 'ctl')
+            self.assertEqual(received[0].priority, PRIORITY_CONTROL)
+            # interactive messages are delivered ahead of earlier bulk messages,
+            # which are not starved by a steady stream of interactive ones
+            self.assertEqual(received[1].ident, 'int-0')
+            self.assertIn('bulk-0', [wrapper.ident for wrapper in received[:4]])
+            self.assertEqual(len(received), 9)
+            exchange.send('codec', MessageWrapper('test', None, StopMessage()))
+            self.assertIsInstance(exchange.recv('codec').message, StopMessage)
+            exchange.stop()
+            exchange.join()
+
+    def test_exchange_expiry(self):
+        for transport in ('pipe', 'shm'):
+            exchange = Exchange(codec=codec.get_codec('compact'))
+            exchange.start(False, transport)
+            exchange.register('codec')
+            past = time.time() - 1
+            exchange.send('codec', MessageWrapper(
+                'test', 'old', ServiceStatus({}), None, None, past))
+            exchange.send('codec', MessageWrapper(
+                'test', 'new', ServiceStatus({}), None, None, past + 60))
+            exchange.send('codec', MessageWrapper('test', 'none', ServiceStatus({})))
+            received = exchange.recv_many('codec')
+            self.assertEqual([wrapper.ident for wrapper in received], ['new', 'none'])
+            self.assertEqual(exchange.status()['expired'], 1)
+            exchange.send('codec', MessageWrapper('test', None, StopMessage()))
+            self.assertIsInstance(exchange.recv('codec').message, StopMessage)
+            exchange.stop()
+            exchange.join()
+
+    def test_exchange_telemetry(self):
+        for transport in ('pipe', 'shm'):
+            exchange = Exchange(codec=codec.get_codec('compact'))
+            exchange.start(False, transport)
+            exchange.register('codec')
+            for message in sample_messages():
+                exchange.send('codec', MessageWrapper('test', None, message))
+            exchange.recv_many('codec', 4)
+            queues = exchange.status()['queues']
+            self.assertEqual(queues['codec']['depth'], 7)
+            self.assertEqual(queues['codec']['max_depth'], 11)
+            self.assertEqual(queues['codec']['size']['count'], 11)
+            self.assertEqual(queues['codec']['wait']['count'], 4)
+            self.assertGreater(queues['codec']['rate'], 0)
+            # reading the status does not reset the rate seen by other readers
+            self.assertGreater(exchange.status()['queues']['codec']['rate'], 0)
+            exchange.send('codec', MessageWrapper('test', None, StopMessage()))
+            self.assertIsInstance(exchange.recv_many('codec')[-1].message, StopMessage)
+            self.assertNotIn('codec', exchange.status()['queues'])
+            exchange.stop()
+            exchange.join()
+
+    def test_queue_rate(self):
+        stats = QueueTelemetry(100.0)
+        stats.sample(10, 105.0)
+        self.assertEqual(stats.rate(10, 105.0), 2.0)
+        self.assertEqual(stats.rate(10, 105.0), 2.0)
+        # the rate of the last complete window is reported until the next one ends
+        stats.sample(50, 100.0 + RATE_WINDOW)
+        self.assertEqual(stats.rate(60, 102.0 + RATE_WINDOW), 50 / RATE_WINDOW)
+        stats.sample(60, 102.0 + RATE_WINDOW)
+        self.assertEqual(stats.rate(60, 105.0 + RATE_WINDOW), 50 / RATE_WINDOW)
+        # an old window is replaced by the rate since it ended
+        self.assertEqual(stats.rate(60, 100.0 + RATE_WINDOW * 3), 10 / (RATE_WINDOW * 2))
+
+    def test_exchange_async(self):
+        loop = asyncio.new_event_loop()
+        for transport in ('pipe', 'shm'):
+            exchange = Exchange(codec=codec.get_codec('compact'))
+            exchange.start(False, transport)
+            exchange.register('codec')
+            self.assertEqual(loop.run_until_complete(exchange.recv_async('codec', None, 0.1)), [])
+            messages = sample_messages()
+            # wake the receiver from another thread while it is waiting
+            loop.call_later(0.05, Thread(target=exchange.send_many, args=([
+                QueuedMessage('codec', MessageWrapper(
+                    'test', None, message, None, PRIORITY_INTERACTIVE))
+                for message in messages],)).start)
+            received = []
+            while len(received) < len(messages):
+                received.extend(loop.run_until_complete(exchange.recv_async('codec')))
+            self.assertEqual(
+                [repr(wrapper.message) for wrapper in received],
+                [repr(message) for message in messages])
+            self.assertTrue(loop.run_until_complete(exchange.send_async(
+                'codec', MessageWrapper('test', None, StopMessage()))))
+            self.assertIsInstance(
+                loop.run_until_complete(exchange.recv_async('codec'))[0].message, StopMessage)
+            exchange.stop()
+            exchange.join()
+        loop.close()
+
+    def test_exchange_consumers(self):
+        for transport in ('pipe', 'shm'):
+            exchange = Exchange()
+            exchange.start(False, transport)
+            self.assertTrue(exchange.register('codec', 'a', 6))
+            self.assertTrue(exchange.register('codec', 'b', 2))
+            self.assertFalse(exchange.register('codec', 'b', 2))
+            for idx in range(4):
+                exchange.send('codec', MessageWrapper('test', str(idx), ServiceStatus({})))
+            # each consumer receives a share in proportion to its unused capacity
+            self.assertEqual(len(exchange.recv_many('codec', consumer='a')), 3)
+            self.assertEqual(len(exchange.recv_many('codec', consumer='b', in_flight=1)), 1)
+            consumers = exchange.status()['queues']['codec']['consumers']
+            self.assertEqual(consumers['a']['share'], 0.75)
+            self.assertEqual(consumers['b']['in_flight'], 2)
+            # every consumer receives the stop message
+            exchange.send('codec', MessageWrapper('test', None, StopMessage()))
+            for consumer in ('a', 'b'):
+                self.assertTrue(exchange.is_registered('codec'))
+                received = exchange.recv_many('codec', consumer=consumer)
+                self.assertIsInstance(received[-1].message, StopMessage)
+            self.assertFalse(exchange.is_registered('codec'))
+            exchange.stop()
+            exchange.join()
+
+    def test_exchange_max_queue(self):
+        for transport in ('pipe', 'shm'):
+            exchange = Exchange(max_queue=4, send_timeout=0)
+            exchange.start(False, transport)
+            exchange.register('codec')
+            sent = 0
+            for idx in range(20):
+                try:
+                    exchange.send('codec', MessageWrapper('test', str(idx), ServiceStatus({})))
+                    sent += 1
+                except ExchangeFullError:
+                    pass
+            self.assertEqual(sent, 4)
+            status = exchange.send_many([
+                QueuedMessage('codec', MessageWrapper('test', None, ServiceStatus({})))
+                for _ in range(2)], False)
+            self.assertEqual(status, [None, None])
+            self.assertEqual(exchange.status()['queues']['codec']['depth'], 4)
+            # receiving frees room in the queue
+            self.assertEqual(len(exchange.recv_many('codec', 2)), 2)
+            status = exchange.send_many([
+                QueuedMessage('codec', MessageWrapper('test', None, ServiceStatus({})))
+                for _ in range(3)], False)
+            self.assertEqual(status, [True, True, None])
+            exchange.send('codec', MessageWrapper('test', None, StopMessage()))
+            received = exchange.recv_many('codec')
+            self.assertEqual(len(received), 5)
+            self.assertIsInstance(received[-1].message, StopMessage)
+            exchange.stop()
+            exchange.join()
+
+    def test_exchange_wake_slots(self):
+        for transport in ('pipe', 'shm'):
+            exchange = Exchange(wake_slots=2)
+            exchange.start(False, transport)
+            pid_a = 'svc-a'
+            pid_b = next(pid for pid in ('svc-b', 'svc-c', 'svc-d', 'svc-e')
+                         if exchange._wake_slot(pid) != exchange._wake_slot(pid_a))
+            polls = {pid_a: 0, pid_b: 0}
+            poll = exchange._poll
+            def counted_poll(to_pid, *args):
+                polls[to_pid] += 1
+                return poll(to_pid, *args)
+            exchange._poll = counted_poll
+            received = {}
+            def receive(to_pid):
+                received[to_pid] = exchange.recv(to_pid)
+            threads = {}
+            for pid in (pid_a, pid_b):
+                exchange.register(pid)
+                threads[pid] = Thread(target=receive, args=(pid,))
+                threads[pid].start()
+            while polls[pid_a] < 1 or polls[pid_b] < 1:
+                time.sleep(0.01)
+            time.sleep(0.1)
+
+            exchange.send(pid_a, MessageWrapper('test', 'a', ServiceStatus({})))
+            threads[pid_a].join(5)
+            self.assertFalse(threads[pid_a].is_alive())
+            self.assertEqual(received[pid_a].ident, 'a')
+            self.assertGreater(polls[pid_a], 1)
+            # the receiver in the other slot is neither woken nor polled
+            time.sleep(0.1)
+            self.assertTrue(threads[pid_b].is_alive())
+            self.assertEqual(polls[pid_b], 1)
+
+            exchange.send(pid_b, MessageWrapper('test', 'b', ServiceStatus({})))
+            threads[pid_b].join(5)
+            self.assertFalse(threads[pid_b].is_alive())
+            self.assertEqual(received[pid_b].ident, 'b')
+            exchange.stop()
+            for pid in (pid_a, pid_b):
+                self.assertIsInstance(exchange.recv(pid).message, StopMessage)
+            exchange.join()
+
+    def test_sharded_exchange(self):
+        exchange = ShardedExchange(shards=3)
+        pids = ['svc-{}'.format(idx) for idx in range(12)]
+        shards = [exchange.shards.index(exchange.shard_for(pid)) for pid in pids]
+        # every instance assigns a recipient to the same shard
+        other = ShardedExchange(shards=3)
+        self.assertEqual(
+            [other.shards.index(other.shard_for(pid)) for pid in pids], shards)
+        self.assertEqual([exchange.shards.index(exchange.shard_for(pid)) for pid in pids],
+                         shards)
+        self.assertEqual(len(set(shards)), 3)
+
+        exchange.start(False)
+        for pid in pids:
+            self.assertTrue(exchange.register(pid))
+            self.assertTrue(exchange.shard_for(pid).is_registered(pid))
+        status = exchange.send_many([
+            QueuedMessage(pid, MessageWrapper('test', '{}-{}'.format(pid, idx), ServiceStatus({})))
+            for idx in range(2) for pid in pids])
+        self.assertEqual(status, [True] * len(pids) * 2)
+        # the batch is divided between the shards of the recipients
+        for idx, shard in enumerate(exchange.shards):
+            self.assertEqual(shard.status()['pending'], shards.count(idx) * 2)
+        for pid in pids:
+            self.assertEqual(
+                [wrapper.ident for wrapper in exchange.recv_many(pid)],
+                ['{}-0'.format(pid), '{}-1'.format(pid)])
+        status = exchange.status()
+        self.assertEqual(status['processed'], {pid: 2 for pid in pids})
+        self.assertEqual(status['total'], len(pids) * 2)
+        self.assertEqual(set(status['queues']), set(pids))
+        self.assertEqual(
+            sum(shard['total'] for shard in status['shards']), status['total'])
+        for pid in pids:
+            exchange.send(pid, MessageWrapper('test', None, StopMessage()))
+            self.assertIsInstance(exchange.recv(pid).message, StopMessage)
+        exchange.stop()
+        exchange.join()
+
+    def test_sharded_exchange_executor(self):
+        exchange = ShardedExchange(shards=2)
+        exchange.start(False)
+        service = HelloProcessor('hello', exchange)
+        service.start()
+        executor = RequestExecutor('client', exchange)
+        executor.start()
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            replies = loop.run_until_complete(asyncio.wait_for(asyncio.gather(
+                *(executor.submit('hello', idx, timeout=5) for idx in range(10))), 10))
+            self.assertEqual(len(replies), 10)
+            for reply in replies:
+                self.assertTrue(reply.startswith('hello from'))
+            self.assertEqual(exchange.status()['processed']['hello'], 10)
+        finally:
+            asyncio.set_event_loop(None)
+            loop.close()
+            executor.stop()
+            service.stop()
+            exchange.stop()
+            exchange.join()
+
+    def test_local_exchange(self):
+        loop = asyncio.new_event_loop()
+        exchange = LocalExchange(max_queue=8, send_timeout=0, lane_burst=2)
+        exchange.start()
+        self.assertTrue(exchange.register('codec'))
+        self.assertFalse(exchange.register('codec'))
+        for idx in range(4):
+            exchange.send('codec', MessageWrapper(
+                'test', 'bulk-{}'.format(idx), ServiceStatus({}), None, PRIORITY_BULK))
+        exchange.send('codec', MessageWrapper('test', 'int', ServiceStatus({})))
+        exchange.send('codec', MessageWrapper(
+            'test', 'old', ServiceStatus({}), None, None, time.time() - 1))
+        exchange.send('codec', MessageWrapper('test', 'ctl', ServiceStatusReq()))
+        self.assertEqual(
+            [wrapper.ident for wrapper in exchange.recv_many('codec', 3)],
+            ['ctl', 'int', 'bulk-0'])
+        self.assertEqual(len(exchange.recv_many('codec')), 3)
+        status = exchange.status()
+        self.assertEqual(status['expired'], 1)
+        self.assertEqual(status['queues']['codec']['max_depth'], 7)
+        # messages are passed without being copied
+        message = sample_messages()[5]
+        exchange.send('codec', MessageWrapper('test', None, message))
+        self.assertIs(exchange.recv('codec').message, message)
+        self.assertEqual(
+            exchange.send_many([QueuedMessage('codec', MessageWrapper('test', None, idx))
+                                for idx in range(9)])[-1], None)
+        with self.assertRaises(ExchangeFullError):
+            exchange.send('codec', MessageWrapper('test', None, 'full'))
+        self.assertEqual(len(exchange.recv_many('codec')), 8)
+        self.assertEqual(loop.run_until_complete(exchange.recv_async('codec', None, 0.05)), [])
+        # wake the receiver from another thread while it is waiting
+        loop.call_later(0.05, Thread(target=exchange.send, args=(
+            'codec', MessageWrapper('test', 'async', ServiceStatus({})))).start)
+        self.assertEqual(
+            loop.run_until_complete(exchange.recv_async('codec'))[0].ident, 'async')
+        exchange.stop()
+        self.assertFalse(exchange.send('codec', MessageWrapper('test', None, 'late')))
+        self.assertIsInstance(exchange.recv('codec').message, StopMessage)
+        self.assertFalse(exchange.is_registered('codec'))
+        exchange.join()
+        loop.close()
+
+    def test_exchange_journal(self):
+        with tempfile.TemporaryDirectory() as path:
+            messages = sample_messages()
+            exchange = Exchange(codec=codec.get_codec('compact'), journal_path=path)
+            exchange.start(False)
+            exchange.register('codec')
+            for message in messages:
+                exchange.send(
+                    'codec', MessageWrapper('test', None, message, None, PRIORITY_INTERACTIVE))
+            # replies are not journaled
+            exchange.send('codec', MessageWrapper('test', None, ServiceStatus({}), 'ref'))
+            received = exchange.recv_many('codec', 3)
+            # only the messages acknowledged by the recipient are removed
+            exchange.ack('codec', [wrapper.seq for wrapper in received[:2]])
+            exchange.stop()
+            exchange.join()
+
+            # the unacknowledged messages are replayed after a restart
+            exchange = Exchange(codec=codec.get_codec('compact'), journal_path=path)
+            exchange.start(False)
+            exchange.register('codec')
+            exchange.send('codec', MessageWrapper('test', None, StopMessage()))
+            received = exchange.recv_many('codec')
+            self.assertEqual(
+                [repr(wrapper.message) for wrapper in received[:-1]],
+                [repr(message) for message in messages[2:]])
+            self.assertIsInstance(received[-1].message, StopMessage)
+            # acknowledged after the recipient has stopped
+            exchange.ack('codec', [wrapper.seq for wrapper in received[:-1]])
+            exchange.stop()
+            exchange.join()
+
+            exchange = Exchange(journal_path=path)
+            exchange.start(False)
+            exchange.register('codec')
+            self.assertEqual(exchange.status()['pending'], 0)
+            exchange.stop()
+            exchange.join()
+
+    @unittest.skipUnless(shared_payloads_supported(), 'shared memory is not supported')
+    def test_exchange_journal_shared_payloads(self):
+        # the journal copies the payload without taking over the segment, so the
+        # resource tracker of the exchange process does not report it as leaked
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env = dict(os.environ, PYTHONPATH=root)
+        result = subprocess.run(
+            [sys.executable, '-c', JOURNAL_SHARED_PAYLOAD], env=env,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=60)
+        self.assertEqual(result.returncode, 0, result.stderr.decode())
+        self.assertEqual(result.stderr.decode(), '')
+
+    def test_coalesce_key(self):
+        self.assertEqual(ServiceStatusReq().coalesce_key(), ServiceStatusReq().coalesce_key())
+        self.assertEqual(ResolveNymReq('did').coalesce_key(), ResolveNymReq('did').coalesce_key())
+        self.assertNotEqual(ResolveNymReq('did').coalesce_key(), ResolveNymReq('other').coalesce_key())
+        # only idempotent requests may share a response
+        self.assertIsNone(GenerateProofRequestReq('spec').coalesce_key())
+        self.assertIsNone(ServiceStatus({}).coalesce_key())
+
+    def test_exchange_drain_timeout(self):
+        exchange = Exchange(drain_timeout=0.2)
+        exchange.start(False)
+        exchange.register('idle')
+        exchange.send('idle', MessageWrapper('test', None, 'undelivered'))
+        start = time.time()
+        exchange.stop()
+        exchange.join()
+        self.assertLess(time.time() - start, 1.0)
+
+    def test_exchange_stop_twice(self):
+        for transport in ('pipe', 'shm'):
+            exchange = Exchange(drain_timeout=3.0)
+            exchange.start(False, transport)
+            exchange.register('svc')
+            # the recipient has already been ordered to stop
+            exchange.send('svc', MessageWrapper('test', None, StopMessage()))
+            exchange.stop()
+            self.assertEqual(exchange.status()['pending'], 1)
+            self.assertIsInstance(exchange.recv('svc').message, StopMessage)
+            self.assertEqual(exchange.status()['pending'], 0)
+            start = time.time()
+            exchange.join()
+            self.assertLess(time.time() - start, 1.0)
+
+    def test_exchange_round_trip(self):
+        for name in ('pickle', 'compact'):
+            for transport in ('pipe', 'shm'):
+                exchange = Exchange(codec=codec.get_codec(name))
+                exchange.start(False, transport)
+                exchange.register('codec')
+                messages = sample_messages()
+                # use a single priority lane to preserve the order of delivery
+                for message in messages:
+                    exchange.send(
+                        'codec', MessageWrapper('test', None, message, None, PRIORITY_INTERACTIVE))
+                exchange.send('codec', MessageWrapper('test', None, StopMessage()))
+                received = exchange.recv_many('codec')
+                self.assertEqual(
+                    [repr(wrapper.message) for wrapper in received[:-1]],
+                    [repr(message) for message in messages])
+                self.assertIsInstance(received[-1].message, StopMessage)
+                exchange.stop()
+                exchange.join()
+
+    @unittest.skipUnless(shared_payloads_supported(), 'shared memory is not supported')
+    def test_exchange_shared_payloads(self):
+        for transport in ('pipe', 'shm'):
+            exchange = Exchange(codec=codec.get_codec('compact'), shm_threshold=1024)
+            exchange.start(False, transport)
+            exchange.register('codec')
+            messages = sample_messages()
+            for message in messages:
+                exchange.send(
+                    'codec', MessageWrapper('test', None, message, None, PRIORITY_INTERACTIVE))
+            received = exchange.recv_many('codec', len(messages))
+            self.assertEqual(
+                [repr(wrapper.message) for wrapper in received],
+                [repr(message) for message in messages])
+            # payloads sent to a stopping recipient are released immediately
+            segments = shared_segments()
+            exchange.send('codec', MessageWrapper('test', None, StopMessage()))
+            self.assertTrue(exchange.send('codec', MessageWrapper('test', None, messages[7])))
+            self.assertEqual(shared_segments(), segments)
+            self.assertIsInstance(exchange.recv('codec').message, StopMessage)
+            # and so are payloads sent to a recipient which is not registered
+            self.assertTrue(exchange.send('unknown', MessageWrapper('test', None, messages[7])))
+            self.assertEqual(shared_segments(), segments)
+            exchange.stop()
+            exchange.join()
+
+
+if __name__ == '__main__':
+    unittest.main()
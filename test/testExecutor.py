@@ -0,0 +1,348 @@
+#!/usr/bin/env python3
+#
+# Copyright 2017-2018 Government of Canada - Public Services and Procurement Canada - buyandsell.gc.ca
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Tests for the request executors exchanging messages through an exchange
+"""
+
+import asyncio
+import json
+import os
+import tempfile
+from threading import Event
+import time
+import unittest
+
+from vonx.common import tracing
+from vonx.common.exchange import (
+    Exchange, ExchangeFail, ExchangeFullError, ExchangeMessage, MessageWrapper,
+    RequestExecutor)
+from vonx.common.journal import MessageJournal
+
+
+class BrokenReq(ExchangeMessage):
+    _fields = (
+        ("value", str),
+    )
+
+    def coalesce_key(self):
+        raise ValueError("Cannot send this request")
+
+
+class SlowReq(ExchangeMessage):
+    _fields = (
+        ("delay", float),
+    )
+    _coalesce = True
+
+
+class EchoExecutor(RequestExecutor):
+    def __init__(self, *args, **kwargs):
+        super(EchoExecutor, self).__init__(*args, **kwargs)
+        self.handled = 0
+
+    async def _handle_message(self, received: MessageWrapper) -> bool:
+        if await super(EchoExecutor, self)._handle_message(received):
+            return True
+        self.handled += 1
+        if isinstance(received.message, SlowReq):
+            await asyncio.sleep(received.message.delay)
+        self.send_noreply(received.from_pid, ('echo', received.message), received.ident)
+        return True
+
+
+class TestExecutor(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        asyncio.set_event_loop(None)
+        self.loop.close()
+
+    def start_exchange(self, **params) -> Exchange:
+        exchange = Exchange(**params)
+        exchange.start(False)
+        self.addCleanup(exchange.stop)
+        return exchange
+
+    def start_executor(self, cls, pid: str, exchange: Exchange, **params) -> RequestExecutor:
+        executor = cls(pid, exchange, **params)
+        executor.start()
+        self.addCleanup(executor.stop)
+        return executor
+
+    def run_coro(self, coro):
+        return self.loop.run_until_complete(asyncio.wait_for(coro, 10, loop=self.loop))
+
+    def test_request_correlation(self):
+        exchange = self.start_exchange()
+        # a recipient given a capacity is a consumer on the exchange and does not
+        # accept messages directly from executors in the same process
+        for pid, capacity in (('echo', None), ('shared', 8)):
+            echo = self.start_executor(EchoExecutor, pid, exchange, capacity=capacity)
+            client = self.start_executor(RequestExecutor, pid + '-client', exchange)
+            results = [client.submit(pid, idx) for idx in range(20)]
+            results.extend(client.submit_many(pid, list(range(20, 40))))
+            self.assertEqual(
+                self.run_coro(asyncio.gather(*results)),
+                [('echo', idx) for idx in range(40)])
+            self.assertEqual(echo.handled, 40)
+            self.assertEqual(echo.local_stats()["delivered"], 0 if capacity else 40)
+            self.assertEqual(client._requests, {})
+
+    def test_request_timeout(self):
+        exchange = self.start_exchange()
+        self.start_executor(EchoExecutor, 'echo', exchange)
+        client = self.start_executor(RequestExecutor, 'client', exchange)
+        start = time.perf_counter()
+        with self.assertRaises(asyncio.CancelledError):
+            self.run_coro(client.submit('echo', SlowReq(1.0), timeout=0.2))
+        self.assertLess(time.perf_counter() - start, 1.0)
+        self.assertEqual(client._requests, {})
+        # a failed request raises the error given to the caller and stops its timer
+        result = client.submit('echo', SlowReq(1.0), timeout=5)
+        self.run_coro(asyncio.sleep(0.05))
+        (ident,) = client._requests
+        client.run_task(client._fail_request(ident, ValueError('failed')))
+        with self.assertRaises(ValueError):
+            self.run_coro(result)
+        self.assertEqual(client._requests, {})
+        self.assertEqual(len(client._timers), 0)
+
+    def test_submit_error(self):
+        exchange = self.start_exchange()
+        self.start_executor(EchoExecutor, 'echo', exchange)
+        client = self.start_executor(RequestExecutor, 'client', exchange)
+        # an exception raised while sending is returned to the caller
+        with self.assertRaises(ValueError):
+            self.run_coro(client.submit('echo', BrokenReq("x")))
+        results = client.submit_many('echo', [BrokenReq("x"), BrokenReq("y")])
+        for result in self.run_coro(asyncio.gather(*results, return_exceptions=True)):
+            self.assertIsInstance(result, ValueError)
+        self.assertEqual(self.run_coro(client.submit('echo', 'ping')), ('echo', 'ping'))
+
+    def test_submit_many_full(self):
+        exchange = self.start_exchange(max_queue=2, send_timeout=0)
+        # a recipient which never receives its messages
+        exchange.register('sink')
+        client = self.start_executor(RequestExecutor, 'client', exchange)
+        results = client.submit_many('sink', list(range(5)), timeout=0.2)
+        results = self.run_coro(asyncio.gather(*results, return_exceptions=True))
+        # the requests rejected by the exchange fail, the others time out
+        self.assertEqual(
+            [type(result) for result in results],
+            [asyncio.CancelledError] * 2 + [ExchangeFullError] * 3)
+        self.assertEqual(client._requests, {})
+        self.assertEqual(len(client._timers), 0)
+
+    def test_coalesce_requests(self):
+        exchange = self.start_exchange()
+        echo = self.start_executor(EchoExecutor, 'echo', exchange)
+        client = self.start_executor(RequestExecutor, 'client', exchange)
+        # identical requests in flight at the same time share a single response
+        results = [client.submit('echo', SlowReq(0.1)) for _ in range(5)]
+        results.extend(client.submit_many('echo', [SlowReq(0.1), SlowReq(0.2)]))
+        replies = self.run_coro(asyncio.gather(*results))
+        self.assertEqual(echo.handled, 2)
+        self.assertEqual([reply[1].delay for reply in replies], [0.1] * 6 + [0.2])
+        self.assertEqual(client._coalesced, {})
+        # a cancelled caller does not cancel the request for the others
+        results = [client.submit('echo', SlowReq(0.1)) for _ in range(2)]
+        results[0].cancel()
+        self.assertEqual(self.run_coro(results[1])[1].delay, 0.1)
+        self.assertEqual(echo.handled, 3)
+
+    @unittest.skipIf(tracing.contextvars is None, 'spans are not linked before Python 3.7')
+    def test_tracing(self):
+        exchange = self.start_exchange()
+        self.start_executor(EchoExecutor, 'echo', exchange)
+        client = self.start_executor(RequestExecutor, 'client', exchange)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'spans.json')
+            tracer = tracing.init_tracing({"TRACE_EXPORT_PATH": path})
+            try:
+                async def traced():
+                    with tracing.start_span('test', root=True) as span:
+                        await client.submit('echo', 'ping')
+                    return span
+                root = self.run_coro(traced())
+                # the other spans may end just after the caller receives the reply
+                spans = {}
+                expire = time.time() + 5
+                while len(spans) < 3 and time.time() < expire:
+                    time.sleep(0.01)
+                    tracer.flush()
+                    if os.path.exists(path):
+                        with open(path) as export:
+                            spans = {
+                                span['name']: span
+                                for line in export
+                                for resource in json.loads(line)['resourceSpans']
+                                for scope in resource['scopeSpans']
+                                for span in scope['spans']}
+            finally:
+                tracing.init_tracing({})
+        request = spans['request str']
+        handle = spans['handle str']
+        self.assertEqual(request['traceId'], root.context.trace_id)
+        self.assertEqual(request['parentSpanId'], root.context.span_id)
+        self.assertEqual(request['kind'], tracing.SPAN_KIND_CLIENT)
+        self.assertEqual(handle['traceId'], root.context.trace_id)
+        self.assertEqual(handle['parentSpanId'], request['spanId'])
+        self.assertEqual(handle['kind'], tracing.SPAN_KIND_SERVER)
+
+    def test_thread_pools(self):
+        exchange = self.start_exchange()
+        echo = self.start_executor(EchoExecutor, 'echo', exchange, helper_threads=2)
+        async def run_threads():
+            await asyncio.gather(*(echo.run_thread(time.sleep, 0.1) for _ in range(4)))
+        start = time.perf_counter()
+        echo.runner().submit(run_threads()).result(5)
+        # four calls in two threads
+        self.assertGreaterEqual(time.perf_counter() - start, 0.15)
+        stats = echo.thread_stats()
+        self.assertEqual(set(stats), {'recv', 'send', 'helper'})
+        self.assertEqual(stats['recv']['size'], 1)
+        self.assertEqual(stats['helper']['size'], 2)
+        self.assertEqual(stats['helper']['max_active'], 2)
+        self.assertEqual(stats['helper']['completed'], 4)
+        self.assertEqual(stats['helper']['saturated'], 2)
+        self.assertEqual(stats['helper']['wait']['count'], 4)
+
+    def test_drain_tasks(self):
+        exchange = self.start_exchange()
+        echo = self.start_executor(EchoExecutor, 'echo', exchange, shutdown_timeout=0.3)
+        client = self.start_executor(RequestExecutor, 'client', exchange)
+        quick = client.submit('echo', SlowReq(0.1))
+        slow = client.submit('echo', SlowReq(5.0))
+        self.run_coro(asyncio.sleep(0.05))
+        echo.stop()
+        # requests received while stopping are refused
+        refused = self.run_coro(client.submit('echo', 'ping'))
+        self.assertIsInstance(refused, ExchangeFail)
+        self.assertEqual(self.run_coro(quick)[1].delay, 0.1)
+        # the request still running after the shutdown timeout is abandoned
+        abandoned = self.run_coro(slow)
+        self.assertIsInstance(abandoned, ExchangeFail)
+        self.assertIn('stopped', abandoned.value)
+        stats = echo.shutdown_stats
+        self.assertEqual((stats["completed"], stats["abandoned"]), (1, 1))
+        self.assertLess(stats["duration"], 1.0)
+
+    def test_local_delivery(self):
+        exchange = self.start_exchange(max_queue=4, send_timeout=0)
+        echo = self.start_executor(EchoExecutor, 'echo', exchange)
+        client = self.start_executor(RequestExecutor, 'client', exchange)
+        self.assertEqual(self.run_coro(client.submit('echo', 'ping')), ('echo', 'ping'))
+        self.assertEqual(echo.local_stats()["delivered"], 1)
+        # the reply is also delivered directly
+        self.assertEqual(client.local_stats()["delivered"], 1)
+        # each side is given a copy of the messages
+        payload = {'items': [1, 2]}
+        reply = self.run_coro(client.submit('echo', payload))
+        self.assertEqual(reply, ('echo', payload))
+        self.assertIsNot(reply[1], payload)
+        self.assertIsNot(reply[1]['items'], payload['items'])
+        # hold up the recipient's event loop, so that requests wait to be processed
+        blocked = Event()
+        echo.runner().call_soon(blocked.wait)
+        results = [client.submit('echo', idx) for idx in range(50)]
+        self.loop.call_later(0.2, blocked.set)
+        results = self.run_coro(asyncio.gather(*results, return_exceptions=True))
+        replies = [result for result in results if isinstance(result, tuple)]
+        rejected = [result for result in results if isinstance(result, ExchangeFullError)]
+        # requests beyond the queue limit are passed to the exchange, which rejects
+        # those that do not fit in its own queue
+        self.assertEqual(len(replies) + len(rejected), 50)
+        self.assertTrue(rejected)
+        stats = echo.local_stats()
+        self.assertEqual(stats["max_depth"], 4)
+        self.assertEqual(stats["deferred"], 46)
+        self.assertEqual(stats["depth"], 0)
+        self.assertEqual(stats["delivered"], 6)
+        self.assertEqual(client.local_stats()["delivered"], len(replies) + 2)
+        # once stopped, requests are sent through the exchange and are not answered
+        echo.stop()
+        with self.assertRaises(asyncio.CancelledError):
+            self.run_coro(client.submit('echo', 'ping', timeout=0.2))
+        self.assertEqual(echo.local_stats()["delivered"], 6)
+
+    def test_local_delivery_journaled(self):
+        # requests are passed through the exchange when it keeps a journal
+        with tempfile.TemporaryDirectory() as path:
+            exchange = Exchange(journal_path=path)
+            exchange.start(False)
+            echo = EchoExecutor('echo', exchange)
+            echo.start()
+            client = RequestExecutor('client', exchange)
+            client.start()
+            self.assertEqual(self.run_coro(client.submit('echo', 'ping')), ('echo', 'ping'))
+            self.assertEqual(echo.local_stats()["delivered"], 0)
+            self.assertEqual(client.local_stats()["delivered"], 0)
+            echo.stop()
+            client.stop()
+            exchange.stop()
+            exchange.join()
+            # the request was recorded and acknowledged in the journal of the recipient
+            journal_file = MessageJournal(path)._pid_path('echo')
+            self.assertTrue(os.path.exists(journal_file))
+            with open(journal_file, 'rb') as infile:
+                self.assertIn(b'ping', infile.read())
+            journal = MessageJournal(path)
+            self.assertEqual(journal.open('echo'), [])
+            journal.close()
+
+    def test_journal_replay(self):
+        with tempfile.TemporaryDirectory() as path:
+            exchange = Exchange(journal_path=path, drain_timeout=0.2)
+            exchange.start(False)
+            exchange.register('echo')
+            exchange.send('echo', MessageWrapper('client', 'req-1', 'ping'))
+            # received, but not acknowledged before the exchange stops
+            self.assertEqual(exchange.recv('echo').ident, 'req-1')
+            exchange.stop()
+            exchange.join()
+
+            exchange = Exchange(journal_path=path)
+            exchange.start(False)
+            client = RequestExecutor('client', exchange)
+            client.start()
+            echo = EchoExecutor('echo', exchange)
+            echo.start()
+            # the request is replayed with its original sender and identifier,
+            # so the reply is discarded by the new client
+            for _ in range(500):
+                if echo.handled:
+                    break
+                time.sleep(0.01)
+            self.assertEqual(echo.handled, 1)
+            self.assertEqual(self.run_coro(client.submit('echo', 'pong')), ('echo', 'pong'))
+            self.assertEqual(client._requests, {})
+            echo.stop()
+            client.stop()
+            exchange.stop()
+            exchange.join()
+            # the handled requests were acknowledged
+            journal = MessageJournal(path)
+            self.assertEqual(journal.open('echo'), [])
+            journal.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+#
+# Copyright 2017-2018 Government of Canada - Public Services and Procurement Canada - buyandsell.gc.ca
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Tests for connecting to an exchange from another host
+"""
+
+import os
+import tempfile
+from threading import Thread
+import unittest
+
+from vonx.common.exchange import (
+    ExchangeFullError, Exchange, MessageWrapper, QueuedMessage, StopMessage)
+from vonx.common.remote import ExchangeServer, parse_address, RemoteExchange
+
+from .samples import sample_messages
+
+
+class TestRemoteExchange(unittest.TestCase):
+
+    def test_remote_exchange(self):
+        with tempfile.TemporaryDirectory() as path:
+            for address in (os.path.join(path, 'exchange.sock'), ('127.0.0.1', 0)):
+                exchange = Exchange(max_queue=2, send_timeout=0)
+                exchange.start(False)
+                server = ExchangeServer(exchange, address, b'secret', poll_interval=0.05)
+                server.start()
+                client = RemoteExchange(server.address, b'secret')
+                client.start()
+                self.assertTrue(client.register('codec'))
+                self.assertTrue(client.is_registered('codec'))
+                messages = sample_messages()[:2]
+                self.assertEqual(client.send_many([
+                    QueuedMessage('codec', MessageWrapper('test', None, message))
+                    for message in messages]), [True, True])
+                # errors raised by the exchange are passed to the client
+                with self.assertRaises(ExchangeFullError):
+                    client.send('codec', MessageWrapper('test', None, messages[0]))
+                self.assertEqual(
+                    [repr(wrapper.message) for wrapper in client.recv_many('codec')],
+                    [repr(message) for message in messages])
+                self.assertEqual(client.recv_many('codec', timeout=0.1), [])
+                self.assertEqual(client.status()['queues']['codec']['depth'], 0)
+                # a message sent locally wakes the remote receiver
+                Thread(target=exchange.send, args=(
+                    'codec', MessageWrapper('test', None, StopMessage()))).start()
+                self.assertIsInstance(client.recv('codec').message, StopMessage)
+                client.stop()
+                server.stop()
+                exchange.stop()
+                exchange.join()
+        with self.assertRaises(ValueError):
+            ExchangeServer(None, ('127.0.0.1', 0))
+        self.assertEqual(parse_address('localhost:8000'), ('localhost', 8000))
+        self.assertEqual(parse_address('/tmp/exchange.sock'), '/tmp/exchange.sock')
+
+
+if __name__ == '__main__':
+    unittest.main()
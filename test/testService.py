@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+#
+# Copyright 2017-2018 Government of Canada - Public Services and Procurement Canada - buyandsell.gc.ca
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Tests for services exchanging requests with each other
+"""
+
+import asyncio
+import unittest
+
+from vonx.common.exchange import Exchange, LocalExchange
+from vonx.common.manager import ServiceManager
+from vonx.common.service import (
+    ServiceBase, ServiceRequest, ServiceResponse, ServiceStatus, ServiceStatusReq)
+
+
+class LookupReq(ServiceRequest):
+    _fields = (
+        ("name", str),
+    )
+    _coalesce = True
+
+
+class LookupResult(ServiceResponse):
+    _fields = (
+        ("name", str),
+        ("value", int),
+    )
+
+
+class BackendService(ServiceBase):
+    def __init__(self, pid: str, exchange: Exchange):
+        super(BackendService, self).__init__(pid, exchange, {})
+        self.handled = 0
+
+    async def _service_request(self, request: ServiceRequest) -> ServiceResponse:
+        if isinstance(request, LookupReq):
+            self.handled += 1
+            await asyncio.sleep(0.2)
+            return LookupResult(request.name, len(request.name))
+        return None
+
+
+class FrontendService(ServiceBase):
+    def __init__(self, pid: str, exchange: Exchange, backend: str):
+        super(FrontendService, self).__init__(pid, exchange, {})
+        self._backend = backend
+
+    async def _service_request(self, request: ServiceRequest) -> ServiceResponse:
+        if isinstance(request, LookupReq):
+            # forward the request to another service
+            return await self.submit(self._backend, request, timeout=5)
+        return None
+
+
+class TestService(unittest.TestCase):
+
+    def test_service_submit(self):
+        exchange = Exchange()
+        exchange.start(False)
+        backend = BackendService('backend', exchange)
+        backend.start()
+        frontend = FrontendService('frontend', exchange, 'backend')
+        frontend.start()
+        try:
+            loop = asyncio.new_event_loop()
+            async def lookup():
+                status = await frontend.submit('backend', ServiceStatusReq(), timeout=5)
+                self.assertIsInstance(status, ServiceStatus)
+                self.assertEqual(status.status["id"], "backend")
+                # identical requests received by either service share one response
+                return await asyncio.gather(*(
+                    backend.submit('frontend', LookupReq("name"), timeout=5)
+                    for _ in range(5)))
+            results = loop.run_until_complete(asyncio.wait_for(lookup(), 10, loop=loop))
+            loop.close()
+            self.assertEqual([(result.name, result.value) for result in results],
+                             [("name", 4)] * 5)
+            self.assertEqual(backend.handled, 1)
+        finally:
+            frontend.stop()
+            backend.stop()
+            exchange.stop()
+
+    def test_exchange_mode(self):
+        create = ServiceManager._create_exchange
+        self.assertIsInstance(create({"EXCHANGE_MODE": "local"}), LocalExchange)
+        self.assertIsInstance(create({"EXCHANGE_MODE": "auto"}), LocalExchange)
+        journaled = {"EXCHANGE_MODE": "auto", "EXCHANGE_JOURNAL_PATH": "/tmp/journal"}
+        self.assertIsInstance(create(journaled), Exchange)
+        # settings ignored by the local exchange are rejected
+        for name, value in (("EXCHANGE_SHARDS", "2"), ("EXCHANGE_TRANSPORT", "shm"),
+                            ("EXCHANGE_SHM_THRESHOLD", "4096"), ("EXCHANGE_CODEC", "compact"),
+                            ("EXCHANGE_JOURNAL_PATH", "/tmp/journal")):
+            with self.assertRaises(ValueError) as ctx:
+                create({"EXCHANGE_MODE": "local", name: value})
+            self.assertIn(name, str(ctx.exception))
+
+    def test_manager_status(self):
+        manager = ServiceManager({"EXCHANGE_MODE": "local"})
+        manager.start()
+        try:
+            status = manager.runner().submit(manager._get_status()).result(10)
+            self.assertEqual(status.status["exchange"]["pending"], 0)
+        finally:
+            manager.stop()
+
+
+if __name__ == '__main__':
+    unittest.main()
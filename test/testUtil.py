@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+#
+# Copyright 2017-2018 Government of Canada - Public Services and Procurement Canada - buyandsell.gc.ca
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Tests for the utility classes
+"""
+
+import asyncio
+import unittest
+
+from vonx.common.util import TaskGraph
+
+
+class TestUtil(unittest.TestCase):
+
+    def test_task_graph(self):
+        order = []
+        running = [0, 0]
+        async def task(name, result=True):
+            running[0] += 1
+            running[1] = max(running)
+            await asyncio.sleep(0.01)
+            running[0] -= 1
+            order.append(name)
+            if isinstance(result, Exception):
+                raise result
+            return result
+        graph = TaskGraph(concurrency=2)
+        graph.add('wallet', lambda: task('wallet'))
+        for name in ('a', 'b', 'c'):
+            graph.add(name, lambda name=name: task(name), ('wallet',))
+        graph.add('partial', lambda: task('partial', False))
+        graph.add('skipped', lambda: task('skipped'), ('a', 'partial'))
+        graph.add('after', lambda: task('after'), (), ('partial',))
+        with self.assertRaises(ValueError):
+            graph.add('missing', lambda: task('missing'), ('unknown',))
+        loop = asyncio.new_event_loop()
+        results = loop.run_until_complete(graph.run())
+        self.assertLess(order.index('wallet'), order.index('a'))
+        self.assertEqual(running[1], 2)
+        self.assertIs(results['skipped'], False)
+        self.assertTrue(results['after'])
+        self.assertEqual(graph.timings['partial']['status'], 'incomplete')
+        self.assertEqual(graph.timings['skipped'], {'status': 'skipped'})
+        self.assertNotIn('skipped', order)
+        # errors are raised once the other tasks have finished
+        graph = TaskGraph()
+        graph.add('failed', lambda: task('failed', ValueError('failed')))
+        graph.add('other', lambda: task('other'))
+        with self.assertRaises(ValueError):
+            loop.run_until_complete(graph.run())
+        self.assertEqual(graph.timings['other']['status'], 'complete')
+        loop.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+#
+# Copyright 2017-2018 Government of Canada - Public Services and Procurement Canada - buyandsell.gc.ca
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Tests for the web application middleware
+"""
+
+import asyncio
+import unittest
+
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+from vonx.common.exchange import ExchangeFullError
+from vonx.web import _exchange_full_middleware
+
+
+async def _full_handler(_request):
+    raise ExchangeFullError("queue for 'indy' is full")
+
+
+async def _ok_handler(_request):
+    return web.Response(text="ok")
+
+
+class TestWeb(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        asyncio.set_event_loop(None)
+        self.loop.close()
+
+    def _get(self, path):
+        async def fetch():
+            app = web.Application(middlewares=[_exchange_full_middleware])
+            app.router.add_get("/full", _full_handler)
+            app.router.add_get("/ok", _ok_handler)
+            client = TestClient(TestServer(app))
+            await client.start_server()
+            try:
+                resp = await client.get(path)
+                return resp.status, resp.headers.get("Retry-After"), await resp.text()
+            finally:
+                await client.close()
+        return self.loop.run_until_complete(fetch())
+
+    def test_exchange_full_middleware(self):
+        status, retry_after, _text = self._get("/full")
+        self.assertEqual(status, 503)
+        self.assertEqual(retry_after, "1")
+
+        status, retry_after, text = self._get("/ok")
+        self.assertEqual(status, 200)
+        self.assertIsNone(retry_after)
+        self.assertEqual(text, "ok")
+
+
+if __name__ == '__main__':
+    unittest.main()
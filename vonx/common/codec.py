@@ -0,0 +1,238 @@
+#
+# Copyright 2017-2018 Government of Canada
+# Public Services and Procurement Canada - buyandsell.gc.ca
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Codecs used by the :class:`Exchange` to encode message payloads for transport
+between processes
+"""
+
+import logging
+import marshal
+import pickle
+import zlib
+
+from .exchange import ExchangeMessage
+
+LOGGER = logging.getLogger(__name__)
+
+# frame format identifiers
+_FORMAT_PICKLE = 0
+_FORMAT_COMPACT = 1
+
+# frame flags
+_FLAG_ZLIB = 1
+
+# marks a nested message within the encoded field values
+_MESSAGE_MARK = b'\x00msg'
+
+_MESSAGE_TYPES = {}
+_MESSAGE_TYPE_IDS = {}
+
+
+def message_type_id(cls) -> int:
+    """
+    Calculate the stable type identifier of a message class from its qualified name
+    """
+    name = '{}.{}'.format(cls.__module__, cls.__qualname__)
+    return zlib.crc32(name.encode('utf-8'))
+
+
+def register_message_type(cls) -> int:
+    """
+    Register a message class with the compact codec
+
+    Args:
+        cls: a subclass of :class:`ExchangeMessage`
+
+    Returns:
+        the type identifier assigned to the class
+    """
+    type_id = _MESSAGE_TYPE_IDS.get(cls)
+    if type_id is None:
+        type_id = message_type_id(cls)
+        found = _MESSAGE_TYPES.get(type_id)
+        if found is not None and found is not cls:
+            raise ValueError('Message type identifier collision: {} {}'.format(cls, found))
+        _MESSAGE_TYPES[type_id] = cls
+        _MESSAGE_TYPE_IDS[cls] = type_id
+    return type_id
+
+
+def _register_subclasses(base) -> None:
+    for cls in base.__subclasses__():
+        register_message_type(cls)
+        _register_subclasses(cls)
+
+
+def resolve_message_type(type_id: int):
+    """
+    Find the message class for a type identifier. Unknown identifiers cause the
+    currently loaded subclasses of :class:`ExchangeMessage` to be registered
+
+    Args:
+        type_id: the type identifier produced by :func:`message_type_id`
+    """
+    cls = _MESSAGE_TYPES.get(type_id)
+    if cls is None:
+        _register_subclasses(ExchangeMessage)
+        cls = _MESSAGE_TYPES.get(type_id)
+        if cls is None:
+            raise ValueError('Unknown message type identifier: {}'.format(type_id))
+    return cls
+
+
+class Codec:
+    """
+    Base class for message codecs. Encoded messages are always `bytes`
+    """
+
+    name = None
+
+    def __init__(self, compress_threshold: int = None, compress_level: int = 1):
+        """
+        Initialize the codec
+
+        Args:
+            compress_threshold: the minimum size in bytes for an encoded message
+                to be compressed with zlib, or None to disable compression
+            compress_level: the zlib compression level
+        """
+        self._compress_threshold = compress_threshold
+        self._compress_level = compress_level
+
+    def encode(self, message) -> bytes:
+        """
+        Encode a message for transport
+
+        Args:
+            message: the message to be encoded
+        """
+        fmt, body = self._encode(message)
+        flags = 0
+        if self._compress_threshold is not None and len(body) >= self._compress_threshold:
+            packed = zlib.compress(body, self._compress_level)
+            if len(packed) < len(body):
+                body = packed
+                flags |= _FLAG_ZLIB
+        return bytes((fmt, flags)) + body
+
+    def decode(self, data):
+        """
+        Decode a message produced by :meth:`encode`
+
+        Args:
+            data: the encoded message as `bytes` or another buffer
+        """
+        fmt = data[0]
+        with memoryview(data) as view:
+            body = view[2:]
+            try:
+                if data[1] & _FLAG_ZLIB:
+                    body = zlib.decompress(body)
+                if fmt == _FORMAT_PICKLE:
+                    return pickle.loads(body)
+                if fmt == _FORMAT_COMPACT:
+                    return self._unpack(marshal.loads(body))
+            finally:
+                if isinstance(body, memoryview):
+                    body.release()
+        raise ValueError('Unsupported message format: {}'.format(fmt))
+
+    def _encode(self, message) -> tuple:
+        return _FORMAT_PICKLE, pickle.dumps(message, pickle.HIGHEST_PROTOCOL)
+
+    def _unpack(self, value):
+        if isinstance(value, tuple) and len(value) == 3 and value[0] == _MESSAGE_MARK:
+            cls = resolve_message_type(value[1])
+            message = cls.__new__(cls)
+            message._values = tuple(self._unpack_field(val) for val in value[2])
+            return message
+        return value
+
+    def _unpack_field(self, value):
+        if isinstance(value, list) and value and isinstance(value[0], tuple):
+            return [self._unpack(val) for val in value]
+        return self._unpack(value)
+
+
+class PickleCodec(Codec):
+    """
+    Encode messages using the pickle module
+    """
+
+    name = 'pickle'
+
+
+class CompactCodec(Codec):
+    """
+    Encode messages as a registered type identifier followed by the positional
+    field values, in the fast binary format of the marshal module. This avoids
+    transmitting the class path and field names of each message. Nested messages
+    are supported as field values or lists of field values; anything else which
+    cannot be represented falls back to pickle.
+
+    The marshal format is only stable within a single Python version, so this
+    codec must not be used between different interpreters.
+    """
+
+    name = 'compact'
+
+    def __init__(self, compress_threshold: int = 16384, compress_level: int = 1):
+        super(CompactCodec, self).__init__(compress_threshold, compress_level)
+
+    def _encode(self, message) -> tuple:
+        if isinstance(message, ExchangeMessage):
+            try:
+                return _FORMAT_COMPACT, marshal.dumps(self._pack(message))
+            except ValueError:
+                # unsupported type within the message values
+                pass
+        return super(CompactCodec, self)._encode(message)
+
+    def _pack(self, message: ExchangeMessage) -> tuple:
+        values = []
+        for value in message._values:
+            if isinstance(value, ExchangeMessage):
+                value = self._pack(value)
+            elif isinstance(value, list) and value and isinstance(value[0], ExchangeMessage):
+                if not all(isinstance(val, ExchangeMessage) for val in value):
+                    # only lists made up entirely of messages are packed
+                    raise ValueError('List combines messages with other values')
+                value = [self._pack(val) for val in value]
+            values.append(value)
+        return (_MESSAGE_MARK, register_message_type(type(message)), tuple(values))
+
+
+CODECS = {
+    PickleCodec.name: PickleCodec,
+    CompactCodec.name: CompactCodec,
+}
+
+
+def get_codec(name: str, **params) -> Codec:
+    """
+    Create a codec instance by name
+
+    Args:
+        name: the codec name, or None or `none` to disable message encoding
+        params: additional parameters for the codec constructor
+    """
+    if not name or name == 'none':
+        return None
+    if name not in CODECS:
+        raise ValueError('Unsupported exchange codec: {}'.format(name))
+    return CODECS[name](**params)
@@ -20,13 +20,90 @@ Methods and classes for working with asyncio event loops
 """
 
 import asyncio
-from concurrent.futures import Executor, Future
-from threading import get_ident, Event, Thread
-from typing import Awaitable, Callable, Coroutine
+from collections import deque
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+from functools import partial
+from threading import get_ident, Event, Lock, Thread
+import time
+from typing import Awaitable, Callable, Coroutine, Iterable, Mapping
 import logging
 
+from .telemetry import Histogram
+
 LOGGER = logging.getLogger(__name__)
 
+EVENT_LOOPS = ('asyncio', 'uvloop', 'auto')
+
+_LOOP_FACTORY = asyncio.new_event_loop
+
+
+def new_event_loop() -> asyncio.AbstractEventLoop:
+    """
+    Create a new event loop using the configured loop factory
+    """
+    return _LOOP_FACTORY()
+
+
+def set_loop_factory(factory: Callable = None) -> None:
+    """
+    Replace the factory used by :func:`new_event_loop`
+
+    Args:
+        factory: a callable returning a new event loop, or None to restore
+            the default asyncio event loop
+    """
+    global _LOOP_FACTORY
+    _LOOP_FACTORY = factory or asyncio.new_event_loop
+
+
+def init_event_loop(env: Mapping) -> str:
+    """
+    Select the event loop implementation using the `EVENT_LOOP` setting:
+    `asyncio` (the default), `uvloop`, or `auto` to use uvloop when it is
+    installed. The event loop policy is also replaced, so that loops created
+    by other libraries (such as the aiohttp web server) use the same
+    implementation, including in any processes forked afterwards
+
+    Returns:
+        the name of the event loop implementation in use
+    """
+    setting = (env.get('EVENT_LOOP') or 'asyncio').lower()
+    if setting not in EVENT_LOOPS:
+        raise ValueError('Unsupported event loop: {}'.format(setting))
+    name = 'asyncio'
+    if setting != 'asyncio':
+        try:
+            import uvloop
+        except ImportError:
+            if setting == 'uvloop':
+                LOGGER.warning('uvloop is not installed, using the asyncio event loop')
+        else:
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+            set_loop_factory(uvloop.new_event_loop)
+            name = 'uvloop'
+    if name == 'asyncio':
+        set_loop_factory(None)
+    LOGGER.info('Using the %s event loop (EVENT_LOOP=%s)', name, setting)
+    return name
+
+
+def current_task() -> asyncio.Task:
+    """
+    Get the task running in the current thread's event loop, if any
+    """
+    if hasattr(asyncio, 'current_task'):
+        try:
+            return asyncio.current_task()
+        except RuntimeError:
+            return None
+    return asyncio.Task.current_task()
+
+
+def _all_tasks(loop: asyncio.AbstractEventLoop) -> set:
+    if hasattr(asyncio, 'all_tasks'):
+        return asyncio.all_tasks(loop)
+    return asyncio.Task.all_tasks(loop)
+
 
 def run_coro(coro: Coroutine):
     """
@@ -41,7 +118,7 @@ def run_coro(coro: Coroutine):
     try:
         event_loop = asyncio.get_event_loop()
     except RuntimeError:
-        event_loop = asyncio.new_event_loop()
+        event_loop = new_event_loop()
         asyncio.set_event_loop(event_loop)
     return event_loop.run_until_complete(coro)
 
@@ -56,7 +133,7 @@ def run_in_executor(executor: Executor, coro: Coroutine) -> Future:
     Returns:
         A `Future` which can be used to access the result of the coroutine
     """
-    loop = asyncio.new_event_loop()
+    loop = new_event_loop()
     def _run_sync_loop(loop, coro):
         asyncio.set_event_loop(loop)
         loop.run_until_complete(coro)
@@ -64,6 +141,100 @@ def run_in_executor(executor: Executor, coro: Coroutine) -> Future:
     return future
 
 
+class ThreadPool(ThreadPoolExecutor):
+    """
+    A named :class:`ThreadPoolExecutor` which measures how busy its workers are,
+    so that a pool too small for its workload can be recognized
+    """
+
+    def __init__(self, max_workers: int, name: str = None):
+        """
+        Initialize the pool
+
+        Args:
+            max_workers: the maximum number of worker threads
+            name: the name used for the pool and as a prefix for its thread names
+        """
+        try:
+            super(ThreadPool, self).__init__(max_workers, thread_name_prefix=name or '')
+        except TypeError:
+            # thread names are not supported before Python 3.6
+            super(ThreadPool, self).__init__(max_workers)
+        self._name = name
+        self._size = max_workers
+        self._stats_lock = Lock()
+        self._active = 0
+        self._queued = 0
+        self._max_active = 0
+        self._max_queued = 0
+        self._completed = 0
+        self._saturated = 0
+        self._waits = Histogram()
+
+    @property
+    def name(self) -> str:
+        """
+        Accessor for the name of the pool
+        """
+        return self._name
+
+    def submit(self, fn, *args, **kwargs) -> Future:
+        """
+        Schedule a function to be run by one of the worker threads, see
+        :meth:`ThreadPoolExecutor.submit`
+        """
+        with self._stats_lock:
+            if self._active + self._queued >= self._size:
+                # no worker is available, so the call must wait in the queue
+                self._saturated += 1
+            self._queued += 1
+            if self._queued > self._max_queued:
+                self._max_queued = self._queued
+        future = super(ThreadPool, self).submit(
+            self._call, time.perf_counter(), fn, args, kwargs)
+        future.add_done_callback(self._done)
+        return future
+
+    def _call(self, queued_at: float, fn: Callable, args: tuple, kwargs: dict):
+        """
+        Run a submitted function in a worker thread, recording the time it waited
+        """
+        with self._stats_lock:
+            self._queued -= 1
+            self._active += 1
+            if self._active > self._max_active:
+                self._max_active = self._active
+            self._waits.add(int((time.perf_counter() - queued_at) * 1e6))
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            with self._stats_lock:
+                self._active -= 1
+                self._completed += 1
+
+    def _done(self, future: Future) -> None:
+        if future.cancelled():
+            # the call was removed from the queue without running
+            with self._stats_lock:
+                self._queued -= 1
+
+    def stats(self) -> dict:
+        """
+        Summarize the use of the pool
+        """
+        with self._stats_lock:
+            return {
+                "size": self._size,
+                "active": self._active,
+                "queued": self._queued,
+                "max_active": self._max_active,
+                "max_queued": self._max_queued,
+                "completed": self._completed,
+                "saturated": self._saturated,
+                "wait": self._waits.results(1e-6),
+            }
+
+
 class Runner:
     """
     Run a new event loop in a separate thread and allow tasks to be submitted to it
@@ -72,6 +243,10 @@ class Runner:
         self._active = False
         self._loop = loop
         self._thread = None
+        self._submitted = deque()
+        self._submit_lock = Lock()
+        self._submit_scheduled = False
+        self._abandoned = 0
 
     @property
     def loop(self):
@@ -80,6 +255,14 @@ class Runner:
         """
         return self._loop
 
+    @property
+    def abandoned(self) -> int:
+        """
+        The number of tasks which were cancelled because they were still running
+        when the event loop was stopped
+        """
+        return self._abandoned
+
     def start(self, wait: bool = True) -> None:
         """
         Run the event loop in a new thread
@@ -90,7 +273,7 @@ class Runner:
         if self._active:
             return
         if not self._loop:
-            self._loop = asyncio.new_event_loop()
+            self._loop = new_event_loop()
         event = Event() if wait else None
         self._thread = Thread(target=self._run, args=(event,))
         self._thread.daemon = True
@@ -109,10 +292,19 @@ class Runner:
                 event.set()
         self._loop.call_soon(_ready)
         self._loop.run_forever()
+        # cancel the tasks left running, so that their callers are not left waiting
+        pending = [task for task in _all_tasks(self._loop) if not task.done()]
+        if pending:
+            LOGGER.debug('Cancelling %s tasks still running', len(pending))
+            self._abandoned += len(pending)
+            for task in pending:
+                task.cancel()
+            self._loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
 
     def stop(self, wait: bool = True) -> None:
         """
-        Terminate the event loop thread
+        Terminate the event loop thread. Any tasks still running are cancelled
+        before the thread exits
 
         Args:
             wait: block until the event loop has been stopped
@@ -120,8 +312,6 @@ class Runner:
         def _finish(event):
             self._active = False
             self._loop.stop()
-            #pending = asyncio.Task.all_tasks()
-            #self._loop.run_until_complete(asyncio.gather(*pending))
             if event:
                 event.set()
         if get_ident() == self._thread.ident:
@@ -169,6 +359,90 @@ class Runner:
             result = fut.result()
         return result
 
+    def submit(self, coro: Awaitable) -> Future:
+        """
+        Add a coroutine to the event loop without waiting for it to be scheduled,
+        see :meth:`run_tasks`
+
+        Args:
+            coro: the coroutine to be added
+
+        Returns:
+            a :class:`Future` resolved with the result of the coroutine
+        """
+        return self.run_tasks((coro,))[0]
+
+    def run_tasks(self, coros: Iterable[Awaitable]) -> list:
+        """
+        Add a batch of coroutines to the event loop, from any thread. The caller
+        does not wait for the tasks to be created, and the coroutines submitted
+        before the event loop next runs are started together after a single wakeup.
+        Cancelling a returned future cancels its task
+
+        Args:
+            coros: the coroutines to be added
+
+        Returns:
+            a list of :class:`Future` instances resolved with the result of each coroutine
+        """
+        if not self._active:
+            raise RuntimeError('Runner is not active')
+        batch = [(coro, Future()) for coro in coros]
+        if get_ident() == self._thread.ident:
+            self._start_tasks(batch)
+        elif batch:
+            with self._submit_lock:
+                self._submitted.extend(batch)
+                wake = not self._submit_scheduled
+                self._submit_scheduled = True
+            if wake:
+                self._loop.call_soon_threadsafe(self._start_submitted)
+        return [future for (_coro, future) in batch]
+
+    def _start_submitted(self) -> None:
+        """
+        Start the tasks submitted from other threads, in the event loop thread
+        """
+        with self._submit_lock:
+            batch = list(self._submitted)
+            self._submitted.clear()
+            self._submit_scheduled = False
+        self._start_tasks(batch)
+
+    def _start_tasks(self, batch: list) -> None:
+        """
+        Create a task for each submitted coroutine and pass its result to the
+        associated :class:`Future`
+        """
+        for coro, future in batch:
+            if future.cancelled():
+                if asyncio.iscoroutine(coro):
+                    coro.close()
+                continue
+            task = asyncio.ensure_future(coro, loop=self._loop)
+            task.add_done_callback(partial(_copy_task_state, future=future))
+            future.add_done_callback(partial(self._cancel_task, task))
+
+    def _cancel_task(self, task: asyncio.Future, future: Future) -> None:
+        """
+        Cancel a task when the future returned for it is cancelled, from any thread
+        """
+        if future.cancelled() and not task.done():
+            self.call_soon(task.cancel)
+
+    def call_soon(self, callback: Callable, *args) -> None:
+        """
+        Schedule a callback to be run by the event loop, from any thread
+
+        Args:
+            callback: the function to be called
+            args: arguments to pass to the function
+        """
+        if get_ident() == self._thread.ident:
+            self._loop.call_soon(callback, *args)
+        else:
+            self._loop.call_soon_threadsafe(callback, *args)
+
     def run_in_executor(self, executor: Executor, func: Callable, *args) -> asyncio.Future:
         """
         Run a function in an executor, in the runner's event loop
@@ -182,3 +456,123 @@ class Runner:
             raise RuntimeError('Runner is not active')
         coro = self._loop.run_in_executor(executor, func, *args)
         return self.run_task(coro)
+
+
+def _copy_task_state(task: asyncio.Future, future: Future) -> None:
+    """
+    Pass the outcome of a finished task to a :class:`Future`
+    """
+    if task.cancelled():
+        future.cancel()
+    elif not future.set_running_or_notify_cancel():
+        return
+    elif task.exception() is not None:
+        future.set_exception(task.exception())
+    else:
+        future.set_result(task.result())
+
+
+class TimerWheel:
+    """
+    A hashed timer wheel for the timeouts of a large number of pending operations
+    in an event loop. Timers are added and removed in constant time, and a single
+    callback advances the wheel once per tick while any timers are waiting.
+    Timers fire within one tick of their expiry time
+    """
+    def __init__(self, loop=None, tick: float = 0.1, slots: int = 512):
+        """
+        Initialize the timer wheel
+
+        Args:
+            loop: the event loop used to run timer callbacks
+            tick: the resolution of the timers in seconds
+            slots: the number of slots in the wheel
+        """
+        self._loop = loop or asyncio.get_event_loop()
+        self._tick = tick
+        self._slots = [{} for _ in range(max(slots, 1))]
+        self._index = {}
+        self._handle = None
+        self._position = None
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def add(self, key, delay: float, callback: Callable, *args) -> None:
+        """
+        Add a timer, replacing any existing timer with the same key. This must be
+        called from the event loop thread
+
+        Args:
+            key: a unique identifier for the timer
+            delay: the number of seconds before the timer fires
+            callback: the function to call when the timer fires
+            args: arguments to pass to the function
+        """
+        self.remove(key)
+        expire = self._loop.time() + delay
+        slot = self._slots[int(expire / self._tick) % len(self._slots)]
+        slot[key] = (expire, callback, args)
+        self._index[key] = slot
+        if not self._handle:
+            current = int(self._loop.time() / self._tick)
+            self._position = current - 1
+            self._handle = self._loop.call_at((current + 1) * self._tick, self._advance)
+
+    def remove(self, key) -> bool:
+        """
+        Remove a timer before it fires
+
+        Args:
+            key: the identifier of the timer
+
+        Returns:
+            True if the timer was found
+        """
+        slot = self._index.pop(key, None)
+        if slot is None:
+            return False
+        del slot[key]
+        return True
+
+    def clear(self) -> None:
+        """
+        Remove all timers without running them
+        """
+        for slot in self._slots:
+            slot.clear()
+        self._index.clear()
+        if self._handle:
+            self._handle.cancel()
+            self._handle = None
+
+    def _advance(self) -> None:
+        """
+        Run the callbacks for the timers which have expired since the last tick
+        """
+        #pylint: disable=broad-except
+        self._handle = None
+        now = self._loop.time()
+        current = int(now / self._tick)
+        # visit the slots for each tick completed since the last advance, at most once.
+        # timers found there with a later expiry belong to a future turn of the wheel
+        first = max(self._position + 1, current - len(self._slots))
+        expired = []
+        for position in range(first, current):
+            slot = self._slots[position % len(self._slots)]
+            for key, (expire, callback, args) in list(slot.items()):
+                if expire <= now:
+                    del slot[key]
+                    del self._index[key]
+                    expired.append((callback, args))
+        self._position = current - 1
+        for callback, args in expired:
+            try:
+                callback(*args)
+            except Exception:
+                LOGGER.exception('Exception in timer callback:')
+        if self._index and not self._handle:
+            self._handle = self._loop.call_at((current + 1) * self._tick, self._advance)
@@ -21,25 +21,45 @@ and acting upon messages
 """
 
 import asyncio
-from collections import deque
-from concurrent.futures import Future, ThreadPoolExecutor
+import base64
+from bisect import bisect
+from collections import deque, OrderedDict
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+import copy
+import ctypes
+import keyword
 import logging
 import multiprocessing as mp
 import os
-from queue import Queue
-from threading import get_ident, Event, Thread
+import pickle
+import shutil
+import socket
+import tempfile
+from threading import get_ident, Condition, Event, Lock, Thread
 import time
 import traceback
+import zlib
 from typing import Awaitable, Callable, NamedTuple, Sequence
 
 import aiohttp
 
-from . import eventloop
+from . import eventloop, tracing
+from .journal import MessageJournal
+from .payload import SharedPayload, shared_payloads_supported
+from .ringbuffer import RingBuffer
+from .telemetry import ConsumerLoad, QueueTelemetry
 
 LOGGER = logging.getLogger(__name__)
 
 
-_MESSAGE_FIELDS = {}
+# message priority classes, in the order they are served
+PRIORITY_CONTROL = 0
+PRIORITY_INTERACTIVE = 1
+PRIORITY_BULK = 2
+PRIORITY_LANES = 3
+
+# marks a constructor argument which was not provided
+_MISSING = object()
 
 def format_type_name(ctype):
     """
@@ -51,80 +71,164 @@ def format_type_name(ctype):
         return 'None'
     return ctype.__name__
 
-class ExchangeMessage:
+def _field_type_error(name: str, val, ftype) -> TypeError:
+    return TypeError("Incorrect type for property '{}' ({}), expected {}".format(
+        name, format_type_name(type(val)), format_type_name(ftype)))
+
+def _compile_field_specs(fields) -> tuple:
     """
-    A common base class for exchange messages
+    Parse the `_fields` definition of a message class into a tuple of the field
+    names, types, default values and positions
     """
-    __slots__ = ('_values',)
-    _fields = ()
+    names = []
+    defaults = {}
+    positions = {}
+    types = {}
+    for idx, field in enumerate(fields):
+        if isinstance(field, tuple):
+            name = field[0]
+            if len(field) > 1:
+                types[name] = field[1]
+                if len(field) > 2:
+                    defaults[name] = field[2]
+        else:
+            name = field
+        names.append(name)
+        positions[name] = idx
+    return (tuple(names), types, defaults, positions)
 
-    def __init__(self, *args, **kwargs):
-        names, types, defaults, _positions = self._field_specs
-        vals = []
-        idx = 0
-        if len(args) + len(kwargs) > len(names):
-            raise TypeError("Too many arguments to constructor")
-        for idx, name in enumerate(names):
-            ftype = types.get(name)
-            if idx < len(args):
-                val = args[idx]
+def _compile_field_init(cls_name: str, specs: tuple):
+    """
+    Generate a constructor which accepts the fields of a message class as
+    positional or keyword arguments and checks their types
+
+    Returns:
+        the constructor, or None if the field names are not valid identifiers
+    """
+    names, types, defaults, _positions = specs
+    if not all(name.isidentifier() and not keyword.iskeyword(name) and
+               not name.startswith('_') for name in names):
+        return None
+    params = []
+    lines = []
+    env = {'_MISSING': _MISSING, '_field_type_error': _field_type_error}
+    for idx, name in enumerate(names):
+        if name in defaults:
+            env['_default_{}'.format(idx)] = defaults[name]
+            params.append('{}=_default_{}'.format(name, idx))
+        else:
+            params.append('{}=_MISSING'.format(name))
+            lines.append('    if {} is _MISSING:'.format(name))
+            lines.append('        raise TypeError("Property not provided to constructor: {}")'
+                         .format(name))
+        if types.get(name) is not None:
+            env['_type_{}'.format(idx)] = types[name]
+            lines.append('    if {0} is not None and not isinstance({0}, _type_{1}):'
+                         .format(name, idx))
+            lines.append("        raise _field_type_error('{0}', {0}, _type_{1})".format(name, idx))
+    lines.append('    _self._values = ({})'.format(''.join(name + ', ' for name in names)))
+    source = 'def __init__(_self{}):\n{}\n'.format(
+        ''.join(', ' + param for param in params), '\n'.join(lines))
+    exec(source, env) #pylint: disable=exec-used
+    init = env['__init__']
+    init.__qualname__ = '{}.__init__'.format(cls_name)
+    init._field_init = True
+    return init
+
+def _field_property(idx: int, name: str) -> property:
+    def _get(self):
+        return self._values[idx]
+    _get._message_field = True
+    return property(_get, doc='The {} field'.format(name))
+
+
+class MessageMeta(type):
+    """
+    Compile the `_fields` of each message class when the class is created: the
+    field specifications, a read-only property for each field, and a constructor
+    specialized to the fields when the class does not define its own
+    """
+
+    def __new__(mcs, name, bases, namespace):
+        # message values are held in the `_values` slot of the base class
+        namespace.setdefault('__slots__', ())
+        cls = super(MessageMeta, mcs).__new__(mcs, name, bases, namespace)
+        specs = _compile_field_specs(cls._fields)
+        cls._field_specs = specs
+        cls._field_names, cls._field_types, cls._field_defaults, cls._field_positions = specs
+        for idx, fname in enumerate(specs[0]):
+            # methods and other attributes take precedence over field names
+            found = getattr(cls, fname, None)
+            if found is None or (isinstance(found, property) and
+                                 getattr(found.fget, '_message_field', False)):
+                setattr(cls, fname, _field_property(idx, fname))
+        init = _compile_field_init(name, specs)
+        cls._init_fields = init or _init_fields_generic
+        inherited = getattr(cls, '__init__')
+        if '__init__' not in namespace and init and \
+                (getattr(inherited, '_field_init', False) or
+                 getattr(inherited, '_generic_init', False)):
+            cls.__init__ = init
+        return cls
+
+
+def _init_fields_generic(self, *args, **kwargs):
+    """
+    Initialize the fields of a message from positional or keyword arguments
+    """
+    names, types, defaults, _positions = self._field_specs
+    vals = []
+    if len(args) + len(kwargs) > len(names):
+        raise TypeError("Too many arguments to constructor")
+    for idx, name in enumerate(names):
+        ftype = types.get(name)
+        if idx < len(args):
+            val = args[idx]
+        else:
+            if name in kwargs:
+                val = kwargs[name]
+            elif name in defaults:
+                val = defaults[name]
             else:
-                if name in kwargs:
-                    val = kwargs[name]
-                elif name in defaults:
-                    val = defaults[name]
-                else:
-                    raise TypeError("Property not provided to constructor: {}".format(name))
-            if val is not None and ftype is not None and not isinstance(val, ftype):
-                raise TypeError("Incorrect type for property '{}' ({}), expected {}".format(
-                    name, format_type_name(type(val)), format_type_name(ftype)))
-            vals.append(val)
-        self._values = tuple(vals)
+                raise TypeError("Property not provided to constructor: {}".format(name))
+        if val is not None and ftype is not None and not isinstance(val, ftype):
+            raise _field_type_error(name, val, ftype)
+        vals.append(val)
+    self._values = tuple(vals)
 
-    @property
-    def _field_specs(self):
-        cname = self.__class__.__name__
-        if cname not in _MESSAGE_FIELDS:
-            names = []
-            defaults = {}
-            positions = {}
-            types = {}
-            for idx, field in enumerate(self._fields):
-                if isinstance(field, tuple):
-                    name = field[0]
-                    if len(field) > 1:
-                        types[name] = field[1]
-                        if len(field) > 2:
-                            defaults[name] = field[2]
-                else:
-                    name = field
-                names.append(name)
-                positions[name] = idx
-            _MESSAGE_FIELDS[cname] = (names, types, defaults, positions)
-        return _MESSAGE_FIELDS[cname]
 
-    @property
-    def _field_names(self):
-        return self._field_specs[0]
+def _restore_message(cls, values: tuple):
+    """
+    Recreate a message from its class and field values, when unpickling
+    """
+    message = cls.__new__(cls)
+    message._values = values
+    return message
 
-    @property
-    def _field_types(self):
-        return self._field_specs[1]
 
-    @property
-    def _field_defaults(self):
-        return self._field_specs[2]
+class ExchangeMessage(metaclass=MessageMeta):
+    """
+    A common base class for exchange messages
+    """
+    __slots__ = ('_values',)
+    _fields = ()
+    _priority = PRIORITY_INTERACTIVE
+    # identical requests in flight at the same time may share a single response
+    _coalesce = False
 
-    @property
-    def _field_positions(self):
-        return self._field_specs[3]
+    def __init__(self, *args, **kwargs):
+        # used by subclasses defining their own constructor
+        self._init_fields(*args, **kwargs)
+    __init__._generic_init = True
+
+    def __reduce__(self):
+        return (_restore_message, (self.__class__, self._values))
 
     def __iter__(self):
         return ((fname, self[idx]) for (idx, fname) in enumerate(self._field_names))
 
     def __getattr__(self, name):
-        if name in self._field_names:
-            return self._values[self._field_positions[name]]
+        # fields are read by their properties, so the name is not a field
         raise AttributeError("Unknown attribute: {}".format(name))
 
     def __getitem__(self, key):
@@ -142,6 +246,22 @@ class ExchangeMessage:
         """
         return getattr(self, name, defval)
 
+    def coalesce_key(self):
+        """
+        Get the key identifying identical requests which may share a single response
+
+        Returns:
+            a hashable key, or None if the message may not be coalesced
+        """
+        if not self._coalesce:
+            return None
+        key = (self.__class__, self._values)
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
     def __repr__(self):
         cls = self.__class__.__name__
         params = ['{}={}'.format(fname, self[idx]) for (idx, fname) in enumerate(self._field_names)]
@@ -191,8 +311,13 @@ MessageWrapper = NamedTuple('MessageWrapper', [
     ('from_pid', str),
     ('ident', str),
     ('message', ExchangeMessage),
-    ('ref', str)])
-MessageWrapper.__new__.__defaults__ = (None,)
+    ('ref', str),
+    ('priority', int),
+    ('deadline', float),
+    ('sent', float),
+    ('seq', int),
+    ('trace', tuple)])
+MessageWrapper.__new__.__defaults__ = (None, None, None, None, None, None)
 MessageWrapper.__doc__ = """
     A wrapper for a message being passed through the :class:`Exchange` message bus
 
@@ -201,7 +326,145 @@ MessageWrapper.__doc__ = """
         ident (str): A unique identifier for the message, used to tag responses
         message (ExchangeMessage): The message received
         ref (str): An optional identifier for the message being responded to
+        priority (int): The priority class of the message, defaulting to the
+            priority of the message class
+        deadline (float): An optional time (as returned by `time.time()`) after
+            which the message is no longer wanted and may be discarded
+        sent (float): The time the message was sent, assigned by the exchange
+        seq (int): The journal sequence number of the message, assigned by the
+            exchange when a journal is in use
+        trace (tracing.TraceContext): The trace identifiers of the sending span,
+            when the request is being traced
+    """
+
+
+def message_priority(message) -> int:
+    """
+    Get the default priority class for a message
+
+    Args:
+        message: the message being sent
+    """
+    return getattr(message, '_priority', PRIORITY_INTERACTIVE)
+
+
+def message_expired(wrapper: MessageWrapper, now: float = None) -> bool:
+    """
+    Check whether the deadline of a message has passed
+
+    Args:
+        wrapper: the message being delivered
+        now: the current time, if already known
+    """
+    if wrapper.deadline is None:
+        return False
+    return wrapper.deadline <= (time.time() if now is None else now)
+
+
+def consumer_limit(group: dict, consumer: str, in_flight: int, depth: int, limit: int) -> int:
+    """
+    Find the number of messages to deliver to one of the consumers sharing a
+    recipient identifier. A consumer receives a share of the waiting messages in
+    proportion to its unused capacity, leaving the rest for the other consumers
+
+    Args:
+        group: the :class:`ConsumerLoad` of each consumer
+        consumer: the identifier of the receiving consumer
+        in_flight: the number of messages the consumer reports in progress
+        depth: the number of messages waiting
+        limit: the maximum number of messages requested, or None
+    """
+    load = group[consumer]
+    load.in_flight = in_flight
+    if not load.free:
+        return 0
+    total = sum(peer.free for peer in group.values())
+    share = max(-(-depth * load.free // total), 1)
+    return min(share, load.free, limit or share)
+
+
+class PriorityLanes:
+    """
+    The queue of messages waiting for a single recipient, divided into one lane
+    for each priority class. Higher priority lanes are served first, but after
+    `burst` messages have been served ahead of a waiting lane, that lane is
+    served once. A :class:`StopMessage` is only delivered once all lanes are empty,
+    and no further messages are accepted after it
+    """
+
+    __slots__ = ('_lanes', '_skipped', '_burst', '_stop')
+
+    def __init__(self, burst: int = 8):
+        self._lanes = tuple(deque() for _ in range(PRIORITY_LANES))
+        self._skipped = [0] * PRIORITY_LANES
+        self._burst = burst
+        self._stop = None
+
+    def __len__(self):
+        return sum(map(len, self._lanes)) + (1 if self._stop else 0)
+
+    def __iter__(self):
+        for lane in self._lanes:
+            yield from lane
+        if self._stop:
+            yield self._stop
+
+    def append(self, wrapper: MessageWrapper) -> bool:
+        """
+        Add a message to the end of the lane for its priority class
+
+        Returns:
+            False if the recipient is stopping and the message was not added
+        """
+        if self._stop:
+            return False
+        if isinstance(wrapper.message, StopMessage):
+            self._stop = wrapper
+            return True
+        lane = wrapper.priority
+        if lane is None:
+            lane = PRIORITY_INTERACTIVE
+        self._lanes[min(max(lane, 0), PRIORITY_LANES - 1)].append(wrapper)
+        return True
+
+    def popleft(self, max_priority: int = None) -> MessageWrapper:
+        """
+        Remove the next message to be delivered
+
+        Args:
+            max_priority: only consider lanes up to and including this priority class
+
+        Returns:
+            the next message, or None if there are no messages waiting
+        """
+        lanes = self._lanes if max_priority is None else self._lanes[:max_priority + 1]
+        chosen = None
+        for idx, lane in enumerate(lanes):
+            if lane:
+                if chosen is None:
+                    chosen = idx
+                elif self._skipped[idx] >= self._burst:
+                    # serve a lower lane which has waited long enough
+                    chosen = idx
+                    break
+                else:
+                    self._skipped[idx] += 1
+        if chosen is None:
+            if max_priority is None and self._stop:
+                wrapper, self._stop = self._stop, None
+                return wrapper
+            return None
+        self._skipped[chosen] = 0
+        return self._lanes[chosen].popleft()
+
+
+class ExchangeFullError(Exception):
+    """
+    Raised when a message cannot be added to the exchange because the queue
+    for the recipient has reached its maximum size
     """
+    pass
+
 
 QueuedMessage = NamedTuple('QueuedMessage', [
     ('to_pid', str),
@@ -215,24 +478,124 @@ QueuedMessage.__doc__ = """
     """
 
 
+TRANSPORT_PIPE = 'pipe'
+TRANSPORT_SHM = 'shm'
+
+
 class Exchange:
     """
     A central message exchange hub for receiving requests and passing them to processors
     which may live in a different thread or process, but have a known identifier.
-    Multiple processors may also respond to the same identifier in order to share processing.
+    Multiple processors may also respond to the same identifier in order to share processing,
+    by registering as consumers with a capacity. Each consumer then receives a share of
+    the waiting messages in proportion to its unused capacity.
     Responses are optional and can be tied to the original request.
     """
 
-    def __init__(self):
+    def __init__(self, wake_slots: int = 16, max_queue: int = None,
+                 send_timeout: float = None, codec=None, shm_threshold: int = None,
+                 lane_burst: int = 8, journal_path: str = None, journal_sync: float = 0.1,
+                 drain_timeout: float = 5.0):
+        """
+        Initialize the exchange. This must be performed before any processes
+        sharing the exchange are forked
+
+        Args:
+            wake_slots: the number of wakeup conditions shared between recipients.
+                A message sent to a recipient only wakes the receivers sharing its slot
+            max_queue: the maximum number of messages waiting for each recipient,
+                or None for no limit
+            send_timeout: the default time to wait for room in a full queue before
+                a send is rejected, or None to wait indefinitely
+            codec: an optional :class:`codec.Codec` instance used to encode message
+                payloads, otherwise messages are pickled whole by the transport
+            shm_threshold: the minimum size in bytes for an encoded payload to be
+                placed in shared memory instead of being sent through the message
+                pipe. This requires a codec
+            lane_burst: the number of higher priority messages delivered ahead of a
+                waiting lower priority message before it is delivered
+            journal_path: an optional directory for the journal of queued requests.
+                Requests which have not been acknowledged with :meth:`ack` when the
+                exchange stops are delivered again when the recipient registers after
+                a restart. Replayed requests keep the sender and identifier of the
+                original request, so replies to them are discarded by the sender
+            journal_sync: the maximum time in seconds between syncs of the journal
+            drain_timeout: the time in seconds to keep delivering the messages left
+                when the exchange is stopped
+        """
         self._cmd_pipe = mp.Pipe()
         self._cmd_lock = mp.Lock()
         self._proc = None
-        self._req_cond = mp.Condition(mp.Lock())
+        slots = max(wake_slots or 1, 1)
+        self._wake_conds = tuple(mp.Condition(mp.Lock()) for _ in range(slots))
+        self._wake_index = {}
+        self._max_queue = max_queue or None
+        self._send_timeout = send_timeout
+        self._codec = codec
+        self._lane_burst = lane_burst
+        self._journal_path = journal_path
+        self._journal_sync = journal_sync
+        self._drain_timeout = drain_timeout
+        self._stopping = mp.Event()
+        self._shm_threshold = None
+        if shm_threshold and codec:
+            if shared_payloads_supported():
+                self._shm_threshold = shm_threshold
+            else:
+                LOGGER.warning('Shared memory payloads are not supported on this platform')
+        self._space_conds = tuple(
+            mp.Condition(mp.Lock()) for _ in range(slots)) if self._max_queue else None
+        self._rings = None
+        self._ring_index = {}
+        self._async_dir = None
+        self._async_waiters = None
+        self._async_readers = {}
+        self._async_writers = {}
 
-    def start(self, process: bool = True) -> None:
+    @property
+    def max_queue(self) -> int:
         """
-        Start the message exchange as a thread or process
+        Accessor for the maximum number of messages waiting for each recipient
+        """
+        return self._max_queue
+
+    @property
+    def journaled(self) -> bool:
+        """
+        Accessor for whether queued requests are recorded in a journal
         """
+        return bool(self._journal_path)
+
+    def start(self, process: bool = True, transport: str = TRANSPORT_PIPE,
+              ring_slots: int = 32, ring_size: int = 1 << 20) -> None:
+        """
+        Start the message exchange as a thread or process
+
+        Args:
+            process: whether to run the message processing loop in a new process
+            transport: the message transport, either `pipe` to pass every message
+                through the processing loop, or `shm` to deliver messages through
+                per-recipient shared memory ring buffers, falling back to the pipe
+                when no buffer is available or a buffer is full. Only interactive
+                messages use the ring buffers: control and bulk messages are
+                queued by the exchange so that the priority lanes are kept, and
+                while they are waiting the interactive messages for the same
+                recipient are queued with them
+            ring_slots: the number of ring buffers available for recipients
+            ring_size: the size of each ring buffer in bytes
+        """
+        if transport == TRANSPORT_SHM:
+            if self._journal_path:
+                # ring buffers would bypass the journal
+                LOGGER.warning('Ring buffers are not used with a message journal')
+            else:
+                self._rings = tuple(RingBuffer(ring_size) for _ in range(ring_slots))
+        elif transport != TRANSPORT_PIPE:
+            raise ValueError('Unsupported exchange transport: {}'.format(transport))
+        if hasattr(os, 'mkfifo'):
+            # named pipes used to wake receivers waiting in an event loop
+            self._async_dir = tempfile.mkdtemp(prefix='vonx-exchange-')
+            self._async_waiters = mp.RawArray(ctypes.c_int, len(self._wake_conds))
         if process:
             evt = mp.Event()
             proc = mp.Process(target=self._run, args=(evt,))
@@ -250,10 +613,21 @@ class Exchange:
         Send a stop signal to the polling thread
         """
         LOGGER.info('Stopping exchange')
-        with self._req_cond:
-            self._cmd('stop', drain)
-            # wake all threads waiting for an incoming message
-            self._req_cond.notify_all()
+        self._cmd('stop', drain)
+        # wake all threads waiting for an incoming message or room in a queue
+        for cond in self._wake_conds + (self._space_conds or ()):
+            with cond:
+                cond.notify_all()
+        if self._async_dir:
+            try:
+                names = os.listdir(self._async_dir)
+            except FileNotFoundError:
+                # the exchange has already finished draining
+                names = ()
+            for name in names:
+                self._write_async(os.path.join(self._async_dir, name))
+        # check the remaining messages without waiting for the next interval
+        self._stopping.set()
 
     def join(self) -> None:
         """
@@ -266,171 +640,1595 @@ class Exchange:
         Retrieve the status from the polling thread
 
         Returns:
-            A dict in the form {'pending': int, 'processed': int, 'total': int}
-            representing the total numbers of messages handled by the exchange
-        """
-        with self._req_cond:
-            return self._cmd('status')
+            A dict in the form
+            {'pending': int, 'processed': int, 'rejected': int, 'expired': int,
+            'total': int, 'queues': dict} representing the total numbers of messages
+            handled by the exchange. Expired messages were discarded without being
+            delivered because their deadline had passed.
+
+            'queues' holds the measurements for each registered recipient:
+            the current and maximum queue depth, the rate of messages delivered
+            per second over the last complete window of `RATE_WINDOW` seconds
+            (or since the current window started, when the last one is not
+            recent), and summaries of the encoded message sizes in bytes and the
+            time spent queued in seconds. Reading the status does not reset the rate.
+            Message sizes are only recorded when a codec is in use, or for
+            messages passed through a ring buffer. For an identifier shared by
+            consumers, 'consumers' holds the capacity, reported number of messages
+            in progress, number of messages delivered and share of the deliveries
+            for each consumer
+        """
+        return self._cmd('status')
 
     def _cmd(self, *command):
         """
         Execute a command against the exchange, using a process lock to synchronize
         requests and responses.
-        Supported commands are currently `send`, `recv`, `status` and `stop`
+        Supported commands are currently `register`, `check`, `lookup`, `send`,
+        `send_many`, `recv`, `recv_many`, `status`, `drain` and `stop`
         """
         with self._cmd_lock:
             self._cmd_pipe[1].send(command)
             return self._cmd_pipe[1].recv()
 
-    def register(self, to_pid: str) -> bool:
+    def _wake_slot(self, to_pid: str) -> int:
+        """
+        Get the index of the wakeup slot for a given identifier.
+        A stable hash is used so that every process selects the same slot
+
+        Args:
+            to_pid: The identifier of the recipient service
+        """
+        idx = self._wake_index.get(to_pid)
+        if idx is None:
+            idx = zlib.crc32(str(to_pid).encode('utf-8')) % len(self._wake_conds)
+            self._wake_index[to_pid] = idx
+        return idx
+
+    def _wake_cond(self, to_pid: str) -> mp.Condition:
+        """
+        Get the condition used to wake the receivers for a given identifier
+
+        Args:
+            to_pid: The identifier of the recipient service
+        """
+        return self._wake_conds[self._wake_slot(to_pid)]
+
+    def _space_cond(self, to_pid: str) -> mp.Condition:
+        """
+        Get the condition used to wake senders waiting for room in the queue
+        for a given identifier
+
+        Args:
+            to_pid: The identifier of the recipient service
+        """
+        return self._space_conds[self._wake_slot(to_pid)]
+
+    def _notify_space(self, to_pid: str) -> None:
+        """
+        Wake any senders waiting for room in the queue for a given identifier
+        """
+        if self._space_conds:
+            cond = self._space_cond(to_pid)
+            with cond:
+                cond.notify_all()
+
+    def _ring_lookup(self, to_pid: str):
+        """
+        Find the ring buffer assigned to a recipient, caching the result for
+        a short period when no buffer has been assigned
+
+        Returns:
+            a tuple of the ring buffer and its expected generation, or None
+        """
+        found = self._ring_index.get(to_pid)
+        if found and (found[0] is not None or found[2] > time.time()):
+            return found[:2] if found[0] is not None else None
+        found = self._cmd('lookup', to_pid)
+        if found:
+            self._ring_index[to_pid] = (self._rings[found[0]], found[1], None)
+            return self._ring_index[to_pid][:2]
+        self._ring_index[to_pid] = (None, None, time.time() + 1.0)
+        return None
+
+    def _ring_send(self, to_pid: str, wrappers: Sequence[MessageWrapper]) -> int:
+        """
+        Write messages directly to the ring buffer of a recipient. Nothing is written
+        while the exchange holds messages for the recipient, so when a maximum queue
+        length is set it is enforced against the frames pending in the buffer
+
+        Returns:
+            the number of messages written, which may be less than requested if
+            the buffer is full or unavailable
+        """
+        found = self._ring_lookup(to_pid)
+        if not found:
+            return 0
+        ring, generation = found
+        frames = [pickle.dumps(wrapper, pickle.HIGHEST_PROTOCOL) for wrapper in wrappers]
+        result = ring.put(frames, generation, self._max_queue)
+        if result is None:
+            # the buffer has been reassigned
+            self._ring_index.pop(to_pid, None)
+            return 0
+        count, waiters = result
+        if count and waiters:
+            cond = self._wake_cond(to_pid)
+            with cond:
+                cond.notify_all()
+            if self._async_waiters:
+                self._notify_async((to_pid,))
+        return count
+
+    def _ring_recv(self, to_pid: str, limit: int = None, wait: bool = False) -> list:
+        """
+        Read messages from the ring buffer assigned to a recipient, if any
+
+        Args:
+            to_pid: the identifier of the recipient service
+            limit: the maximum number of messages to read
+            wait: register as a waiting receiver when the buffer is empty
+        """
+        found = self._ring_lookup(to_pid)
+        if found:
+            return self._ring_frames(found[0], limit, wait)
+        return []
+
+    def _ring_frames(self, ring: RingBuffer, limit: int = None, wait: bool = False) -> list:
+        """
+        Read messages from a ring buffer, discarding any which have expired
+        """
+        frames = ring.get(limit, wait)
+        if not frames:
+            return []
+        now = time.time()
+        messages = []
+        waits = []
+        for wrapper in map(pickle.loads, frames):
+            if message_expired(wrapper, now):
+                if isinstance(wrapper.message, SharedPayload):
+                    wrapper.message.release()
+            else:
+                messages.append(wrapper)
+                if wrapper.sent:
+                    waits.append(int((now - wrapper.sent) * 1e6))
+        if len(messages) < len(frames):
+            ring.add_expired(len(frames) - len(messages))
+        if waits:
+            ring.record_waits(waits)
+        return messages
+
+    @staticmethod
+    def _ring_allowed(wrapper: MessageWrapper) -> bool:
+        """
+        Check whether a message may be delivered through a ring buffer. A buffer
+        is read in order, so only interactive messages are written to it. Stop,
+        control and bulk messages are queued by the exchange, which serves them
+        in their priority lanes
+        """
+        return wrapper.priority == PRIORITY_INTERACTIVE and \
+            not isinstance(wrapper.message, StopMessage)
+
+    @staticmethod
+    def _journaled(wrapper: MessageWrapper) -> bool:
+        """
+        Check whether a message should be added to the journal. Replies and control
+        messages are only meaningful to the running processes, so only the other
+        requests are kept
+        """
+        return wrapper.ref is None and wrapper.priority != PRIORITY_CONTROL and \
+            not isinstance(wrapper.message, StopMessage)
+
+    @staticmethod
+    def _journal_record(wrapper: MessageWrapper) -> bytes:
+        """
+        Encode a message for the journal, copying any shared memory payload
+        """
+        if isinstance(wrapper.message, SharedPayload):
+            wrapper = wrapper._replace(message=wrapper.message.copy())
+        return pickle.dumps(wrapper, pickle.HIGHEST_PROTOCOL)
+
+    def _ring_unwait(self, to_pid: str) -> None:
+        found = self._ring_lookup(to_pid)
+        if found:
+            found[0].remove_waiter()
+
+    def _encode(self, wrapper: MessageWrapper) -> MessageWrapper:
+        """
+        Assign the default priority and sending time to a message and encode the
+        payload using our codec, if any
+        """
+        wrapper = wrapper._replace(
+            priority=message_priority(wrapper.message)
+            if wrapper.priority is None else wrapper.priority,
+            sent=time.time())
+        if self._codec is None or isinstance(wrapper.message, StopMessage):
+            return wrapper
+        payload = self._codec.encode(wrapper.message)
+        if self._shm_threshold and len(payload) >= self._shm_threshold:
+            payload = SharedPayload.create(payload)
+        return wrapper._replace(message=payload)
+
+    def _decode(self, wrapper: MessageWrapper) -> MessageWrapper:
+        """
+        Decode the payload of a message encoded by :meth:`_encode`
+        """
+        if self._codec is None or isinstance(wrapper.message, StopMessage):
+            return wrapper
+        if isinstance(wrapper.message, SharedPayload):
+            return wrapper._replace(message=wrapper.message.read(self._codec.decode))
+        return wrapper._replace(message=self._codec.decode(wrapper.message))
+
+    def register(self, to_pid: str, consumer: str = None, capacity: int = None) -> bool:
+        """
+        Register a listener on the exchange
+
+        Args:
+            to_pid: The identifier of the recipient service
+            consumer: An optional identifier for this listener, allowing multiple
+                listeners to share the recipient identifier. Messages for a shared
+                identifier are always passed through the exchange processing loop
+            capacity: The number of messages the consumer can process at once
+        """
+        self._ring_index.pop(to_pid, None)
+        return self._cmd('register', to_pid, consumer, capacity)
+
+    def is_registered(self, to_pid: str) -> bool:
+        """
+        Check if a listener is currently running
+        """
+        return self._cmd('check', to_pid)
+
+    def ack(self, to_pid: str, seqs: Sequence[int]) -> None:
+        """
+        Record that a recipient has finished processing messages, so that they are
+        removed from the journal. Messages which are never acknowledged are delivered
+        again after a restart
+
+        Args:
+            to_pid: The identifier of the recipient service
+            seqs: The journal sequence numbers of the messages
+        """
+        self._cmd('ack', to_pid, list(seqs))
+
+    def send(self, to_pid: str, wrapper: MessageWrapper,
+             blocking: bool = True, timeout: float = None) -> bool:
+        """
+        Add a message to the bus, blocking until the processing thread is ready
+
+        Args:
+            to_pid: The identifier for the receiving service
+            wrapper: The message to be added to the queue
+            blocking: Whether to wait for room when the recipient's queue is full
+            timeout: An optional override for the time to wait for room in the queue
+
+        Returns:
+            True if the message is successfully added to the queue
+
+        Raises:
+            ExchangeFullError: if the recipient's queue remained full
+        """
+        # Blocks until we have access to the message queues and command pipe
+        LOGGER.debug('send to %s/%s %s', to_pid, wrapper.ref, wrapper.message)
+        wrapper = self._encode(wrapper)
+        if self._rings and self._ring_allowed(wrapper):
+            if self._ring_send(to_pid, (wrapper,)):
+                return True
+        status = self._send_queued([(to_pid, wrapper)], blocking, timeout)[0]
+        if not status and isinstance(wrapper.message, SharedPayload):
+            wrapper.message.release()
+        if status is None:
+            raise ExchangeFullError('Message queue is full: {}'.format(to_pid))
+        return status
+
+    def send_many(self, messages: Sequence[QueuedMessage],
+                  blocking: bool = True, timeout: float = None) -> list:
+        """
+        Add a batch of messages to the bus using a single exchange command
+
+        Args:
+            messages: The messages to be sent, each with the identifier of its recipient
+            blocking: Whether to wait for room when a recipient's queue is full
+            timeout: An optional override for the time to wait for room in the queue
+
+        Returns:
+            A list of flags indicating whether each message was added to the queue,
+            with None for the messages rejected because a queue remained full
+        """
+        status = [None] * len(messages)
+        messages = [QueuedMessage(queued.to_pid, self._encode(queued.message))
+                    for queued in messages]
+        if self._rings:
+            by_pid = {}
+            for idx, queued in enumerate(messages):
+                if self._ring_allowed(queued.message):
+                    by_pid.setdefault(queued.to_pid, []).append(idx)
+            for to_pid, indices in by_pid.items():
+                count = self._ring_send(to_pid, [messages[idx].message for idx in indices])
+                for idx in indices[:count]:
+                    status[idx] = True
+        remain = [idx for idx, flag in enumerate(status) if flag is None]
+        if remain:
+            LOGGER.debug('send batch of %s messages', len(remain))
+            result = self._send_queued(
+                [tuple(messages[idx]) for idx in remain], blocking, timeout)
+            for idx, flag in zip(remain, result):
+                status[idx] = flag
+                if not flag and isinstance(messages[idx].message.message, SharedPayload):
+                    messages[idx].message.message.release()
+        return status
+
+    async def send_async(self, to_pid: str, wrapper: MessageWrapper,
+                         timeout: float = None) -> bool:
+        """
+        Add a message to the bus from within an event loop, see :meth:`send`
+
+        Raises:
+            ExchangeFullError: if the recipient's queue remained full
+        """
+        status = (await self.send_many_async([QueuedMessage(to_pid, wrapper)], timeout))[0]
+        if status is None:
+            raise ExchangeFullError('Message queue is full: {}'.format(to_pid))
+        return status
+
+    async def send_many_async(self, messages: Sequence[QueuedMessage],
+                              timeout: float = None, executor: Executor = None) -> list:
+        """
+        Add a batch of messages to the bus from within an event loop. The messages
+        are added without waiting, and only those rejected because a queue was full
+        are retried in a worker thread until room is available or the timeout expires.
+        See :meth:`send_many`
+
+        Args:
+            messages: the messages to be added
+            timeout: the time to wait for room in a full queue
+            executor: the executor used for retries, or None for the loop's default
+        """
+        status = self.send_many(messages, False)
+        full = [idx for idx, flag in enumerate(status) if flag is None]
+        if full:
+            retry = await asyncio.get_event_loop().run_in_executor(
+                executor, self.send_many, [messages[idx] for idx in full], True, timeout)
+            for idx, flag in zip(full, retry):
+                status[idx] = flag
+        return status
+
+    def _send_queued(self, messages: list, blocking: bool, timeout: float) -> list:
+        """
+        Add messages to the exchange message queues, retrying any rejected because
+        a queue was full until room is available or the timeout expires
+
+        Args:
+            messages: a list of tuples of the recipient identifier and message
+            blocking: whether to wait for room in a full queue
+            timeout: the time to wait for room, defaulting to the exchange setting
+
+        Returns:
+            A list of flags for each message, with None for full queues
+        """
+        if timeout is None:
+            timeout = self._send_timeout
+        expire = time.time() + timeout if timeout is not None else None
+        status = [None] * len(messages)
+        remain = list(range(len(messages)))
+        space = None
+        while True:
+            try:
+                if space:
+                    # hold the condition so that a receiver cannot free space
+                    # before we are waiting on it
+                    space.acquire()
+                if len(remain) == 1:
+                    result = [self._cmd('send', *messages[remain[0]])]
+                else:
+                    result = self._cmd('send_many', [messages[idx] for idx in remain])
+                full = [idx for idx, flag in zip(remain, result) if flag is None]
+                if space and full and messages[full[0]][0] == space_pid:
+                    wait = expire - time.time() if expire is not None else None
+                    if wait is None or wait > 0:
+                        space.wait(wait)
+            finally:
+                if space:
+                    space.release()
+            # wake the threads waiting for a message to these recipients
+            slots = set()
+            for idx, flag in zip(remain, result):
+                status[idx] = flag
+                if flag:
+                    slots.add(self._wake_slot(messages[idx][0]))
+            for slot in slots:
+                cond = self._wake_conds[slot]
+                with cond:
+                    cond.notify_all()
+            if slots and self._async_waiters:
+                self._notify_async(set(
+                    messages[idx][0] for idx, flag in zip(remain, result) if flag))
+            if not full or not blocking or (expire is not None and time.time() >= expire):
+                break
+            remain = full
+            space_pid = messages[full[0]][0]
+            space = self._space_cond(space_pid)
+        return status
+
+    def recv(self, to_pid: str, blocking: bool = True, timeout=None) -> MessageWrapper:
+        """
+        Receive a message from the bus
+
+        Args:
+            to_pid: The identifier of the recipient service
+            blocking: Whether to sleep this thread until a message is received
+            timeout: An optional timeout before aborting
+
+        Returns:
+            The next message in the queue, or None
+        """
+        received = self.recv_many(to_pid, 1, blocking, timeout)
+        return received[0] if received else None
+
+    def recv_many(self, to_pid: str, limit: int = None,
+                  blocking: bool = True, timeout=None,
+                  consumer: str = None, in_flight: int = 0) -> list:
+        """
+        Receive a batch of messages from the bus. A :class:`StopMessage`, if received,
+        is always the last message in the batch
+
+        Args:
+            to_pid: The identifier of the recipient service
+            limit: The maximum number of messages to return, or None for all pending
+            blocking: Whether to sleep this thread until a message is received
+            timeout: An optional timeout before aborting
+            consumer: The consumer identifier passed to :meth:`register`, if any
+            in_flight: The number of messages the consumer is currently processing
+
+        Returns:
+            The list of messages received, which is empty if none were available
+        """
+        #pylint: disable=broad-except
+        cond = self._wake_cond(to_pid)
+        messages = []
+        try:
+            LOGGER.debug('recv %s', to_pid)
+            if not cond.acquire(blocking):
+                return messages
+            try:
+                messages = self._poll(to_pid, limit, consumer, in_flight)
+                while not messages and (blocking or timeout is not None):
+                    if self._rings:
+                        # recheck the ring buffer, registering as a waiting receiver
+                        messages = self._ring_recv(to_pid, limit, True)
+                        if messages:
+                            break
+                    notified = cond.wait(timeout)
+                    if self._rings:
+                        self._ring_unwait(to_pid)
+                    if notified:
+                        messages = self._poll(to_pid, limit, consumer, in_flight)
+                    if not notified or timeout is not None:
+                        break
+            finally:
+                cond.release()
+        except Exception:
+            LOGGER.exception('Error in recv:')
+            raise
+        if consumer is not None and messages:
+            self._notify_consumers(to_pid)
+        return self._received(to_pid, messages)
+
+    async def recv_async(self, to_pid: str, limit: int = None, timeout=None,
+                         consumer: str = None, in_flight: int = 0,
+                         executor: Executor = None) -> list:
+        """
+        Receive a batch of messages from the bus from within an event loop, without
+        blocking it. The calling task waits on a named pipe which is written by
+        senders when messages are added for this recipient, so no thread is needed.
+        Where named pipes are not supported a worker thread is used instead.
+        See :meth:`recv_many`
+
+        Args:
+            to_pid: The identifier of the recipient service
+            limit: The maximum number of messages to return, or None for all pending
+            timeout: An optional timeout before aborting
+            consumer: The consumer identifier passed to :meth:`register`, if any
+            in_flight: The number of messages the consumer is currently processing
+            executor: The executor used when a worker thread is needed, or None
+                for the loop's default
+
+        Returns:
+            The list of messages received, which is empty if the timeout expired
+        """
+        loop = asyncio.get_event_loop()
+        fd = self._async_reader(to_pid)
+        if fd is None:
+            return await loop.run_in_executor(
+                executor, self.recv_many, to_pid, limit, True, timeout, consumer, in_flight)
+        expire = time.time() + timeout if timeout is not None else None
+        slot = self._wake_slot(to_pid)
+        with self._wake_conds[slot]:
+            self._async_waiters[slot] += 1
+        try:
+            while True:
+                messages = self._poll(to_pid, limit, consumer, in_flight)
+                if messages:
+                    break
+                if self._rings:
+                    # recheck the ring buffer, registering as a waiting receiver
+                    messages = self._ring_recv(to_pid, limit, True)
+                    if messages:
+                        break
+                wait = expire - time.time() if expire is not None else None
+                ready = (wait is None or wait > 0) and \
+                    await self._wait_readable(loop, fd, wait)
+                if self._rings:
+                    self._ring_unwait(to_pid)
+                if not ready:
+                    break
+                try:
+                    while os.read(fd, 4096):
+                        pass
+                except BlockingIOError:
+                    pass
+        finally:
+            with self._wake_conds[slot]:
+                self._async_waiters[slot] -= 1
+        if consumer is not None and messages:
+            self._notify_consumers(to_pid)
+        return self._received(to_pid, messages)
+
+    @staticmethod
+    async def _wait_readable(loop, fd: int, timeout: float = None) -> bool:
+        """
+        Wait for a file descriptor to become readable
+
+        Returns:
+            False if the timeout expired
+        """
+        ready = loop.create_future()
+        def _ready():
+            if not ready.done():
+                ready.set_result(True)
+        loop.add_reader(fd, _ready)
+        try:
+            await asyncio.wait_for(ready, timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            loop.remove_reader(fd)
+
+    def _async_path(self, to_pid: str) -> str:
+        """
+        Get the path of the named pipe used to wake the receivers for a recipient
+        """
+        name = base64.urlsafe_b64encode(str(to_pid).encode('utf-8')).decode('ascii')
+        return os.path.join(self._async_dir, name)
+
+    def _async_reader(self, to_pid: str) -> int:
+        """
+        Open the named pipe used to wake the receivers for a recipient
+
+        Returns:
+            the file descriptor to be monitored, or None if not supported
+        """
+        if not self._async_dir:
+            return None
+        found = self._async_readers.get(to_pid)
+        if found is None:
+            path = self._async_path(to_pid)
+            try:
+                os.mkfifo(path)
+            except FileExistsError:
+                pass
+            reader = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+            # hold the pipe open for writing as well, otherwise it is reported
+            # as readable (at end-of-file) once the last sender has closed it
+            writer = os.open(path, os.O_WRONLY | os.O_NONBLOCK)
+            found = self._async_readers[to_pid] = (reader, writer)
+        return found[0]
+
+    def _notify_async(self, to_pids) -> None:
+        """
+        Wake any receivers waiting in an event loop for messages to the given recipients
+        """
+        for to_pid in to_pids:
+            if not self._async_waiters[self._wake_slot(to_pid)]:
+                continue
+            fd = self._async_writers.get(to_pid)
+            if fd is None:
+                fd = self._write_async(self._async_path(to_pid), True)
+                if fd is not None:
+                    self._async_writers[to_pid] = fd
+            else:
+                try:
+                    os.write(fd, b'\0')
+                except BlockingIOError:
+                    # the pipe is full, so the receiver is already awake
+                    pass
+                except OSError:
+                    del self._async_writers[to_pid]
+                    os.close(fd)
+
+    @staticmethod
+    def _write_async(path: str, keep: bool = False) -> int:
+        """
+        Write to the named pipe used to wake the receivers for a recipient
+
+        Args:
+            path: the path to the named pipe
+            keep: return the open file descriptor instead of closing it
+        """
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_NONBLOCK)
+        except OSError:
+            # no receiver has opened the pipe
+            return None
+        try:
+            os.write(fd, b'\0')
+        except BlockingIOError:
+            pass
+        except OSError:
+            keep = False
+        if not keep:
+            os.close(fd)
+            return None
+        return fd
+
+    def _notify_consumers(self, to_pid: str) -> None:
+        """
+        Wake the other consumers sharing a recipient identifier after receiving
+        a share of its messages, so that any messages left are taken up
+        """
+        cond = self._wake_cond(to_pid)
+        with cond:
+            cond.notify_all()
+        if self._async_waiters:
+            self._notify_async((to_pid,))
+
+    def _received(self, to_pid: str, messages: list) -> list:
+        """
+        Finish receiving a batch of messages, waking any senders waiting for room
+        in the queue and decoding the message payloads
+        """
+        if messages and self._space_conds:
+            self._notify_space(to_pid)
+        if self._codec is not None:
+            messages = [self._decode(wrapper) for wrapper in messages]
+        return messages
+
+    def _poll(self, to_pid: str, limit: int = None,
+              consumer: str = None, in_flight: int = 0) -> list:
+        """
+        Check for waiting messages without blocking, starting with the recipient's
+        ring buffer (if any) and then the exchange message queue
+        """
+        if consumer is not None:
+            # the exchange selects the messages for a consumer of a shared identifier
+            return self._cmd('recv_many', to_pid, limit, None, consumer, in_flight)
+        messages = []
+        if self._rings:
+            found = self._ring_lookup(to_pid)
+            if found:
+                if found[0].queued:
+                    # control messages bypass the ring buffer, so collect them first
+                    messages = self._cmd('recv_many', to_pid, limit, PRIORITY_CONTROL)
+                    if limit and len(messages) >= limit:
+                        return messages
+                messages.extend(self._ring_frames(
+                    found[0], limit - len(messages) if limit else None))
+                if not found[0].queued or (limit and len(messages) >= limit):
+                    # nothing more has been queued for this recipient by the exchange
+                    return messages
+        if limit == 1:
+            message = self._cmd('recv', to_pid)
+            if message is not None:
+                messages.append(message)
+        else:
+            messages.extend(self._cmd(
+                'recv_many', to_pid, limit - len(messages) if limit else None))
+        return messages
+
+    def _drain(self) -> None:
+        # the exchange replies with the time until the next check, or zero once it has ended
+        while True:
+            wait = self._cmd('drain')
+            if not wait:
+                break
+            self._stopping.wait(wait)
+
+    def _run(self, event: Event) -> None:
+        """
+        The message processing loop
+        """
+        drain = Thread(target=self._drain)
+        drain.start()
+        #pylint: disable=broad-except
+        pending = 0
+        processed = {}
+        rejected = 0
+        expired = 0
+        queue = {}
+        rings = {}
+        telemetry = {}
+        consumers = {}
+        free_rings = list(range(len(self._rings))) if self._rings else []
+        journal = MessageJournal(self._journal_path, self._journal_sync) \
+            if self._journal_path else None
+        stop_time = None
+
+        def discard(wrappers):
+            # free the shared memory held by undelivered messages
+            for wrapper in wrappers:
+                if isinstance(wrapper.message, SharedPayload):
+                    wrapper.message.release()
+
+        def release_ring(to_pid):
+            nonlocal expired
+            idx = rings.pop(to_pid, None)
+            if idx is not None:
+                dropped = self._rings[idx].get() if self._shm_threshold else ()
+                discard(pickle.loads(frame) for frame in dropped)
+                ring_expired = self._rings[idx].expired
+                expired += ring_expired
+                delivered = self._rings[idx].reset() - len(dropped) - ring_expired
+                processed[to_pid] = processed.get(to_pid, 0) + delivered
+                free_rings.append(idx)
+
+        def enqueue(to_pid, wrapper):
+            nonlocal pending, rejected
+            if stop_time:
+                LOGGER.debug("rejected message %s %s", to_pid, wrapper)
+                return False
+            if to_pid in queue:
+                if self._max_queue and not isinstance(wrapper.message, StopMessage):
+                    depth = len(queue[to_pid])
+                    if to_pid in rings:
+                        depth += self._rings[rings[to_pid]].pending
+                    if depth >= self._max_queue:
+                        rejected += 1
+                        return None
+                if journal and self._journaled(wrapper):
+                    # a message refused while the recipient is stopping is kept for replay
+                    wrapper = wrapper._replace(
+                        seq=journal.append(to_pid, self._journal_record(wrapper)))
+                if not queue[to_pid].append(wrapper):
+                    # the recipient is stopping
+                    discard((wrapper,))
+                    return True
+                pending += 1
+                depth = len(queue[to_pid])
+                if to_pid in rings:
+                    ring = self._rings[rings[to_pid]]
+                    ring.add_queued(1)
+                    depth += ring.pending
+                stats = telemetry[to_pid]
+                if depth > stats.max_depth:
+                    stats.max_depth = depth
+                payload = wrapper.message
+                if isinstance(payload, bytes):
+                    stats.sizes.add(len(payload))
+                elif isinstance(payload, SharedPayload):
+                    stats.sizes.add(payload.size)
+            else:
+                # the recipient is not registered
+                discard((wrapper,))
+            return True
+
+        def dequeue(to_pid, limit, max_priority=None, consumer=None, in_flight=0):
+            nonlocal pending, expired
+            received = []
+            dropped = 0
+            now = time.time()
+            found = queue.get(to_pid)
+            group = consumers.get(to_pid)
+            if found and group and consumer in group:
+                limit = consumer_limit(group, consumer, in_flight, len(found), limit)
+            else:
+                group = None
+            while found and (limit is None or len(received) < limit):
+                wrapper = found.popleft(max_priority)
+                if wrapper is None:
+                    break
+                if message_expired(wrapper, now):
+                    # the sender is no longer waiting for this message
+                    LOGGER.debug("expired message %s %s", to_pid, wrapper.ident)
+                    if journal and wrapper.seq is not None:
+                        journal.ack(to_pid, wrapper.seq)
+                    discard((wrapper,))
+                    pending -= 1
+                    dropped += 1
+                    continue
+                received.append(wrapper)
+                processed[to_pid] = processed.get(to_pid, 0) + 1
+                pending -= 1
+                if wrapper.sent:
+                    telemetry[to_pid].waits.add(int((now - wrapper.sent) * 1e6))
+                if isinstance(wrapper.message, StopMessage):
+                    if group and len(group) > 1:
+                        # every consumer of a shared identifier receives the stop message
+                        del group[consumer]
+                        found.append(wrapper)
+                        pending += 1
+                        LOGGER.debug("unregistered consumer %s %s", to_pid, consumer)
+                        return received
+                    consumers.pop(to_pid, None)
+                    pending -= len(found)
+                    discard(found)
+                    del queue[to_pid]
+                    del telemetry[to_pid]
+                    release_ring(to_pid)
+                    if journal:
+                        # undelivered messages are replayed when the recipient registers
+                        journal.release(to_pid)
+                    LOGGER.debug("unregistered %s", to_pid)
+                    return received
+            if dropped:
+                expired += dropped
+            if group:
+                group[consumer].in_flight += len(received)
+                group[consumer].delivered += len(received)
+            if (received or dropped) and to_pid in rings:
+                self._rings[rings[to_pid]].add_queued(-(len(received) + dropped))
+            return received
+
+        def ring_status():
+            ring_pending = 0
+            ring_expired = 0
+            ring_processed = processed.copy()
+            for to_pid, idx in rings.items():
+                ring = self._rings[idx]
+                ring_pending += ring.pending
+                ring_expired += ring.expired
+                ring_processed[to_pid] = ring_processed.get(to_pid, 0) + \
+                    ring.delivered - ring.expired
+            return ring_pending, ring_processed, ring_expired
+
+        def queue_status(all_processed):
+            now = time.time()
+            result = {}
+            for to_pid, stats in telemetry.items():
+                depth = len(queue[to_pid])
+                max_depth = stats.max_depth
+                sizes = stats.sizes
+                waits = stats.waits
+                if to_pid in rings:
+                    ring = self._rings[rings[to_pid]]
+                    depth += ring.pending
+                    ring_depth, ring_sizes, ring_waits = ring.telemetry()
+                    max_depth = max(max_depth, ring_depth)
+                    ring_sizes.merge(sizes.counts, sizes.max)
+                    ring_waits.merge(waits.counts, waits.max)
+                    sizes, waits = ring_sizes, ring_waits
+                result[to_pid] = {
+                    'depth': depth,
+                    'max_depth': max_depth,
+                    'rate': stats.rate(all_processed.get(to_pid, 0), now),
+                    'size': sizes.results(),
+                    'wait': waits.results(1e-6),
+                }
+                group = consumers.get(to_pid)
+                if group:
+                    total = sum(load.delivered for load in group.values())
+                    result[to_pid]['consumers'] = {
+                        name: load.results(total) for name, load in group.items()}
+            return result
+
+        event.set()
+        try:
+            while True:
+                command = self._cmd_pipe[0].recv()
+                if command[0] == 'register':
+                    to_pid, consumer, capacity = command[1:]
+                    if to_pid and to_pid not in queue:
+                        queue[to_pid] = PriorityLanes(self._lane_burst)
+                        telemetry[to_pid] = QueueTelemetry(time.time())
+                        if consumer is not None:
+                            consumers[to_pid] = OrderedDict(
+                                ((consumer, ConsumerLoad(capacity)),))
+                        elif free_rings:
+                            rings[to_pid] = free_rings.pop(0)
+                        if journal:
+                            for seq, data in journal.open(to_pid):
+                                queue[to_pid].append(pickle.loads(data)._replace(seq=seq))
+                                pending += 1
+                        self._cmd_pipe[0].send(True)
+                        LOGGER.debug("registered %s", to_pid)
+                    elif consumer is not None and to_pid in consumers and \
+                            consumer not in consumers[to_pid]:
+                        consumers[to_pid][consumer] = ConsumerLoad(capacity)
+                        self._cmd_pipe[0].send(True)
+                        LOGGER.debug("registered consumer %s %s", to_pid, consumer)
+                    else:
+                        self._cmd_pipe[0].send(False)
+                elif command[0] == 'check':
+                    to_pid = command[1]
+                    self._cmd_pipe[0].send(to_pid and to_pid in queue)
+                elif command[0] == 'lookup':
+                    idx = rings.get(command[1])
+                    self._cmd_pipe[0].send(
+                        (idx, self._rings[idx].generation) if idx is not None else None)
+                elif command[0] == 'send':
+                    self._cmd_pipe[0].send(enqueue(command[1], command[2]))
+                    if journal:
+                        journal.sync()
+                elif command[0] == 'send_many':
+                    self._cmd_pipe[0].send([
+                        enqueue(to_pid, wrapper) for (to_pid, wrapper) in command[1]])
+                    if journal:
+                        journal.sync()
+                elif command[0] == 'recv':
+                    received = dequeue(command[1], 1)
+                    self._cmd_pipe[0].send(received[0] if received else None)
+                elif command[0] == 'recv_many':
+                    self._cmd_pipe[0].send(dequeue(*command[1:]))
+                elif command[0] == 'ack':
+                    if journal:
+                        journal.ack_many(command[1], command[2])
+                        journal.sync()
+                    self._cmd_pipe[0].send(True)
+                elif command[0] == 'status':
+                    ring_pending, all_processed, ring_expired = ring_status()
+                    self._cmd_pipe[0].send({
+                        'pending': pending + ring_pending,
+                        'processed': all_processed,
+                        'rejected': rejected,
+                        'expired': expired + ring_expired,
+                        'total': sum(all_processed.values()),
+                        'queues': queue_status(all_processed)})
+                elif command[0] == 'drain':
+                    if journal:
+                        journal.sync()
+                    # measure delivery rates, including messages read from the ring buffers
+                    now = time.time()
+                    all_processed = ring_status()[1]
+                    for to_pid, stats in telemetry.items():
+                        stats.sample(all_processed.get(to_pid, 0), now)
+                    # clean up expired messages ...
+                    if stop_time:
+                        waiting = pending + ring_status()[0]
+                        if not waiting or time.time() - stop_time >= self._drain_timeout:
+                            if waiting:
+                                LOGGER.debug("terminating with %s messages pending", waiting)
+                                for to_pid in list(queue):
+                                    discard(queue[to_pid])
+                                    release_ring(to_pid)
+                            self._cmd_pipe[0].send(0)
+                            break
+                        # check often while stopping, to end soon after the queues are empty
+                        self._cmd_pipe[0].send(0.05)
+                    else:
+                        self._cmd_pipe[0].send(1.0)
+                elif command[0] == 'stop':
+                    for to_pid in queue:
+                        LOGGER.debug("ordering %s to stop", to_pid)
+                        if queue[to_pid].append(MessageWrapper(None, None, StopMessage())):
+                            pending += 1
+                            if to_pid in rings:
+                                self._rings[rings[to_pid]].add_queued(1)
+                    stop_time = time.time()
+                    self._cmd_pipe[0].send(True)
+                else:
+                    raise ValueError('Unrecognized command: {}'.format(command[0]))
+        except Exception:
+            LOGGER.exception('Error in exchange:')
+        finally:
+            if journal:
+                journal.close()
+            if self._async_dir:
+                shutil.rmtree(self._async_dir, ignore_errors=True)
+
+
+class ShardedExchange:
+    """
+    A message exchange composed of multiple :class:`Exchange` instances, each
+    running its own message processing loop. Recipient identifiers are assigned
+    to a shard by consistent hashing, so that every process routes messages for
+    a recipient to the same shard. It presents the same interface as a single
+    :class:`Exchange`
+    """
+
+    def __init__(self, shards: int = 2, vnodes: int = 64, **params):
+        """
+        Initialize the exchange shards. This must be performed before any processes
+        sharing the exchange are forked
+
+        Args:
+            shards: the number of exchange instances to run
+            vnodes: the number of points on the hash ring for each shard
+            params: additional arguments passed to each :class:`Exchange`
+        """
+        self._shards = tuple(Exchange(**params) for _ in range(max(shards, 1)))
+        points = sorted(
+            (zlib.crc32('{}-{}'.format(idx, vnode).encode('utf-8')), idx)
+            for idx in range(len(self._shards)) for vnode in range(vnodes))
+        self._ring_keys = [point[0] for point in points]
+        self._ring_shards = [point[1] for point in points]
+        self._shard_index = {}
+
+    @property
+    def shards(self) -> tuple:
+        """
+        Accessor for the :class:`Exchange` shards
+        """
+        return self._shards
+
+    @property
+    def max_queue(self) -> int:
+        """
+        Accessor for the maximum number of messages waiting for each recipient
+        """
+        return self._shards[0].max_queue
+
+    @property
+    def journaled(self) -> bool:
+        """
+        Accessor for whether queued requests are recorded in a journal
+        """
+        return self._shards[0].journaled
+
+    def start(self, process: bool = True, transport: str = TRANSPORT_PIPE, **params) -> None:
+        """
+        Start each exchange shard. Running the shards in separate processes
+        allows message processing to use multiple cores
+
+        Args:
+            process: whether to run the message processing loops in new processes
+            transport: the message transport used by each shard
+            params: additional arguments passed to :meth:`Exchange.start`
+        """
+        for shard in self._shards:
+            shard.start(process, transport, **params)
+
+    def stop(self, drain: bool = True) -> None:
+        """
+        Send a stop signal to each exchange shard
+        """
+        for shard in self._shards:
+            shard.stop(drain)
+
+    def join(self) -> None:
+        """
+        Wait for all exchange shards to finish running
+        """
+        for shard in self._shards:
+            shard.join()
+
+    def status(self) -> dict:
+        """
+        Retrieve the combined status of the exchange shards
+
+        Returns:
+            A dict in the same form as :meth:`Exchange.status`, with the addition
+            of 'shards', a list of the status of each shard
+        """
+        shards = [shard.status() for shard in self._shards]
+        processed = {}
+        for status in shards:
+            for to_pid, count in status['processed'].items():
+                processed[to_pid] = processed.get(to_pid, 0) + count
+        return {
+            'pending': sum(status['pending'] for status in shards),
+            'processed': processed,
+            'rejected': sum(status['rejected'] for status in shards),
+            'expired': sum(status['expired'] for status in shards),
+            'queues': {to_pid: found for status in shards
+                       for to_pid, found in status['queues'].items()},
+            'total': sum(status['total'] for status in shards),
+            'shards': shards,
+        }
+
+    def shard_for(self, to_pid: str) -> Exchange:
+        """
+        Get the exchange shard responsible for a recipient
+
+        Args:
+            to_pid: The identifier of the recipient service
+        """
+        idx = self._shard_index.get(to_pid)
+        if idx is None:
+            pos = bisect(self._ring_keys, zlib.crc32(str(to_pid).encode('utf-8')))
+            idx = self._ring_shards[pos % len(self._ring_shards)]
+            self._shard_index[to_pid] = idx
+        return self._shards[idx]
+
+    def register(self, to_pid: str, consumer: str = None, capacity: int = None) -> bool:
+        """
+        Register a listener on the exchange, see :meth:`Exchange.register`
+        """
+        return self.shard_for(to_pid).register(to_pid, consumer, capacity)
+
+    def is_registered(self, to_pid: str) -> bool:
+        """
+        Check if a listener is currently running
+        """
+        return self.shard_for(to_pid).is_registered(to_pid)
+
+    def ack(self, to_pid: str, seqs: Sequence[int]) -> None:
+        """
+        Record that a recipient has finished processing messages, see :meth:`Exchange.ack`
+        """
+        self.shard_for(to_pid).ack(to_pid, seqs)
+
+    def send(self, to_pid: str, wrapper: MessageWrapper,
+             blocking: bool = True, timeout: float = None) -> bool:
+        """
+        Add a message to the bus, see :meth:`Exchange.send`
+        """
+        return self.shard_for(to_pid).send(to_pid, wrapper, blocking, timeout)
+
+    def send_many(self, messages: Sequence[QueuedMessage],
+                  blocking: bool = True, timeout: float = None) -> list:
+        """
+        Add a batch of messages to the bus, using one command for each shard
+        involved. See :meth:`Exchange.send_many`
+        """
+        by_shard = {}
+        for idx, queued in enumerate(messages):
+            by_shard.setdefault(id(self.shard_for(queued.to_pid)), []).append(idx)
+        status = [None] * len(messages)
+        for indices in by_shard.values():
+            shard = self.shard_for(messages[indices[0]].to_pid)
+            result = shard.send_many([messages[idx] for idx in indices], blocking, timeout)
+            for idx, flag in zip(indices, result):
+                status[idx] = flag
+        return status
+
+    async def send_async(self, to_pid: str, wrapper: MessageWrapper,
+                         timeout: float = None) -> bool:
+        """
+        Add a message to the bus from within an event loop, see :meth:`Exchange.send_async`
+        """
+        return await self.shard_for(to_pid).send_async(to_pid, wrapper, timeout)
+
+    async def send_many_async(self, messages: Sequence[QueuedMessage],
+                              timeout: float = None, executor: Executor = None) -> list:
+        """
+        Add a batch of messages to the bus from within an event loop, using one
+        command for each shard involved. See :meth:`Exchange.send_many_async`
+        """
+        by_shard = {}
+        for idx, queued in enumerate(messages):
+            by_shard.setdefault(id(self.shard_for(queued.to_pid)), []).append(idx)
+        status = [None] * len(messages)
+        for indices in by_shard.values():
+            shard = self.shard_for(messages[indices[0]].to_pid)
+            result = await shard.send_many_async(
+                [messages[idx] for idx in indices], timeout, executor)
+            for idx, flag in zip(indices, result):
+                status[idx] = flag
+        return status
+
+    def recv(self, to_pid: str, blocking: bool = True, timeout=None) -> MessageWrapper:
+        """
+        Receive a message from the bus, see :meth:`Exchange.recv`
+        """
+        return self.shard_for(to_pid).recv(to_pid, blocking, timeout)
+
+    def recv_many(self, to_pid: str, limit: int = None,
+                  blocking: bool = True, timeout=None,
+                  consumer: str = None, in_flight: int = 0) -> list:
+        """
+        Receive a batch of messages from the bus, see :meth:`Exchange.recv_many`
+        """
+        return self.shard_for(to_pid).recv_many(
+            to_pid, limit, blocking, timeout, consumer, in_flight)
+
+    async def recv_async(self, to_pid: str, limit: int = None, timeout=None,
+                         consumer: str = None, in_flight: int = 0,
+                         executor: Executor = None) -> list:
+        """
+        Receive a batch of messages from the bus from within an event loop,
+        see :meth:`Exchange.recv_async`
+        """
+        return await self.shard_for(to_pid).recv_async(
+            to_pid, limit, timeout, consumer, in_flight, executor)
+
+
+class LocalExchange:
+    """
+    An in-memory message exchange for deployments running in a single process.
+    Messages are passed between threads without being serialized, using a
+    thread lock and a condition for each recipient in place of the pipe and
+    process-shared primitives of :class:`Exchange`. It presents the same
+    interface, but it cannot be used from a process forked after it was created
+    """
+
+    def __init__(self, max_queue: int = None, send_timeout: float = None,
+                 lane_burst: int = 8, drain_timeout: float = 5.0):
+        """
+        Initialize the exchange
+
+        Args:
+            max_queue: the maximum number of messages waiting for each recipient,
+                or None for no limit
+            send_timeout: the default time to wait for room in a full queue before
+                a send is rejected, or None to wait indefinitely
+            lane_burst: the number of higher priority messages delivered ahead of a
+                waiting lower priority message before it is delivered
+            drain_timeout: the time in seconds :meth:`join` waits for the messages
+                left when the exchange is stopped
+        """
+        self._owner = os.getpid()
+        self._max_queue = max_queue or None
+        self._send_timeout = send_timeout
+        self._lane_burst = lane_burst
+        self._drain_timeout = drain_timeout
+        self._lock = Lock()
+        self._stopped = Condition(self._lock)
+        self._queue = {}
+        self._telemetry = {}
+        self._consumers = {}
+        self._wake_conds = {}
+        self._space_conds = {}
+        self._async_waiters = {}
+        self._pending = 0
+        self._processed = {}
+        self._rejected = 0
+        self._expired = 0
+        self._stop_time = None
+
+    @property
+    def max_queue(self) -> int:
+        """
+        Accessor for the maximum number of messages waiting for each recipient
+        """
+        return self._max_queue
+
+    def _check_process(self) -> None:
+        if os.getpid() != self._owner:
+            raise RuntimeError(
+                'LocalExchange cannot be shared with a forked process, use Exchange instead')
+
+    def _wake_cond(self, to_pid: str) -> Condition:
+        cond = self._wake_conds.get(to_pid)
+        if cond is None:
+            cond = self._wake_conds[to_pid] = Condition(self._lock)
+        return cond
+
+    def _space_cond(self, to_pid: str) -> Condition:
+        cond = self._space_conds.get(to_pid)
+        if cond is None:
+            cond = self._space_conds[to_pid] = Condition(self._lock)
+        return cond
+
+    def _notify(self, to_pid: str) -> None:
+        """
+        Wake the receivers waiting for messages to a recipient. The lock must be held
+        """
+        cond = self._wake_conds.get(to_pid)
+        if cond:
+            cond.notify_all()
+        waiters = self._async_waiters.pop(to_pid, None)
+        if waiters:
+            for loop, waiter in waiters:
+                loop.call_soon_threadsafe(self._wake_waiter, waiter)
+
+    @staticmethod
+    def _wake_waiter(waiter: asyncio.Future) -> None:
+        if not waiter.done():
+            waiter.set_result(True)
+
+    def start(self, _process: bool = False, transport: str = TRANSPORT_PIPE, **_params) -> None:
+        """
+        Start accepting messages. Messages are always passed in memory, so the
+        transport settings do not apply
+        """
+        self._check_process()
+        if transport != TRANSPORT_PIPE:
+            LOGGER.warning('Transport is not used by the local exchange: %s', transport)
+        LOGGER.info('Started local exchange')
+
+    def stop(self, drain: bool = True) -> None:
+        """
+        Send a stop message to each recipient and stop accepting new messages
+        """
+        LOGGER.info('Stopping exchange')
+        with self._lock:
+            for to_pid, found in self._queue.items():
+                LOGGER.debug("ordering %s to stop", to_pid)
+                if found.append(MessageWrapper(None, None, StopMessage())):
+                    self._pending += 1
+                self._notify(to_pid)
+            for cond in self._space_conds.values():
+                cond.notify_all()
+            self._stop_time = time.time()
+
+    def join(self) -> None:
+        """
+        Wait for the recipients to receive the messages left after stopping
+        """
+        with self._lock:
+            expire = self._stop_time + self._drain_timeout
+            while self._pending and time.time() < expire:
+                self._stopped.wait(max(expire - time.time(), 0))
+            if self._pending:
+                LOGGER.debug("terminating with %s messages pending", self._pending)
+
+    def status(self) -> dict:
+        """
+        Retrieve the status of the exchange, see :meth:`Exchange.status`
+        """
+        with self._lock:
+            now = time.time()
+            queues = {}
+            for to_pid, stats in self._telemetry.items():
+                queues[to_pid] = {
+                    'depth': len(self._queue[to_pid]),
+                    'max_depth': stats.max_depth,
+                    'rate': stats.rate(self._processed.get(to_pid, 0), now),
+                    'size': stats.sizes.results(),
+                    'wait': stats.waits.results(1e-6),
+                }
+                group = self._consumers.get(to_pid)
+                if group:
+                    total = sum(load.delivered for load in group.values())
+                    queues[to_pid]['consumers'] = {
+                        name: load.results(total) for name, load in group.items()}
+            return {
+                'pending': self._pending,
+                'processed': self._processed.copy(),
+                'rejected': self._rejected,
+                'expired': self._expired,
+                'total': sum(self._processed.values()),
+                'queues': queues,
+            }
+
+    def register(self, to_pid: str, consumer: str = None, capacity: int = None) -> bool:
+        """
+        Register a listener on the exchange, see :meth:`Exchange.register`
+        """
+        self._check_process()
+        with self._lock:
+            if to_pid and to_pid not in self._queue:
+                self._queue[to_pid] = PriorityLanes(self._lane_burst)
+                self._telemetry[to_pid] = QueueTelemetry(time.time())
+                if consumer is not None:
+                    self._consumers[to_pid] = OrderedDict(((consumer, ConsumerLoad(capacity)),))
+                LOGGER.debug("registered %s", to_pid)
+                return True
+            group = self._consumers.get(to_pid)
+            if consumer is not None and group is not None and consumer not in group:
+                group[consumer] = ConsumerLoad(capacity)
+                LOGGER.debug("registered consumer %s %s", to_pid, consumer)
+                return True
+            return False
+
+    def is_registered(self, to_pid: str) -> bool:
+        """
+        Check if a listener is currently running
+        """
+        with self._lock:
+            return bool(to_pid) and to_pid in self._queue
+
+    def ack(self, to_pid: str, seqs: Sequence[int]) -> None:
+        """
+        Record that a recipient has finished processing messages. No journal is
+        kept by the local exchange, so there is nothing to record
+        """
+        pass
+
+    def _enqueue(self, to_pid: str, wrapper: MessageWrapper) -> bool:
+        """
+        Add a message to a recipient's queue. The lock must be held
+
+        Returns:
+            True if the message was added, or was discarded because the recipient
+            is not registered or is stopping, False if the exchange is stopping,
+            or None if the recipient's queue is full
+        """
+        if self._stop_time:
+            LOGGER.debug("rejected message %s %s", to_pid, wrapper)
+            return False
+        found = self._queue.get(to_pid)
+        if found is None:
+            return True
+        if self._max_queue and len(found) >= self._max_queue and \
+                not isinstance(wrapper.message, StopMessage):
+            self._rejected += 1
+            return None
+        if not found.append(wrapper):
+            # the recipient is stopping
+            return True
+        self._pending += 1
+        stats = self._telemetry[to_pid]
+        if len(found) > stats.max_depth:
+            stats.max_depth = len(found)
+        self._notify(to_pid)
+        return True
+
+    def _send_locked(self, messages: list, blocking: bool, timeout: float) -> list:
+        """
+        Add messages to the recipients' queues, waiting for room in a full queue
+        until the timeout expires. The lock must be held
+        """
+        if timeout is None:
+            timeout = self._send_timeout
+        expire = time.time() + timeout if timeout is not None else None
+        now = time.time()
+        status = []
+        for to_pid, wrapper in messages:
+            wrapper = wrapper._replace(
+                priority=message_priority(wrapper.message)
+                if wrapper.priority is None else wrapper.priority,
+                sent=now)
+            while True:
+                result = self._enqueue(to_pid, wrapper)
+                if result is not None or not blocking:
+                    break
+                wait = expire - time.time() if expire is not None else None
+                if wait is not None and wait <= 0:
+                    break
+                self._space_cond(to_pid).wait(wait)
+            status.append(result)
+        return status
+
+    def send(self, to_pid: str, wrapper: MessageWrapper,
+             blocking: bool = True, timeout: float = None) -> bool:
         """
-        Register a listener on the exchange
+        Add a message to the bus, see :meth:`Exchange.send`
+
+        Raises:
+            ExchangeFullError: if the recipient's queue remained full
         """
-        return self._cmd('register', to_pid)
+        self._check_process()
+        LOGGER.debug('send to %s/%s %s', to_pid, wrapper.ref, wrapper.message)
+        with self._lock:
+            status = self._send_locked([(to_pid, wrapper)], blocking, timeout)[0]
+        if status is None:
+            raise ExchangeFullError('Message queue is full: {}'.format(to_pid))
+        return status
 
-    def is_registered(self, to_pid: str) -> bool:
+    def send_many(self, messages: Sequence[QueuedMessage],
+                  blocking: bool = True, timeout: float = None) -> list:
         """
-        Check if a listener is currently running
+        Add a batch of messages to the bus, see :meth:`Exchange.send_many`
         """
-        return self._cmd('check', to_pid)
+        self._check_process()
+        with self._lock:
+            return self._send_locked(messages, blocking, timeout)
 
-    def send(self, to_pid: str, wrapper: MessageWrapper) -> bool:
+    async def send_async(self, to_pid: str, wrapper: MessageWrapper,
+                         timeout: float = None) -> bool:
         """
-        Add a message to the bus, blocking until the processing thread is ready
-
-        Args:
-            to_pid: The identifier for the receiving service
-            wrapper: The message to be added to the queue
-
-        Returns:
-            True if the message is successfully added to the queue
+        Add a message to the bus from within an event loop, see :meth:`Exchange.send_async`
         """
-        # Blocks until we have access to the message queues and command pipe
-        # FIXME add a maximum buffer size for the message queues and allow blocking
-        # until there is room in the buffer (optional blocking=True argument)
-        with self._req_cond:
-            LOGGER.debug('send to %s/%s %s', to_pid, wrapper.ref, wrapper.message)
-            status = self._cmd('send', to_pid, wrapper)
-            # wake all threads waiting for an incoming message
-            self._req_cond.notify_all()
+        status = (await self.send_many_async([QueuedMessage(to_pid, wrapper)], timeout))[0]
+        if status is None:
+            raise ExchangeFullError('Message queue is full: {}'.format(to_pid))
         return status
 
-    def recv(self, to_pid: str, blocking: bool = True, timeout=None) -> MessageWrapper:
+    async def send_many_async(self, messages: Sequence[QueuedMessage],
+                              timeout: float = None, executor: Executor = None) -> list:
         """
-        Receive a message from the bus
-
-        Args:
-            to_pid: The identifier of the recipient service
-            blocking: Whether to sleep this thread until a message is received
-            timeout: An optional timeout before aborting
+        Add a batch of messages to the bus from within an event loop. Only the
+        messages rejected because a queue was full are retried in a worker thread,
+        see :meth:`Exchange.send_many_async`
+        """
+        status = self.send_many(messages, False)
+        full = [idx for idx, flag in enumerate(status) if flag is None]
+        if full:
+            retry = await asyncio.get_event_loop().run_in_executor(
+                executor, self.send_many, [messages[idx] for idx in full], True, timeout)
+            for idx, flag in zip(full, retry):
+                status[idx] = flag
+        return status
 
-        Returns:
-            The next message in the queue, or None
+    def _dequeue(self, to_pid: str, limit: int = None,
+                 consumer: str = None, in_flight: int = 0) -> list:
         """
-        #pylint: disable=broad-except
-        try:
-            LOGGER.debug('recv %s', to_pid)
-            locked = self._req_cond.acquire(blocking)
-            message = None
-            if locked:
-                message = self._cmd('recv', to_pid)
-                while message is None and (blocking or timeout is not None):
-                    #LOGGER.warning("Locked (%r), wait", locked)
-                    locked = self._req_cond.wait(timeout)
-                    if locked:
-                        message = self._cmd('recv', to_pid)
-                    if not locked or timeout is not None:
-                        break
-                if locked:
-                    self._req_cond.release()
-        except Exception:
-            LOGGER.exception('Error in recv:')
-            raise
-        return message
+        Remove the messages to be delivered to a recipient. The lock must be held
+        """
+        found = self._queue.get(to_pid)
+        if not found:
+            return []
+        received = []
+        dropped = 0
+        now = time.time()
+        group = self._consumers.get(to_pid)
+        if group and consumer in group:
+            limit = consumer_limit(group, consumer, in_flight, len(found), limit)
+        else:
+            group = None
+        shared = group is not None
+        while limit is None or len(received) < limit:
+            wrapper = found.popleft()
+            if wrapper is None:
+                break
+            self._pending -= 1
+            if message_expired(wrapper, now):
+                # the sender is no longer waiting for this message
+                LOGGER.debug("expired message %s %s", to_pid, wrapper.ident)
+                dropped += 1
+                continue
+            received.append(wrapper)
+            if wrapper.sent:
+                self._telemetry[to_pid].waits.add(int((now - wrapper.sent) * 1e6))
+            if isinstance(wrapper.message, StopMessage):
+                if group and len(group) > 1:
+                    # every consumer of a shared identifier receives the stop message
+                    del group[consumer]
+                    found.append(wrapper)
+                    self._pending += 1
+                    LOGGER.debug("unregistered consumer %s %s", to_pid, consumer)
+                    group = None
+                    break
+                self._consumers.pop(to_pid, None)
+                self._pending -= len(found)
+                del self._queue[to_pid]
+                del self._telemetry[to_pid]
+                LOGGER.debug("unregistered %s", to_pid)
+                group = None
+                break
+        self._processed[to_pid] = self._processed.get(to_pid, 0) + len(received)
+        if to_pid in self._telemetry:
+            self._telemetry[to_pid].sample(self._processed[to_pid], now)
+        self._expired += dropped
+        if group:
+            group[consumer].in_flight += len(received)
+            group[consumer].delivered += len(received)
+        if received or dropped:
+            if to_pid in self._space_conds:
+                self._space_conds[to_pid].notify_all()
+            if self._stop_time and not self._pending:
+                self._stopped.notify_all()
+        if shared and received and to_pid in self._queue:
+            # let the other consumers take up any messages left
+            self._notify(to_pid)
+        return received
 
-    def _drain(self) -> None:
-        while self._cmd('drain'):
-            time.sleep(1)
+    def recv(self, to_pid: str, blocking: bool = True, timeout=None) -> MessageWrapper:
+        """
+        Receive a message from the bus, see :meth:`Exchange.recv`
+        """
+        received = self.recv_many(to_pid, 1, blocking, timeout)
+        return received[0] if received else None
 
-    def _run(self, event: Event) -> None:
+    def recv_many(self, to_pid: str, limit: int = None,
+                  blocking: bool = True, timeout=None,
+                  consumer: str = None, in_flight: int = 0) -> list:
         """
-        The message processing loop
+        Receive a batch of messages from the bus, see :meth:`Exchange.recv_many`
         """
-        drain = Thread(target=self._drain)
-        drain.start()
-        #pylint: disable=broad-except
-        pending = 0
-        processed = {}
-        queue = {}
-        stop_time = None
-        event.set()
-        try:
+        self._check_process()
+        LOGGER.debug('recv %s', to_pid)
+        expire = time.time() + timeout if timeout is not None else None
+        with self._lock:
             while True:
-                command = self._cmd_pipe[0].recv()
-                if command[0] == 'register':
-                    to_pid = command[1]
-                    if to_pid and to_pid not in queue:
-                        queue[to_pid] = deque()
-                        self._cmd_pipe[0].send(True)
-                        LOGGER.debug("registered %s", to_pid)
-                    else:
-                        self._cmd_pipe[0].send(False)
-                elif command[0] == 'check':
-                    to_pid = command[1]
-                    self._cmd_pipe[0].send(to_pid and to_pid in queue)
-                elif command[0] == 'send':
-                    if stop_time:
-                        LOGGER.debug("rejected message %s %s", command[1], command[2])
-                        self._cmd_pipe[0].send(False)
-                    else:
-                        to_pid = command[1]
-                        if to_pid in queue:
-                            queue[to_pid].append(command[2])
-                            pending += 1
-                        else:
-                            self._cmd_pipe[0].send(True)
-                        self._cmd_pipe[0].send(True)
-                elif command[0] == 'recv':
-                    to_pid = command[1]
-                    wrapper = None
-                    if to_pid in queue:
-                        try:
-                            wrapper = queue[to_pid].popleft()
-                            processed[to_pid] = processed.get(to_pid, 0) + 1
-                            pending -= 1
-                        except IndexError:
-                            pass
-                        if wrapper and isinstance(wrapper.message, StopMessage):
-                            pending -= len(queue[to_pid])
-                            del queue[to_pid]
-                            LOGGER.debug("unregistered %s", to_pid)
-                    self._cmd_pipe[0].send(wrapper)
-                elif command[0] == 'status':
-                    total = sum(processed.values())
-                    self._cmd_pipe[0].send({
-                        'pending': pending,
-                        'processed': processed,
-                        'total': total})
-                elif command[0] == 'drain':
-                    # clean up expired messages ...
-                    if stop_time:
-                        if not pending or time.time() - stop_time >= 5:
-                            if pending:
-                                LOGGER.debug("terminating with %s messages pending", pending)
-                            self._cmd_pipe[0].send(False)
-                            break
-                    self._cmd_pipe[0].send(True)
-                elif command[0] == 'stop':
-                    for to_pid in queue:
-                        LOGGER.debug("ordering %s to stop", to_pid)
-                        queue[to_pid].append(MessageWrapper(None, None, StopMessage()))
-                        pending += 1
-                    stop_time = time.time()
-                    self._cmd_pipe[0].send(True)
-                else:
-                    raise ValueError('Unrecognized command: {}'.format(command[0]))
-        except Exception:
-            LOGGER.exception('Error in exchange:')
+                messages = self._dequeue(to_pid, limit, consumer, in_flight)
+                if messages or not (blocking or timeout is not None):
+                    return messages
+                wait = expire - time.time() if expire is not None else None
+                if wait is not None and wait <= 0:
+                    return messages
+                self._wake_cond(to_pid).wait(wait)
+
+    async def recv_async(self, to_pid: str, limit: int = None, timeout=None,
+                         consumer: str = None, in_flight: int = 0,
+                         executor: Executor = None) -> list:
+        """
+        Receive a batch of messages from the bus from within an event loop. The
+        calling task is woken directly by senders, so no thread is needed.
+        See :meth:`Exchange.recv_async`
+        """
+        self._check_process()
+        loop = asyncio.get_event_loop()
+        expire = time.time() + timeout if timeout is not None else None
+        while True:
+            with self._lock:
+                messages = self._dequeue(to_pid, limit, consumer, in_flight)
+                if messages:
+                    return messages
+                waiter = loop.create_future()
+                self._async_waiters.setdefault(to_pid, []).append((loop, waiter))
+            wait = expire - time.time() if expire is not None else None
+            try:
+                if wait is not None and wait <= 0:
+                    raise asyncio.TimeoutError()
+                await asyncio.wait_for(waiter, wait)
+            except asyncio.TimeoutError:
+                with self._lock:
+                    waiters = self._async_waiters.get(to_pid)
+                    if waiters and (loop, waiter) in waiters:
+                        waiters.remove((loop, waiter))
+                return []
 
 
 class MessageTarget:
@@ -483,7 +2281,8 @@ class MessageTarget:
             ident: str,
             message: ExchangeMessage,
             ref: str = None,
-            from_pid: str = None) -> bool:
+            from_pid: str = None,
+            priority: int = None) -> bool:
         """
         Send a message to the recipient service
 
@@ -492,6 +2291,7 @@ class MessageTarget:
             message: The message being sent
             ref: An optional identifier for the message being responded to
             from_pid: An optional override for the sender identifier
+            priority: An optional override for the priority class of the message
 
         Returns:
             True if the message was successfully added to the queue
@@ -500,20 +2300,22 @@ class MessageTarget:
             from_pid if from_pid is not None else self._from_pid,
             ident,
             message,
-            ref))
+            ref,
+            priority))
 
     def send_noreply(
             self,
             message: ExchangeMessage,
             ref: str = None,
-            from_pid: str = None) -> bool:
+            from_pid: str = None,
+            priority: int = None) -> bool:
         """
         Send a message with no reply expected
 
         Returns:
             True if the message was successfully added to the queue
         """
-        return self.send(None, message, ref, from_pid)
+        return self.send(None, message, ref, from_pid, priority)
 
 
 class MessageProcessor:
@@ -523,10 +2325,27 @@ class MessageProcessor:
     and send responses.
     """
 
-    def __init__(self, pid: str, exchange: Exchange):
+    def __init__(self, pid: str, exchange: Exchange, recv_batch: int = 32,
+                 capacity: int = None):
+        """
+        Initialize the message processor
+
+        Args:
+            pid: the identifier of this processor on the exchange
+            exchange: the shared message exchange
+            recv_batch: the maximum number of messages to receive at once
+            capacity: the number of messages this processor can have in progress.
+                When given, the processor registers as one of the consumers which
+                may share its identifier, and receives messages according to its load
+        """
         self._pid = pid
         self._exchange = exchange
         self._poll_thread = None
+        self._recv_batch = recv_batch
+        self._capacity = capacity
+        self._consumer = None
+        self._in_flight = 0
+        self._load_cond = Condition()
 
     @property
     def pid(self) -> str:
@@ -559,7 +2378,9 @@ class MessageProcessor:
         """
         Perform any additional initializion in polling thread
         """
-        return self._exchange.register(self._pid)
+        if self._capacity:
+            self._consumer = '{}:{}:{}'.format(socket.gethostname(), os.getpid(), id(self))
+        return self._exchange.register(self._pid, self._consumer, self._capacity)
 
     def join(self) -> None:
         """
@@ -610,11 +2431,61 @@ class MessageProcessor:
 
     def _poll_message(self) -> bool:
         """
-        Wait for a message from the exchange
+        Wait for a batch of messages from the exchange and process each in turn.
+        Journaled messages are acknowledged once :meth:`_process_message` returns
+        """
+        if self._capacity:
+            with self._load_cond:
+                while self._in_flight >= self._capacity:
+                    self._load_cond.wait()
+        # blocks until at least one message is available
+        messages = self._exchange.recv_many(
+            self._pid, self._recv_limit(),
+            consumer=self._consumer, in_flight=self._in_flight)
+        done = []
+        try:
+            for received in messages:
+                if not self._dispatch_message(received):
+                    return False
+                if received.seq is not None:
+                    done.append(received.seq)
+        finally:
+            if done:
+                self._exchange.ack(self._pid, done)
+        return True
+
+    def _recv_limit(self) -> int:
+        """
+        Get the number of messages to request from the exchange, limited by our
+        unused capacity
+        """
+        if self._capacity:
+            return max(min(self._recv_batch, self._capacity - self._in_flight), 1)
+        return self._recv_batch
+
+    def _message_started(self) -> None:
+        """
+        Record a message which continues processing after :meth:`_process_message`
+        returns, counting towards our capacity
+        """
+        with self._load_cond:
+            self._in_flight += 1
+
+    def _message_finished(self) -> None:
+        """
+        Record the completion of a message passed to :meth:`_message_started`
+        """
+        with self._load_cond:
+            self._in_flight -= 1
+            self._load_cond.notify()
+
+    def _dispatch_message(self, received: MessageWrapper) -> bool:
+        """
+        Process a single message received from the exchange
+
+        Returns: `False` if the polling thread should terminate
         """
         #pylint: disable=broad-except
-        # blocks until a message is available
-        received = self._exchange.recv(self._pid)
         LOGGER.debug('%s processing message: %s', self._pid, received.message)
         if isinstance(received.message, StopMessage):
             return False
@@ -641,7 +2512,9 @@ class MessageProcessor:
         if isinstance(from_message.message, ExchangeFail):
             LOGGER.error(from_message.message.format())
             return False
-        return self.send_noreply(from_message.from_pid, errmsg, from_message.ident)
+        return self.send_noreply(
+            from_message.from_pid, errmsg, from_message.ident,
+            priority=from_message.priority)
 
     def _send_message(self, to_pid: str, wrapper: MessageWrapper) -> bool:
         """
@@ -659,7 +2532,8 @@ class MessageProcessor:
             ident: str,
             message: ExchangeMessage,
             ref: str = None,
-            from_pid: str = None) -> bool:
+            from_pid: str = None,
+            priority: int = None) -> bool:
         """
         Send a message to a recipient on the exchange
 
@@ -669,20 +2543,22 @@ class MessageProcessor:
             message: The content of the message
             ref: The identifier of the message being responded to
             from_pid: An optional override for the sender identifier
+            priority: An optional override for the priority class of the message
 
         Returns:
             True if the message was successfully added to the queue
         """
         return self._send_message(
             to_pid,
-            MessageWrapper(from_pid or self._pid, ident, message, ref))
+            MessageWrapper(from_pid or self._pid, ident, message, ref, priority))
 
     def send_noreply(
             self,
             to_pid: str,
             message: ExchangeMessage,
             ref: str = None,
-            from_pid: str = None) -> bool:
+            from_pid: str = None,
+            priority: int = None) -> bool:
         """
         Send a message with no reply expected
 
@@ -691,7 +2567,7 @@ class MessageProcessor:
         """
         return self._send_message(
             to_pid,
-            MessageWrapper(from_pid or self._pid, None, message, ref))
+            MessageWrapper(from_pid or self._pid, None, message, ref, priority))
 
     def _process_message(self, received: MessageWrapper) -> bool:
         """
@@ -709,6 +2585,11 @@ class LoggingTCPConnector(aiohttp.TCPConnector):
         super(LoggingTCPConnector, self)._release(key, protocol, should_close=should_close)
 
 
+# Request executors accepting messages within the current process, by identifier.
+# Each entry records the OS process ID so that registrations do not survive a fork
+_LOCAL_EXECUTORS = {}
+
+
 class RequestExecutor(MessageProcessor):
     """
     An subclass of :class:`MessageProcessor` which starts a thread for each outgoing request
@@ -716,32 +2597,126 @@ class RequestExecutor(MessageProcessor):
     async requests via the :class:`Exchange` (like a webserver process). It normally assumes
     that all incoming messages are simply responses to earlier requests.
     Processing should not block the main thread (much) to avoid breaking asyncio.
+    Blocking work is performed by the executor's own thread pools rather than the
+    default executor of its event loop: a single thread each for receiving and
+    sending when the exchange must block, and a sized pool for :meth:`run_thread`.
+    When stopped, the messages still being handled are given until the shutdown
+    timeout to finish before they are cancelled
     """
 
-    def __init__(self, pid: str, exchange: Exchange):
-        super(RequestExecutor, self).__init__(pid, exchange)
+    def __init__(self, pid: str, exchange: Exchange, send_batch: int = 64,
+                 capacity: int = None, helper_threads: int = 4,
+                 shutdown_timeout: float = 30.0):
+        super(RequestExecutor, self).__init__(pid, exchange, capacity=capacity)
+        self._capacity_ready = None
         self._connector = None
-        self._out_queue = None
+        self._send_batch = send_batch
+        self._outgoing = []
+        self._send_ready = None
+        self._send_task = None
+        self._sending = False
         self._req_lock = None
         self._requests = {}
+        self._coalesced = {}
+        self._acks = []
         self._runner = None
+        self._timers = None
+        self._local = False
+        self._helper_threads = max(helper_threads or 1, 1)
+        self._recv_pool = None
+        self._send_pool = None
+        self._helper_pool = None
+        self._shutdown_timeout = shutdown_timeout
+        self._tasks = set()
+        self._draining = False
+        self._shutdown_stats = None
+        # the exchange limit is applied to messages delivered directly within the process
+        self._local_limit = getattr(exchange, 'max_queue', None)
+        # direct delivery would bypass the journal of the exchange
+        self._local_allowed = not getattr(exchange, 'journaled', False)
+        self._local_lock = Lock()
+        self._local_queued = 0
+        self._local_delivered = 0
+        self._local_deferred = 0
+        self._local_stats = QueueTelemetry(time.time())
 
     def start(self, wait: bool = True) -> None:
         """
-        Initialize our :class:`eventloop.Runner` and run our polling thread to listen for messages
+        Initialize our :class:`eventloop.Runner` and listen for messages within its event loop
         """
-        self._out_queue = Queue()
+        self._recv_pool = eventloop.ThreadPool(1, '{}-recv'.format(self._pid))
+        self._send_pool = eventloop.ThreadPool(1, '{}-send'.format(self._pid))
+        self._helper_pool = eventloop.ThreadPool(
+            self._helper_threads, '{}-helper'.format(self._pid))
         self._runner = eventloop.Runner()
         self._runner.start(wait)
-        self._req_lock = asyncio.Lock(loop=self._runner.loop)
-        # Poll for results in a thread from our thread pool
-        self.run_thread(self._run, ident='polling thread {}'.format(self.pid))
+        self._runner.submit(self._init_loop_state()).result()
+        self._timers = eventloop.TimerWheel(self._runner.loop)
+        # Receive messages as a task in our event loop, without a polling thread
+        self.run_task(self._run_async())
+
+    async def _init_loop_state(self) -> None:
+        """
+        Create the synchronization primitives used by our tasks, within our event loop
+        """
+        self._req_lock = asyncio.Lock()
+        self._send_ready = asyncio.Event()
+        self._capacity_ready = asyncio.Event()
 
     def _start_run(self) -> bool:
         if not super(RequestExecutor, self)._start_run():
             return False
-        # Send outgoing messages to the exchange (without blocking our event loop)
-        self.run_thread(self._send_messages, ident='sending thread {}'.format(self.pid))
+        # Send outgoing messages to the exchange as a task in our event loop
+        self._sending = True
+        self._send_task = self.run_task(self._send_messages())
+        # Accept messages from executors in the same process without the exchange,
+        # unless the identifier may be shared with other consumers
+        if self._consumer is None:
+            self._local = True
+            _LOCAL_EXECUTORS[self._pid] = (os.getpid(), self)
+        return True
+
+    async def _run_async(self) -> None:
+        """
+        The main run loop, receiving messages as a task in our event loop
+        """
+        if not self._start_run():
+            return
+        await self._poll_messages_async()
+        await self._drain_tasks()
+        self._local = False
+        if _LOCAL_EXECUTORS.get(self._pid, (None, None))[1] is self:
+            del _LOCAL_EXECUTORS[self._pid]
+        # finish sending any outgoing messages
+        self._sending = False
+        self._send_ready.set()
+        await self._send_task
+        self._stop_run()
+
+    async def _poll_messages_async(self) -> None:
+        """
+        The receiving loop for messages from the exchange
+        """
+        #pylint: disable=broad-except
+        try:
+            while await self._poll_message_async():
+                pass
+        except Exception:
+            LOGGER.exception('Exception while processing messages:')
+
+    async def _poll_message_async(self) -> bool:
+        """
+        Wait for a batch of messages from the exchange and process each in turn
+        """
+        while self._capacity and self._in_flight >= self._capacity:
+            self._capacity_ready.clear()
+            await self._capacity_ready.wait()
+        for received in await self._exchange.recv_async(
+                self._pid, self._recv_limit(),
+                consumer=self._consumer, in_flight=self._in_flight,
+                executor=self._recv_pool):
+            if not self._dispatch_message(received):
+                return False
         return True
 
     # In the webserver environment, the process we're concerned with has already started
@@ -754,7 +2729,9 @@ class RequestExecutor(MessageProcessor):
             self._init_process()
             self.start()
             self._runner.join()
-        asyncio.get_child_watcher()
+        if hasattr(asyncio.get_event_loop_policy(), 'get_child_watcher'):
+            # not provided by the uvloop policy
+            asyncio.get_child_watcher()
         proc = mp.Process(target=_start)
         proc.start()
         return proc
@@ -765,18 +2742,76 @@ class RequestExecutor(MessageProcessor):
         """
         return self._runner
 
+    @property
+    def shutdown_stats(self) -> dict:
+        """
+        The measurements recorded by :meth:`_drain_tasks` when stopping, if any
+        """
+        return self._shutdown_stats
+
+    async def _drain_tasks(self) -> dict:
+        """
+        Stop accepting new requests and wait for the messages being handled to
+        finish, up to the shutdown timeout. Any left running are then cancelled
+
+        Returns:
+            a dict of the number of messages completed and abandoned, along with
+            the time spent waiting in seconds
+        """
+        self._draining = True
+        start = time.perf_counter()
+        current = eventloop.current_task()
+        tasks = [task for task in self._tasks if task is not current]
+        done, pending = (), ()
+        if tasks:
+            done, pending = await asyncio.wait(tasks, timeout=self._shutdown_timeout)
+            if pending:
+                LOGGER.warning('%s abandoned %s messages still in progress after %s seconds',
+                               self._pid, len(pending), self._shutdown_timeout)
+                for task in pending:
+                    task.cancel()
+                await asyncio.wait(pending)
+        stats = self._shutdown_stats or {"completed": 0, "abandoned": 0, "duration": 0.0}
+        stats["completed"] += len(done)
+        stats["abandoned"] += len(pending)
+        stats["duration"] += time.perf_counter() - start
+        self._shutdown_stats = stats
+        return stats
+
+    def local_stats(self) -> dict:
+        """
+        Summarize the messages delivered directly by other executors in this process,
+        and those passed to the exchange instead because we were busy
+        """
+        with self._local_lock:
+            return {
+                "depth": self._local_queued,
+                "max_depth": self._local_stats.max_depth,
+                "delivered": self._local_delivered,
+                "deferred": self._local_deferred,
+                "wait": self._local_stats.waits.results(1e-6),
+            }
+
+    def thread_stats(self) -> dict:
+        """
+        Summarize the use of our thread pools, see :meth:`eventloop.ThreadPool.stats`
+        """
+        pools = (('recv', self._recv_pool), ('send', self._send_pool),
+                 ('helper', self._helper_pool))
+        return {name: pool.stats() for name, pool in pools if pool}
+
     def _stop_run(self) -> None:
         """
-        Stop our sending thread and any other tasks in progress
+        Stop any tasks in progress
         """
-        # stop sending messages
-        self._out_queue.put_nowait(None)
-        self._out_queue.join()
+        self._timers.clear()
         # close TCP connector
         if self._connector:
             self._connector.close()
         # shut down event loop
         self._runner.stop()
+        for pool in (self._recv_pool, self._send_pool, self._helper_pool):
+            pool.shutdown(False)
 
     def run_task(self, proc: Awaitable) -> asyncio.Future:
         """
@@ -792,7 +2827,7 @@ class RequestExecutor(MessageProcessor):
         Add a task to be processed, as either a coroutine or function
 
         Args:
-            proc: the function to be run in the :class:`ThreadPoolExecutor`
+            proc: the function to be run in our pool of helper threads
             args: arguments to pass to the proc, if a function
         """
         if ident and False:
@@ -803,7 +2838,7 @@ class RequestExecutor(MessageProcessor):
                 ret = _proc(*args)
                 LOGGER.info("<< end thread %s %s", ident, tid)
                 return ret
-        return self._runner.run_in_executor(None, proc, *args)
+        return self._runner.run_in_executor(self._helper_pool, proc, *args)
 
     def _init_process(self) -> None:
         """
@@ -811,34 +2846,193 @@ class RequestExecutor(MessageProcessor):
         """
         # create new event loop after fork
         asyncio.get_event_loop().close()
-        loop = asyncio.new_event_loop()
+        loop = eventloop.new_event_loop()
         asyncio.set_event_loop(loop)
 
-    def _send_messages(self) -> None:
+    async def _send_messages(self) -> None:
         """
-        Thread loop for sending messages added to the out-queue
+        Task for sending the outgoing messages added by :meth:`_queue_messages`.
+        Any messages waiting are sent to the exchange as a single batch, followed
+        by the acknowledgements added by :meth:`_ack_message`
         """
+        #pylint: disable=broad-except
         while True:
-            msg = self._out_queue.get()
-            if msg is None:
-                self._out_queue.task_done()
+            await self._send_ready.wait()
+            self._send_ready.clear()
+            while self._outgoing:
+                batch = self._outgoing[:self._send_batch]
+                del self._outgoing[:self._send_batch]
+                for queued, status in zip(batch, await self._exchange.send_many_async(
+                        batch, executor=self._send_pool)):
+                    if status is None:
+                        self._reject_message(queued)
+            if self._acks:
+                acks, self._acks = self._acks, []
+                try:
+                    await asyncio.get_event_loop().run_in_executor(
+                        self._send_pool, self._exchange.ack, self._pid, acks)
+                except Exception:
+                    # the messages are replayed after a restart
+                    LOGGER.exception('Error acknowledging messages:')
+            if not self._sending:
+                break
+
+    def _queue_messages(self, messages: Sequence[QueuedMessage]) -> None:
+        """
+        Add messages to the outgoing list, in our event loop
+        """
+        self._outgoing.extend(messages)
+        self._send_ready.set()
+
+    def _reject_message(self, queued: QueuedMessage) -> None:
+        """
+        Handle a message which could not be added to the exchange because the
+        recipient's queue was full, failing the associated request if any
+
+        Args:
+            queued: the rejected message
+        """
+        LOGGER.warning('Message queue is full, dropped message to %s', queued.to_pid)
+        if queued.message.ident and queued.message.from_pid == self._pid:
+            self.run_task(self._fail_request(
+                queued.message.ident,
+                ExchangeFullError('Message queue is full: {}'.format(queued.to_pid))))
+
+    def _local_executor(self, to_pid: str) -> 'RequestExecutor':
+        """
+        Find a running executor in the current process which shares our exchange.
+        None is returned when the exchange keeps a journal, so that requests are
+        recorded before they are delivered
+
+        Args:
+            to_pid: the identifier of the recipient
+        """
+        if not self._local_allowed:
+            return None
+        found = _LOCAL_EXECUTORS.get(to_pid)
+        if found and found[0] == os.getpid() and found[1]._exchange is self._exchange:
+            return found[1]
+        return None
+
+    def _send_local(self, to_pid: str, wrappers: Sequence[MessageWrapper]) -> bool:
+        """
+        Pass messages directly to the event loop of a recipient hosted in the
+        current process, skipping the exchange. Stop messages are always sent
+        through the exchange so that the recipient finishes polling normally.
+        The recipient is given a copy of the messages, so that neither side
+        can modify the other's objects, as when the messages are serialized
+
+        Args:
+            to_pid: the identifier of the recipient
+            wrappers: the messages to be delivered
+
+        Returns:
+            True if the messages were handed over to the recipient
+        """
+        target = self._local_executor(to_pid)
+        if not target or any(isinstance(wrapper.message, StopMessage) for wrapper in wrappers):
+            return False
+        try:
+            wrappers = copy.deepcopy(wrappers)
+        except Exception:
+            # leave the exchange to report a message which cannot be serialized
+            LOGGER.exception('Error copying messages for local delivery to %s', to_pid)
+            return False
+        if not target._accept_local(wrappers):
+            # the recipient is busy, so the exchange queues the messages and applies its limits
+            return False
+        try:
+            target._runner.call_soon(target._receive_local, wrappers, time.perf_counter())
+        except RuntimeError:
+            # the recipient's event loop has been closed
+            with target._local_lock:
+                target._local_queued -= len(wrappers)
+            return False
+        return True
+
+    def _accept_local(self, wrappers: Sequence[MessageWrapper]) -> bool:
+        """
+        Reserve room for messages delivered directly by another executor in this
+        process. Requests are refused when our local messages waiting to be processed
+        would exceed the queue limit of the exchange. Replies complete requests
+        already in progress, so they are always accepted
+
+        Args:
+            wrappers: the messages to be delivered
+
+        Returns:
+            True if the messages may be delivered
+        """
+        count = len(wrappers)
+        with self._local_lock:
+            if any(not wrapper.ref for wrapper in wrappers):
+                if self._local_limit and self._local_queued + count > self._local_limit:
+                    self._local_deferred += count
+                    return False
+            self._local_queued += count
+            if self._local_queued > self._local_stats.max_depth:
+                self._local_stats.max_depth = self._local_queued
+        return True
+
+    def _receive_local(self, messages: Sequence[MessageWrapper], sent: float) -> None:
+        """
+        Process messages delivered by :meth:`_send_local`, in our event loop
+
+        Args:
+            messages: the messages received from another executor in this process
+            sent: the time at which the messages were handed over
+        """
+        wait = int((time.perf_counter() - sent) * 1e6)
+        with self._local_lock:
+            self._local_queued -= len(messages)
+            self._local_delivered += len(messages)
+            for _ in messages:
+                self._local_stats.waits.add(wait)
+        if not self._local:
+            # stopping: drop the messages, as the exchange does for a stopped recipient
+            LOGGER.debug('%s dropped %d local message(s) after stopping', self._pid, len(messages))
+            return
+        for received in messages:
+            if not self._dispatch_message(received):
+                self.send_stop_message()
                 break
-            self._exchange.send(msg.to_pid, msg.message)
-            self._out_queue.task_done()
 
     def _send_message(self, to_pid: str, wrapper: MessageWrapper) -> bool:
         """
-        Add the message to our out-queue for processing instead of sending directly
+        Add the message to our outgoing list for processing instead of sending directly,
+        unless the recipient is hosted in the current process
 
         Args:
             to_pid: the identifier of the recipient
             message: the message to be sent
         """
-        self._out_queue.put_nowait(QueuedMessage(to_pid, wrapper))
+        if not self._send_local(to_pid, [wrapper]):
+            self._runner.call_soon(self._queue_messages, [QueuedMessage(to_pid, wrapper)])
+        return True
+
+    def _send_message_batch(self, messages: Sequence[QueuedMessage]) -> bool:
+        """
+        Add a list of messages to our outgoing list to be sent to the exchange together.
+        Messages for recipients hosted in the current process are delivered directly
+
+        Args:
+            messages: the messages to be sent, each with the identifier of its recipient
+        """
+        local = OrderedDict()
+        for queued in messages:
+            if self._local_executor(queued.to_pid):
+                local.setdefault(queued.to_pid, []).append(queued)
+        remote = [queued for queued in messages if queued.to_pid not in local]
+        for to_pid, batch in local.items():
+            if not self._send_local(to_pid, [queued.message for queued in batch]):
+                remote.extend(batch)
+        if remote:
+            self._runner.call_soon(self._queue_messages, remote)
         return True
 
     async def _send_request(self, to_pid: str, request: ExchangeMessage,
-                            future: Future, timeout: int = None) -> None:
+                            future: Future, timeout: int = None,
+                            priority: int = None, trace: tuple = None) -> None:
         """
         Send a request to a target service on the exchange and add it to our
         collection to automatically associate the response later
@@ -847,9 +3041,19 @@ class RequestExecutor(MessageProcessor):
             to_pid: the target service identifier
             request: the message payload
             future: used to return the response to (potentially) another thread
-            timeout: an optional timeout before cancelling the request
+            timeout: an optional timeout before cancelling the request, which also
+                sets the deadline for the target to process it
+            priority: an optional override for the priority class of the request
+            trace: the trace context of the caller, if the request is being traced
         """
-        message = MessageWrapper(self._pid, os.urandom(10), request)
+        future = self._coalesce_request(to_pid, request, future, timeout, priority)
+        if future is None:
+            return
+        deadline = time.time() + timeout if timeout else None
+        span = self._request_span(to_pid, request, future, trace)
+        message = MessageWrapper(
+            self._pid, os.urandom(10), request, None, priority, deadline,
+            trace=span.context)
         result = None
         async with self._req_lock:
             if message.ident in self._requests:
@@ -858,41 +3062,225 @@ class RequestExecutor(MessageProcessor):
             self._requests[message.ident] = future
         result = self._send_message(to_pid, message)
         if not result:
+            del self._requests[message.ident]
             future.set_exception(RuntimeError('Request could not be processed'))
         elif timeout:
-            self.run_task(self._cancel_request(message.ident, timeout))
+            self._timers.add(message.ident, timeout, self._cancel_request, message.ident)
+
+    async def _send_requests(self, to_pid: str, requests: Sequence[ExchangeMessage],
+                             futures: Sequence[Future], timeout: int = None,
+                             priority: int = None, trace: tuple = None) -> None:
+        """
+        Send a batch of requests to a target service on the exchange, registering
+        all of them before the batch is queued
+
+        Args:
+            to_pid: the target service identifier
+            requests: the message payloads
+            futures: used to return each response to (potentially) another thread
+            timeout: an optional timeout before cancelling the requests, which also
+                sets the deadline for the target to process them
+            priority: an optional override for the priority class of the requests
+            trace: the trace context of the caller, if the requests are being traced
+        """
+        deadline = time.time() + timeout if timeout else None
+        messages = []
+        async with self._req_lock:
+            for request, future in zip(requests, futures):
+                future = self._coalesce_request(to_pid, request, future, timeout, priority)
+                if future is None:
+                    continue
+                span = self._request_span(to_pid, request, future, trace)
+                message = MessageWrapper(
+                    self._pid, os.urandom(10), request, None, priority, deadline,
+                    trace=span.context)
+                if message.ident in self._requests:
+                    future.set_exception(RuntimeError('Duplicate request identifier'))
+                    continue
+                self._requests[message.ident] = future
+                messages.append(message)
+        if not messages:
+            return
+        # requests rejected by the exchange are failed by _reject_message
+        self._send_message_batch([QueuedMessage(to_pid, message) for message in messages])
+        if timeout:
+            for message in messages:
+                self._timers.add(message.ident, timeout, self._cancel_request, message.ident)
+
+    def _coalesce_request(self, to_pid: str, request: ExchangeMessage, future: Future,
+                          timeout: int = None, priority: int = None) -> Future:
+        """
+        Attach the caller to an identical request which is already in flight, when
+        the request may be coalesced. This is called in the event loop thread
+
+        Args:
+            to_pid: the target service identifier
+            request: the message payload
+            future: used to return the response to the caller
+            timeout: the timeout of the request
+            priority: the priority override of the request
+
+        Returns:
+            the future to be resolved by the response to a new request, or None
+            if the caller is waiting on a request already sent
+        """
+        key = request.coalesce_key() if isinstance(request, ExchangeMessage) else None
+        if key is None:
+            return future
+        key = (to_pid, key, timeout, priority)
+        waiters = self._coalesced.get(key)
+        if waiters is not None:
+            waiters.append(future)
+            return None
+        self._coalesced[key] = [future]
+        # a separate future is used so that a cancelled caller does not
+        # cancel the request for the other waiters
+        shared = Future()
+        shared.add_done_callback(lambda result: self._resolve_coalesced(key, result))
+        return shared
+
+    def _resolve_coalesced(self, key: tuple, result: Future) -> None:
+        """
+        Pass the outcome of a coalesced request to each of the waiting callers
+
+        Args:
+            key: the coalescing key of the request
+            result: the future resolved by the response
+        """
+        for waiter in self._coalesced.pop(key, ()):
+            if waiter.done():
+                continue
+            if result.cancelled():
+                waiter.cancel()
+            elif result.exception() is not None:
+                waiter.set_exception(result.exception())
+            else:
+                waiter.set_result(result.result())
 
-    async def _cancel_request(self, ident: str, timeout: int = None) -> None:
+    @staticmethod
+    def _request_span(to_pid: str, request: ExchangeMessage, future: Future,
+                      trace: tuple = None):
         """
-        Cancel an outstanding request
+        Start a span for an outgoing request, which ends when the response is received
+
+        Args:
+            to_pid: the target service identifier
+            request: the message payload
+            future: the future resolved by the response
+            trace: the trace context of the caller
+        """
+        if trace is None:
+            return tracing.NULL_SPAN
+        span = tracing.start_span(
+            'request {}'.format(type(request).__name__), trace, tracing.SPAN_KIND_CLIENT,
+            attributes={'messaging.destination': to_pid})
+        def _done(result: Future):
+            if result.cancelled():
+                span.set_error('Request cancelled or timed out')
+            elif result.exception() is not None:
+                span.set_error(str(result.exception()))
+            elif isinstance(result.result(), ExchangeFail):
+                span.set_error(str(result.result().value))
+            span.end()
+        future.add_done_callback(_done)
+        return span
+
+    async def _fail_request(self, ident: str, error: Exception) -> None:
+        """
+        Fail an outstanding request with an exception
 
         Args:
             ident: the request identifier
-            timeout: an optional timeout to wait before cancelling
+            error: the exception to be raised by the request future
         """
-        if timeout:
-            await asyncio.sleep(timeout)
         async with self._req_lock:
-            if ident in self._requests and not self._requests[ident].done():
-                self._requests[ident].cancel()
+            request = self._requests.pop(ident, None)
+            self._timers.remove(ident)
+            if request and not request.done():
+                request.set_exception(error)
+
+    def _cancel_request(self, ident: str) -> None:
+        """
+        Cancel an outstanding request when its timeout expires. This is called
+        by our timer wheel in the event loop thread
+
+        Args:
+            ident: the request identifier
+        """
+        request = self._requests.pop(ident, None)
+        if request and not request.done():
+            request.cancel()
 
     def submit(
             self,
             to_pid: str,
             request: ExchangeMessage,
-            timeout: int = None) -> asyncio.Future:
+            timeout: int = None,
+            priority: int = None) -> asyncio.Future:
         """
-        Submit a message to another service and run a task to poll for the results
+        Submit a message to another service and run a task to poll for the results.
+        The result raises :class:`ExchangeFullError` if the message was rejected
+        because the target service's queue is full. Requests which may be
+        coalesced are not sent again while an identical request is in flight,
+        and the callers share the same response
 
         Args:
             to_pid: the identifier of the target service
             request: the body of the message to be sent
             timeout: an optional timeout to wait before cancelling the request
+            priority: an optional override for the priority class of the request
         """
         result = Future()
-        self.run_task(self._send_request(to_pid, request, result, timeout))
+        # the calling thread does not wait for the event loop to schedule the request
+        sent = self._runner.submit(self._send_request(
+            to_pid, request, result, timeout, priority, tracing.current_context()))
+        sent.add_done_callback(lambda sent: self._send_failed(sent, (result,)))
         return asyncio.wrap_future(result)
 
+    def submit_many(
+            self,
+            to_pid: str,
+            requests: Sequence[ExchangeMessage],
+            timeout: int = None,
+            priority: int = None) -> list:
+        """
+        Submit a batch of messages to another service, which are passed to the
+        exchange together
+
+        Args:
+            to_pid: the identifier of the target service
+            requests: the bodies of the messages to be sent
+            timeout: an optional timeout to wait before cancelling each request
+            priority: an optional override for the priority class of the requests
+
+        Returns:
+            a list of futures resolving to the response to each request
+        """
+        results = [Future() for _ in requests]
+        sent = self._runner.submit(self._send_requests(
+            to_pid, requests, results, timeout, priority, tracing.current_context()))
+        sent.add_done_callback(lambda sent: self._send_failed(sent, results))
+        return [asyncio.wrap_future(result) for result in results]
+
+    @staticmethod
+    def _send_failed(sent: Future, results: Sequence[Future]) -> None:
+        """
+        Pass an exception raised while sending requests to the callers still
+        waiting for their results
+
+        Args:
+            sent: the future resolved by the task sending the requests
+            results: the futures returned to the callers
+        """
+        if sent.cancelled():
+            error = RuntimeError('Request was cancelled before it was sent')
+        else:
+            error = sent.exception()
+        if error is not None:
+            for result in results:
+                if not result.done():
+                    result.set_exception(error)
+
     async def _handle_message(self, received: MessageWrapper) -> bool:
         """
         Handle a message received from another service on the exchange by awaking
@@ -901,16 +3289,15 @@ class RequestExecutor(MessageProcessor):
         Args:
             received: the received message to be processed
         """
-        result = False
         if received.ref:
             async with self._req_lock:
-                if received.ref in self._requests:
-                    if not self._requests[received.ref].cancelled():
-                        self._requests[received.ref].set_result(received.message)
-                    result = True
-                self._requests = {
-                    ident: req for ident, req in self._requests.items() if not req.done()}
-        return result
+                request = self._requests.pop(received.ref, None)
+            if request is not None:
+                self._timers.remove(received.ref)
+                if not request.done():
+                    request.set_result(received.message)
+                return True
+        return False
 
     async def _handle_message_task(self, received: MessageWrapper) -> None:
         """
@@ -920,13 +3307,46 @@ class RequestExecutor(MessageProcessor):
             received: the message received from the exchange
         """
         #pylint: disable=broad-except
+        span = tracing.NULL_SPAN
+        if received.trace and not received.ref:
+            if received.sent:
+                tracing.start_span(
+                    'exchange queue', received.trace, tracing.SPAN_KIND_CONSUMER,
+                    received.sent, {'messaging.destination': self._pid}).end()
+            span = tracing.start_span(
+                'handle {}'.format(type(received.message).__name__), received.trace,
+                tracing.SPAN_KIND_SERVER, attributes={'vonx.service': self._pid})
         try:
-            if not await self._handle_message(received):
-                LOGGER.debug('unhandled message to %s/%s from %s: %s',
-                             self._pid, received.ref, received.from_pid, received.message)
+            with span:
+                if not await self._handle_message(received):
+                    LOGGER.debug('unhandled message to %s/%s from %s: %s',
+                                 self._pid, received.ref, received.from_pid, received.message)
+            self._ack_message(received)
+        except asyncio.CancelledError:
+            # abandoned when stopping, so the sender is not left waiting.
+            # The message is not acknowledged, and is replayed after a restart
+            errmsg = ExchangeFail('Service stopped before the request was completed')
+            self._reply_with_error(received, errmsg)
+            raise
         except Exception:
             errmsg = ExchangeFail('Exception during message processing', True)
             self._reply_with_error(received, errmsg)
+            self._ack_message(received)
+        finally:
+            self._in_flight -= 1
+            self._capacity_ready.set()
+
+    def _ack_message(self, received: MessageWrapper) -> None:
+        """
+        Acknowledge a message we have finished handling, when it is kept in the
+        journal of the exchange. Acknowledgements are sent by our sending task
+
+        Args:
+            received: the message received from the exchange
+        """
+        if received.seq is not None:
+            self._acks.append(received.seq)
+            self._send_ready.set()
 
     def _process_message(self, received: MessageWrapper) -> bool:
         """
@@ -935,8 +3355,17 @@ class RequestExecutor(MessageProcessor):
         Args:
             received: the received message to be processed
         """
-        # push the handling of the message into our own event loop
-        self.run_task(self._handle_message_task(received))
+        if self._draining and not received.ref:
+            # new requests are refused while stopping
+            if received.from_pid:
+                self._reply_with_error(
+                    received, ExchangeFail('Service is stopping: {}'.format(self._pid)))
+            return True
+        # handle the message in a new task in our event loop
+        self._in_flight += 1
+        task = self.run_task(self._handle_message_task(received))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
         return True
 
     @property
@@ -1013,7 +3442,8 @@ class RequestTarget:
         """
         return self._executor
 
-    def request(self, message: ExchangeMessage, timeout: int = None) -> asyncio.Future:
+    def request(self, message: ExchangeMessage, timeout: int = None,
+                priority: int = None) -> asyncio.Future:
         """
         Send a request to the recipient service, awaiting the response in
         a method defined by the executor
@@ -1021,11 +3451,33 @@ class RequestTarget:
         Args:
             message: The message to be sent
             timeout: An optional timeout for the message response
+            priority: An optional override for the priority class of the message,
+                such as `PRIORITY_CONTROL`, `PRIORITY_INTERACTIVE` or `PRIORITY_BULK`
         """
         return self._executor.submit(
             self.pid,
             message,
-            timeout)
+            timeout,
+            priority)
+
+    def request_many(self, messages: Sequence[ExchangeMessage], timeout: int = None,
+                     priority: int = None) -> list:
+        """
+        Send a batch of requests to the recipient service
+
+        Args:
+            messages: The messages to be sent
+            timeout: An optional timeout for each message response
+            priority: An optional override for the priority class of the messages
+
+        Returns:
+            A list of futures resolving to the response to each message
+        """
+        return self._executor.submit_many(
+            self.pid,
+            messages,
+            timeout,
+            priority)
 
 
 class HelloProcessor(MessageProcessor):
@@ -1042,20 +3494,26 @@ class ThreadedHelloProcessor(HelloProcessor):
     A threaded request processor for testing delayed, blocking and non-blocking responses
     """
     def __init__(self, pid, exchange, blocking=False, max_workers=5):
-        super(ThreadedHelloProcessor, self).__init__(pid, exchange)
+        # one worker is occupied by the polling loop
+        super(ThreadedHelloProcessor, self).__init__(
+            pid, exchange, capacity=1 if blocking else max(max_workers - 1, 1))
         self._blocking = blocking
         self._pool = None
         self._max_workers = max_workers
+        self._running = None
 
     def start(self, _wait: bool = True) -> None:
         self._pool = ThreadPoolExecutor(self._max_workers) #thread_name_prefix=self._pid
-        self._pool.submit(self._run)
+        self._running = self._pool.submit(self._run)
 
     def start_process(self) -> mp.Process:
         """
         Start this demo processor as a process instead of a thread
         """
-        proc = mp.Process(target=lambda: self.start().result())
+        def _start():
+            self.start()
+            self._running.result()
+        proc = mp.Process(target=_start)
         proc.start()
         return proc
 
@@ -1063,7 +3521,9 @@ class ThreadedHelloProcessor(HelloProcessor):
         if self._blocking:
             self._delayed_process(received)
         else:
-            self._pool.submit(self._delayed_process, received)
+            self._message_started()
+            self._pool.submit(self._delayed_process, received).add_done_callback(
+                lambda _: self._message_finished())
 
     def _delayed_process(self, received: MessageWrapper) -> bool:
         time.sleep(1)
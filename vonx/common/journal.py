@@ -0,0 +1,289 @@
+#
+# Copyright 2017-2018 Government of Canada
+# Public Services and Procurement Canada - buyandsell.gc.ca
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+An append-only journal of the messages accepted by the :class:`Exchange`,
+allowing queued messages to be recovered after a restart
+"""
+
+import binascii
+from collections import OrderedDict
+import logging
+import os
+import struct
+import time
+from typing import Sequence
+
+LOGGER = logging.getLogger(__name__)
+
+# record types
+_RECORD_MESSAGE = 1
+_RECORD_ACK = 2
+
+# record header: type, sequence number, length of the data
+_HEADER = struct.Struct('<BQI')
+
+
+class PidJournal:
+    """
+    The journal file for a single recipient, holding a record for each accepted
+    message followed by a record for each message acknowledged
+    """
+
+    def __init__(self, path: str):
+        self._path = path
+        self._file = None
+        self._live = OrderedDict()
+        self._acked = 0
+        self._seq = 0
+        self._unsynced = 0
+
+    @property
+    def live(self) -> int:
+        """
+        The number of messages which have not been acknowledged
+        """
+        return len(self._live)
+
+    @property
+    def unsynced(self) -> int:
+        """
+        The number of records written since the last sync
+        """
+        return self._unsynced
+
+    def open(self) -> list:
+        """
+        Open the journal file, loading any existing records
+
+        Returns:
+            a list of (sequence number, data) for the unacknowledged messages
+        """
+        valid = 0
+        if os.path.exists(self._path):
+            with open(self._path, 'rb') as infile:
+                data = infile.read()
+            while valid + _HEADER.size <= len(data):
+                kind, seq, size = _HEADER.unpack_from(data, valid)
+                end = valid + _HEADER.size + size
+                if end > len(data) or kind not in (_RECORD_MESSAGE, _RECORD_ACK):
+                    break
+                if kind == _RECORD_MESSAGE:
+                    self._live[seq] = data[valid + _HEADER.size:end]
+                else:
+                    self._live.pop(seq, None)
+                    self._acked += 1
+                self._seq = max(self._seq, seq)
+                valid = end
+            if valid < len(data):
+                # a record was only partly written when the journal was closed
+                LOGGER.warning('Discarding incomplete journal records: %s', self._path)
+        self._file = open(self._path, 'ab')
+        if self._file.tell() != valid:
+            self._file.truncate(valid)
+        return list(self._live.items())
+
+    def append(self, data: bytes) -> int:
+        """
+        Add a message to the journal
+
+        Returns:
+            the sequence number assigned to the message
+        """
+        self._seq += 1
+        self._live[self._seq] = data
+        self._write(_RECORD_MESSAGE, self._seq, data)
+        return self._seq
+
+    def ack(self, seq: int) -> None:
+        """
+        Record that a message has been delivered
+        """
+        if self._live.pop(seq, None) is not None:
+            self._write(_RECORD_ACK, seq, b'')
+            self._acked += 1
+
+    def _write(self, kind: int, seq: int, data: bytes) -> None:
+        self._file.write(_HEADER.pack(kind, seq, len(data)))
+        if data:
+            self._file.write(data)
+        self._unsynced += 1
+
+    def sync(self) -> None:
+        """
+        Flush written records to disk
+        """
+        if self._unsynced:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._unsynced = 0
+
+    def compact(self, threshold: int) -> bool:
+        """
+        Rewrite the journal without the acknowledged messages, once their records
+        outnumber those of the remaining messages
+
+        Args:
+            threshold: the minimum number of acknowledged messages to compact
+        """
+        if self._acked < max(threshold, len(self._live)):
+            return False
+        self._file.close()
+        temp_path = self._path + '.tmp'
+        with open(temp_path, 'wb') as outfile:
+            for seq, data in self._live.items():
+                outfile.write(_HEADER.pack(_RECORD_MESSAGE, seq, len(data)))
+                outfile.write(data)
+            outfile.flush()
+            os.fsync(outfile.fileno())
+        os.replace(temp_path, self._path)
+        self._file = open(self._path, 'ab')
+        self._acked = 0
+        self._unsynced = 0
+        return True
+
+    def close(self) -> None:
+        """
+        Sync and close the journal file
+        """
+        if self._file:
+            self.sync()
+            self._file.close()
+            self._file = None
+
+
+class MessageJournal:
+    """
+    A directory of journal files, one for each recipient. Writes are collected
+    and synced to disk together, either once `sync_batch` records are waiting
+    or `sync_interval` seconds after the previous sync, so a crash may lose the
+    most recent records. A message is acknowledged once its recipient has
+    finished processing it, and is replayed otherwise, so it may be delivered
+    more than once
+    """
+
+    def __init__(self, path: str, sync_interval: float = 0.1, sync_batch: int = 256,
+                 compact_threshold: int = 1024):
+        """
+        Initialize the journal
+
+        Args:
+            path: the directory holding the journal files
+            sync_interval: the maximum time in seconds before written records are synced
+            sync_batch: the number of written records which causes an immediate sync
+            compact_threshold: the minimum number of acknowledged messages before
+                a journal file is rewritten
+        """
+        self._path = path
+        self._sync_interval = sync_interval
+        self._sync_batch = sync_batch
+        self._compact_threshold = compact_threshold
+        self._journals = {}
+        self._last_sync = time.time()
+
+    def _pid_path(self, to_pid: str) -> str:
+        name = binascii.hexlify(to_pid.encode('utf-8')).decode('ascii')
+        return os.path.join(self._path, name + '.journal')
+
+    def open(self, to_pid: str) -> list:
+        """
+        Open the journal for a recipient
+
+        Returns:
+            a list of (sequence number, data) for the messages to be replayed
+        """
+        journal = self._journals.get(to_pid)
+        if journal:
+            return []
+        os.makedirs(self._path, exist_ok=True)
+        journal = PidJournal(self._pid_path(to_pid))
+        self._journals[to_pid] = journal
+        replay = journal.open()
+        if replay:
+            LOGGER.info('Replaying %d journaled message(s) for %s', len(replay), to_pid)
+        return replay
+
+    def append(self, to_pid: str, data: bytes) -> int:
+        """
+        Add a message for a recipient to the journal
+
+        Returns:
+            the sequence number of the message, or None if the recipient's
+            journal is not open
+        """
+        journal = self._journals.get(to_pid)
+        if journal:
+            return journal.append(data)
+        return None
+
+    def ack(self, to_pid: str, seq: int) -> None:
+        """
+        Record the completion of a message
+        """
+        self.ack_many(to_pid, (seq,))
+
+    def ack_many(self, to_pid: str, seqs: Sequence[int]) -> None:
+        """
+        Record the completion of a list of messages. The journal of a recipient
+        which has stopped is updated as well, so that the messages it finished
+        while stopping are not replayed
+        """
+        journal = self._journals.get(to_pid)
+        if journal:
+            for seq in seqs:
+                journal.ack(seq)
+            if journal.compact(self._compact_threshold):
+                LOGGER.debug('Compacted journal for %s', to_pid)
+        elif os.path.exists(self._pid_path(to_pid)):
+            journal = PidJournal(self._pid_path(to_pid))
+            journal.open()
+            for seq in seqs:
+                journal.ack(seq)
+            journal.close()
+
+    def release(self, to_pid: str) -> None:
+        """
+        Close the journal for a recipient which has stopped, so that the messages
+        not yet delivered are replayed if it registers again
+        """
+        journal = self._journals.pop(to_pid, None)
+        if journal:
+            journal.close()
+
+    def sync(self, force: bool = False) -> None:
+        """
+        Sync the written records to disk when the batch is full or the sync
+        interval has passed
+
+        Args:
+            force: sync all records immediately
+        """
+        now = time.time()
+        if not force and now - self._last_sync < self._sync_interval and \
+                sum(journal.unsynced for journal in self._journals.values()) < self._sync_batch:
+            return
+        for journal in self._journals.values():
+            journal.sync()
+        self._last_sync = now
+
+    def close(self) -> None:
+        """
+        Sync and close all open journal files
+        """
+        for journal in self._journals.values():
+            journal.close()
+        self._journals.clear()
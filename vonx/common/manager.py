@@ -21,12 +21,19 @@ a collection of :class:`ServiceBase` instances
 """
 
 
+import asyncio
 import logging
 import os
+import socket
+import time
 from typing import Mapping
 
+from . import codec
 from . import config
+from . import eventloop
 from . import exchange as exch
+from . import remote
+from . import tracing
 from .service import (
     ServiceBase,
     ServiceStatus,
@@ -45,12 +52,76 @@ class ServiceManager(ServiceBase):
     """
 
     def __init__(self, env: Mapping = None, pid: str = "manager"):
-        super(ServiceManager, self).__init__(pid, exch.Exchange(), env or {})
+        env = env or {}
+        tracing.init_tracing(env)
+        eventloop.init_event_loop(env)
+        super(ServiceManager, self).__init__(pid, self._create_exchange(env), env)
         self._executor_cls = exch.RequestExecutor
+        self._exchange_server = None
         self._proc_locals = {"pid": os.getpid()}
         self._services = {}
         self._init_services()
 
+    @staticmethod
+    def _create_exchange(env: Mapping) -> exch.Exchange:
+        """
+        Create the message exchange using the settings in our environment.
+        When `EXCHANGE_CONNECT` is set, the exchange shared by another node is used
+        """
+        connect = env.get("EXCHANGE_CONNECT")
+        if connect:
+            return remote.RemoteExchange(
+                remote.parse_address(connect), ServiceManager._exchange_authkey(env))
+        send_timeout = env.get("EXCHANGE_SEND_TIMEOUT")
+        shm_threshold = int(env.get("EXCHANGE_SHM_THRESHOLD") or 0)
+        # shared memory payloads must be encoded, so default to the pickle codec
+        codec_name = env.get("EXCHANGE_CODEC") or (shm_threshold and "pickle")
+        params = {
+            "max_queue": int(env.get("EXCHANGE_MAX_QUEUE") or 0),
+            "send_timeout": float(send_timeout) if send_timeout not in (None, "") else 5.0,
+            "codec": codec.get_codec(codec_name),
+            "shm_threshold": shm_threshold,
+            "lane_burst": int(env.get("EXCHANGE_LANE_BURST") or 8),
+            "journal_path": env.get("EXCHANGE_JOURNAL_PATH") or None,
+            "journal_sync": float(env.get("EXCHANGE_JOURNAL_SYNC") or 0.1),
+            "drain_timeout": float(env.get("EXCHANGE_DRAIN_TIMEOUT") or 5),
+        }
+        shards = int(env.get("EXCHANGE_SHARDS") or 1)
+        # the settings only supported by the exchange shared between processes
+        shared = [name for name, value in (
+            ("EXCHANGE_SHARDS", shards > 1),
+            ("EXCHANGE_TRANSPORT", env.get("EXCHANGE_TRANSPORT") == exch.TRANSPORT_SHM),
+            ("EXCHANGE_SHM_THRESHOLD", shm_threshold),
+            ("EXCHANGE_CODEC", env.get("EXCHANGE_CODEC")),
+            ("EXCHANGE_JOURNAL_PATH", params["journal_path"]),
+        ) if value]
+        mode = env.get("EXCHANGE_MODE") or "process"
+        if mode == "auto":
+            # an in-memory exchange suits a single process, when no setting
+            # requires the exchange to be shared between processes
+            mode = "process" if shared else "local"
+        if mode == "local":
+            if shared:
+                raise ValueError(
+                    "Not supported by the local exchange, set EXCHANGE_MODE to 'process': "
+                    + ", ".join(shared))
+            return exch.LocalExchange(
+                params["max_queue"], params["send_timeout"], params["lane_burst"],
+                params["drain_timeout"])
+        if mode != "process":
+            raise ValueError("Unsupported exchange mode: {}".format(mode))
+        if shards > 1:
+            return exch.ShardedExchange(shards, **params)
+        return exch.Exchange(**params)
+
+    @staticmethod
+    def _exchange_authkey(env: Mapping) -> bytes:
+        """
+        Get the key used to authenticate connections to a shared exchange
+        """
+        authkey = env.get("EXCHANGE_AUTHKEY")
+        return authkey.encode("utf-8") if authkey else None
+
     def _init_services(self) -> None:
         """
         Initialize all dependent services
@@ -85,9 +156,29 @@ class ServiceManager(ServiceBase):
         """
         Start the message processor and any other services
         """
-        self._exchange.start(False)
+        # a sharded exchange runs each shard in its own process to use multiple cores
+        self._exchange.start(
+            isinstance(self._exchange, exch.ShardedExchange),
+            self._env.get("EXCHANGE_TRANSPORT") or exch.TRANSPORT_PIPE)
+        listen = self._env.get("EXCHANGE_LISTEN")
+        if listen and not isinstance(self._exchange, remote.RemoteExchange):
+            # share the exchange with the nodes connecting to this address
+            self._exchange_server = remote.ExchangeServer(
+                self._exchange, remote.parse_address(listen),
+                self._exchange_authkey(self._env))
+            self._exchange_server.start()
         super(ServiceManager, self).start(wait)
 
+    def start_process(self):
+        """
+        Start the message processor and any other services in a new process
+        """
+        if isinstance(self._exchange, exch.LocalExchange):
+            raise RuntimeError(
+                "The local exchange cannot be shared with a new process, "
+                "set EXCHANGE_MODE to 'process'")
+        return super(ServiceManager, self).start_process()
+
     async def _service_start(self) -> bool:
         """
         Start all registered services
@@ -101,15 +192,31 @@ class ServiceManager(ServiceBase):
         Stop the message processor and any other services
         """
         super(ServiceManager, self).stop(wait)
+        if self._exchange_server:
+            self._exchange_server.stop()
         self._exchange.stop()
 
     async def _service_stop(self) -> None:
         """
-        Stop all registered services
+        Stop all registered services, allowing them to finish the requests in
+        progress at the same time
         """
         LOGGER.debug("Stopping managed services")
-        for _id, service in self._services.items():
-            service.stop()
+        start = time.perf_counter()
+        services = list(self._services.values())
+        for service in services:
+            service.stop(False)
+        # allow for the shutdown of the service itself after its requests are finished
+        expire = time.time() + self._shutdown_timeout + 5
+        while any(self._exchange.is_registered(service.pid) for service in services):
+            if time.time() >= expire:
+                LOGGER.warning("Timed out waiting for services to stop")
+                break
+            await asyncio.sleep(0.05)
+        abandoned = sum((service.shutdown_stats or {}).get("abandoned", 0)
+                        for service in services)
+        LOGGER.info("Stopped %s services in %.2fs, %s requests abandoned",
+                    len(services), time.perf_counter() - start, abandoned)
 
     async def _get_status(self) -> ServiceResponse:
         """
@@ -119,6 +226,9 @@ class ServiceManager(ServiceBase):
         status["services"] = {}
         for svc_id in self._services:
             status["services"][svc_id] = await self.get_service_status(svc_id)
+        # the exchange may be in another process or on another node, so avoid
+        # blocking the event loop while it replies
+        status["exchange"] = await self.run_thread(self._exchange.status)
         return ServiceStatus(status)
 
     @property
@@ -157,8 +267,10 @@ class ServiceManager(ServiceBase):
         """
         ploc = self.proc_locals
         if not "executor" in ploc:
-            ident = "exec-{}".format(ploc["pid"])
-            ploc["executor"] = self._executor_cls(ident, self._exchange)
+            # the host name keeps identifiers unique between nodes sharing an exchange
+            ident = "exec-{}-{}".format(socket.gethostname(), ploc["pid"])
+            ploc["executor"] = self._executor_cls(
+                ident, self._exchange, shutdown_timeout=self._shutdown_timeout)
             ploc["executor"].start()
         return ploc["executor"]
 
@@ -0,0 +1,140 @@
+#
+# Copyright 2017-2018 Government of Canada
+# Public Services and Procurement Canada - buyandsell.gc.ca
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Shared memory segments used by the :class:`Exchange` to pass large message payloads
+between processes, so that only a small handle is sent through the message pipe
+"""
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    # Python < 3.8
+    shared_memory = None
+
+
+def _open_segment(name: str = None, size: int = 0, track: bool = None):
+    """
+    Create or attach to a shared memory segment. Created segments are not tracked
+    by the current process, as they are unlinked by the receiving process
+
+    Args:
+        name: the name of an existing segment, or None to create one
+        size: the size of a new segment
+        track: whether the resource tracker of the current process should unlink
+            the segment at exit. By default only attached segments are tracked,
+            as those are unlinked by this process once read
+    """
+    create = name is None
+    if track is None:
+        track = not create
+    try:
+        return shared_memory.SharedMemory(name, create=create, size=size, track=track)
+    except TypeError:
+        # Python < 3.13 tracks every segment opened, and stops tracking on unlink
+        shm = shared_memory.SharedMemory(name, create=create, size=size)
+        if not track:
+            try:
+                from multiprocessing import resource_tracker
+                resource_tracker.unregister(
+                    shm._name, 'shared_memory') #pylint: disable=protected-access
+            except (ImportError, AttributeError):
+                pass
+        return shm
+
+
+class SharedPayload:
+    """
+    A handle to an encoded message payload held in a shared memory segment.
+    Only the handle is passed through the exchange, and the segment is unlinked
+    by the receiver once the payload has been decoded
+    """
+
+    __slots__ = ('name', 'size')
+
+    def __init__(self, name: str, size: int):
+        self.name = name
+        self.size = size
+
+    def __getstate__(self):
+        return (self.name, self.size)
+
+    def __setstate__(self, state):
+        self.name, self.size = state
+
+    def __repr__(self):
+        return 'SharedPayload(name={}, size={})'.format(self.name, self.size)
+
+    @classmethod
+    def create(cls, data: bytes) -> 'SharedPayload':
+        """
+        Copy an encoded payload into a new shared memory segment
+
+        Args:
+            data: the encoded payload
+        """
+        shm = _open_segment(size=len(data))
+        try:
+            shm.buf[:len(data)] = data
+        finally:
+            shm.close()
+        return cls(shm.name, len(data))
+
+    def read(self, decode):
+        """
+        Decode the payload directly from shared memory and release the segment
+
+        Args:
+            decode: a function accepting a buffer containing the encoded payload
+        """
+        shm = _open_segment(self.name)
+        try:
+            with shm.buf[:self.size] as view:
+                return decode(view)
+        finally:
+            shm.close()
+            shm.unlink()
+
+    def copy(self) -> bytes:
+        """
+        Copy the payload out of shared memory without releasing the segment
+        """
+        # the segment is still owned by the recipient of the message
+        shm = _open_segment(self.name, track=False)
+        try:
+            with shm.buf[:self.size] as view:
+                return bytes(view)
+        finally:
+            shm.close()
+
+    def release(self) -> None:
+        """
+        Release the segment without reading the payload
+        """
+        try:
+            shm = _open_segment(self.name)
+        except FileNotFoundError:
+            return
+        shm.close()
+        shm.unlink()
+
+
+def shared_payloads_supported() -> bool:
+    """
+    Check whether shared memory payloads are available on this platform
+    """
+    return shared_memory is not None
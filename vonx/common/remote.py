@@ -0,0 +1,382 @@
+#
+# Copyright 2017-2018 Government of Canada
+# Public Services and Procurement Canada - buyandsell.gc.ca
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+A socket transport for the :class:`Exchange`, allowing services and web servers
+running on other hosts to share the message exchange of a single node.
+Commands and replies are passed as length-prefixed frames over a TCP or Unix
+domain socket, which is authenticated using a shared key
+"""
+
+import asyncio
+from concurrent.futures import Executor
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
+import logging
+import os
+from threading import local, Lock, Thread
+import time
+from typing import Sequence
+
+from .exchange import ExchangeFullError, MessageWrapper, QueuedMessage, TRANSPORT_PIPE
+
+LOGGER = logging.getLogger(__name__)
+
+# the exchange methods which may be called by a remote client
+_COMMANDS = (
+    'register', 'is_registered', 'ack', 'send', 'send_many', 'recv_many', 'status')
+
+
+def parse_address(value: str):
+    """
+    Parse the address of an exchange server, either `host:port` for a TCP socket
+    or the path of a Unix domain socket
+
+    Returns:
+        a (host, port) tuple or a path string
+    """
+    host, sep, port = value.rpartition(':')
+    if sep and port.isdigit() and '/' not in value:
+        return (host or 'localhost', int(port))
+    return value
+
+
+class ExchangeServer:
+    """
+    Accept connections from :class:`RemoteExchange` clients and perform their
+    commands against a local :class:`Exchange`. Each connection is served by
+    its own thread, as a receiver may wait for messages
+    """
+
+    def __init__(self, exchange, address, authkey: bytes = None, poll_interval: float = 1.0):
+        """
+        Initialize the server
+
+        Args:
+            exchange: the :class:`Exchange` or :class:`ShardedExchange` to be shared
+            address: a (host, port) tuple for a TCP socket, or the path of a
+                Unix domain socket
+            authkey: the key shared with the clients, which is required for TCP
+            poll_interval: the time in seconds between checks that a client
+                waiting for messages is still connected
+        """
+        if isinstance(address, tuple) and not authkey:
+            raise ValueError('An authentication key is required for a TCP exchange server')
+        self._exchange = exchange
+        self._address = address
+        self._authkey = authkey
+        self._poll_interval = poll_interval
+        self._listener = None
+        self._thread = None
+        self._conns = set()
+        self._lock = Lock()
+        self._closing = False
+
+    @property
+    def address(self):
+        """
+        Accessor for the address the server is listening on
+        """
+        return self._listener.address if self._listener else self._address
+
+    def start(self) -> None:
+        """
+        Start listening for connections in a new thread
+        """
+        self._listener = Listener(self._address, authkey=self._authkey)
+        self._thread = Thread(target=self._accept, daemon=True)
+        self._thread.start()
+        LOGGER.info('Exchange server listening on %s', self.address)
+
+    def stop(self) -> None:
+        """
+        Stop accepting connections and close the current connections
+        """
+        if not self._listener or self._closing:
+            return
+        self._closing = True
+        try:
+            # wake the thread waiting for a new connection
+            Client(self.address, authkey=self._authkey).close()
+        except (OSError, AuthenticationError):
+            pass
+        self._thread.join()
+        self._listener.close()
+        with self._lock:
+            conns, self._conns = self._conns, set()
+        for conn in conns:
+            conn.close()
+
+    def _accept(self) -> None:
+        """
+        Accept new connections until the server is stopped
+        """
+        while not self._closing:
+            try:
+                conn = self._listener.accept()
+            except (AuthenticationError, EOFError, OSError) as e:
+                if not self._closing:
+                    LOGGER.warning('Rejected exchange connection: %s', e)
+                continue
+            if self._closing:
+                conn.close()
+                break
+            with self._lock:
+                self._conns.add(conn)
+            Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _serve(self, conn) -> None:
+        """
+        Perform the commands received on a connection until it is closed
+        """
+        #pylint: disable=broad-except
+        try:
+            while not self._closing:
+                command, args = conn.recv()
+                if command not in _COMMANDS:
+                    conn.send((False, ValueError('Unrecognized command: {}'.format(command))))
+                    continue
+                try:
+                    if command == 'recv_many':
+                        result = self._recv_many(conn, *args)
+                    else:
+                        result = getattr(self._exchange, command)(*args)
+                except (EOFError, OSError):
+                    raise
+                except Exception as e:
+                    conn.send((False, e))
+                else:
+                    conn.send((True, result))
+        except (EOFError, OSError):
+            # the client has disconnected
+            pass
+        except Exception:
+            LOGGER.exception('Error serving exchange connection:')
+        finally:
+            with self._lock:
+                self._conns.discard(conn)
+            conn.close()
+
+    def _recv_many(self, conn, to_pid: str, limit: int = None, blocking: bool = True,
+                   timeout=None, consumer: str = None, in_flight: int = 0) -> list:
+        """
+        Receive messages on behalf of a client, checking periodically that it
+        has not disconnected so that no messages are taken for a closed connection
+        """
+        if not blocking:
+            return self._exchange.recv_many(
+                to_pid, limit, blocking, timeout, consumer, in_flight)
+        expire = time.time() + timeout if timeout is not None else None
+        while True:
+            wait = self._poll_interval
+            if expire is not None:
+                wait = max(min(expire - time.time(), wait), 0)
+            messages = self._exchange.recv_many(
+                to_pid, limit, True, wait, consumer, in_flight)
+            if messages or self._closing or (expire is not None and time.time() >= expire):
+                return messages
+            if conn.poll():
+                # clients wait for a reply before sending again, so the connection is closed
+                raise EOFError
+
+
+class RemoteExchange:
+    """
+    A client for an :class:`Exchange` shared by an :class:`ExchangeServer` on
+    another node. It presents the same interface as a local :class:`Exchange`,
+    so it may be used by message processors and request executors unchanged.
+    Each thread uses its own connection to the server, opened when first needed
+    """
+
+    def __init__(self, address, authkey: bytes = None):
+        """
+        Initialize the client
+
+        Args:
+            address: a (host, port) tuple for a TCP socket, or the path of a
+                Unix domain socket
+            authkey: the key shared with the server
+        """
+        self._address = address
+        self._authkey = authkey
+        self._local = local()
+        self._conns = []
+        self._lock = Lock()
+
+    @property
+    def address(self):
+        """
+        Accessor for the address of the exchange server
+        """
+        return self._address
+
+    def _connection(self):
+        """
+        Get the connection to the server for the current thread
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.pid != os.getpid():
+            # the connection belongs to the parent of a forked process
+            conn = None
+        if conn is None:
+            conn = Client(self._address, authkey=self._authkey)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+            with self._lock:
+                self._conns.append(conn)
+        return conn
+
+    def _close_connection(self, conn) -> None:
+        if getattr(self._local, 'conn', None) is conn:
+            self._local.conn = None
+        with self._lock:
+            if conn in self._conns:
+                self._conns.remove(conn)
+        conn.close()
+
+    def _call(self, command: str, *args):
+        """
+        Perform a command against the exchange on the server
+
+        Raises:
+            ConnectionError: if the server could not be reached
+        """
+        for attempt in (0, 1):
+            conn = self._connection()
+            try:
+                conn.send((command, args))
+            except (EOFError, OSError):
+                # the command was not sent, so it is safe to reconnect and retry
+                self._close_connection(conn)
+                if attempt:
+                    raise ConnectionError('Exchange server is unavailable: {}'.format(
+                        self._address))
+                continue
+            try:
+                success, result = conn.recv()
+            except (EOFError, OSError):
+                self._close_connection(conn)
+                raise ConnectionError('Lost connection to exchange server: {}'.format(
+                    self._address))
+            if not success:
+                raise result
+            return result
+
+    def start(self, _process: bool = True, _transport: str = TRANSPORT_PIPE, **_params) -> None:
+        """
+        Check that the exchange server can be reached. The transport and process
+        settings of the shared exchange are determined by the server
+        """
+        self._connection()
+        LOGGER.info('Connected to exchange server on %s', self._address)
+
+    def stop(self, _drain: bool = True) -> None:
+        """
+        Close the connections to the server. The shared exchange keeps running
+        """
+        with self._lock:
+            conns, self._conns = self._conns, []
+        for conn in conns:
+            conn.close()
+
+    def join(self) -> None:
+        """
+        Nothing to wait for, as the exchange runs on the server
+        """
+        pass
+
+    def status(self) -> dict:
+        """
+        Retrieve the status of the shared exchange, see :meth:`Exchange.status`
+        """
+        return self._call('status')
+
+    def register(self, to_pid: str, consumer: str = None, capacity: int = None) -> bool:
+        """
+        Register a listener on the exchange, see :meth:`Exchange.register`
+        """
+        return self._call('register', to_pid, consumer, capacity)
+
+    def is_registered(self, to_pid: str) -> bool:
+        """
+        Check if a listener is currently running
+        """
+        return self._call('is_registered', to_pid)
+
+    def ack(self, to_pid: str, seqs: Sequence[int]) -> None:
+        """
+        Record that a recipient has finished processing messages, see :meth:`Exchange.ack`
+        """
+        self._call('ack', to_pid, list(seqs))
+
+    def send(self, to_pid: str, wrapper: MessageWrapper,
+             blocking: bool = True, timeout: float = None) -> bool:
+        """
+        Add a message to the bus, see :meth:`Exchange.send`
+        """
+        return self._call('send', to_pid, wrapper, blocking, timeout)
+
+    def send_many(self, messages: Sequence[QueuedMessage],
+                  blocking: bool = True, timeout: float = None) -> list:
+        """
+        Add a batch of messages to the bus using a single command, see :meth:`Exchange.send_many`
+        """
+        return self._call('send_many', list(messages), blocking, timeout)
+
+    async def send_async(self, to_pid: str, wrapper: MessageWrapper,
+                         timeout: float = None) -> bool:
+        """
+        Add a message to the bus from within an event loop, see :meth:`Exchange.send_async`
+        """
+        status = (await self.send_many_async([QueuedMessage(to_pid, wrapper)], timeout))[0]
+        if status is None:
+            raise ExchangeFullError('Message queue is full: {}'.format(to_pid))
+        return status
+
+    async def send_many_async(self, messages: Sequence[QueuedMessage],
+                              timeout: float = None, executor: Executor = None) -> list:
+        """
+        Add a batch of messages to the bus from within an event loop, using a
+        worker thread. See :meth:`Exchange.send_many_async`
+        """
+        return await asyncio.get_event_loop().run_in_executor(
+            executor, self.send_many, messages, True, timeout)
+
+    def recv(self, to_pid: str, blocking: bool = True, timeout=None) -> MessageWrapper:
+        """
+        Receive a message from the bus, see :meth:`Exchange.recv`
+        """
+        received = self.recv_many(to_pid, 1, blocking, timeout)
+        return received[0] if received else None
+
+    def recv_many(self, to_pid: str, limit: int = None,
+                  blocking: bool = True, timeout=None,
+                  consumer: str = None, in_flight: int = 0) -> list:
+        """
+        Receive a batch of messages from the bus, see :meth:`Exchange.recv_many`
+        """
+        return self._call('recv_many', to_pid, limit, blocking, timeout, consumer, in_flight)
+
+    async def recv_async(self, to_pid: str, limit: int = None, timeout=None,
+                         consumer: str = None, in_flight: int = 0,
+                         executor: Executor = None) -> list:
+        """
+        Receive a batch of messages from the bus from within an event loop, using
+        a worker thread. See :meth:`Exchange.recv_async`
+        """
+        return await asyncio.get_event_loop().run_in_executor(
+            executor, self.recv_many, to_pid, limit, True, timeout, consumer, in_flight)
@@ -0,0 +1,278 @@
+#
+# Copyright 2017-2018 Government of Canada
+# Public Services and Procurement Canada - buyandsell.gc.ca
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+A shared-memory ring buffer used by the :class:`Exchange` to pass messages between
+processes without a round trip through the message processing loop
+"""
+
+import ctypes
+import multiprocessing as mp
+import struct
+from typing import Sequence
+
+from .telemetry import HISTOGRAM_BUCKETS, Histogram, histogram_bucket
+
+_HEADER = struct.Struct('<I')
+
+# offsets into the shared state array
+_HEAD = 0
+_TAIL = 1
+_GENERATION = 2
+_WAITERS = 3
+_DELIVERED = 4
+_WRITTEN = 5
+_QUEUED = 6
+_EXPIRED = 7
+_MAX_PENDING = 8
+_MAX_SIZE = 9
+_MAX_WAIT = 10
+_STATE_SIZE = 11
+
+
+class RingBuffer:
+    """
+    A fixed-size buffer of length-prefixed frames held in shared memory.
+    It must be created before the processes using it are forked.
+    Access is serialized by a lock which is only held while frames are copied.
+    """
+
+    def __init__(self, size: int = 1 << 20):
+        if size < _HEADER.size * 2:
+            raise ValueError('Ring buffer size is too small: {}'.format(size))
+        self._size = size
+        self._buf = mp.RawArray(ctypes.c_ubyte, size)
+        self._state = mp.RawArray(ctypes.c_ulonglong, _STATE_SIZE)
+        self._sizes = mp.RawArray(ctypes.c_ulonglong, HISTOGRAM_BUCKETS)
+        self._waits = mp.RawArray(ctypes.c_ulonglong, HISTOGRAM_BUCKETS)
+        self._lock = mp.Lock()
+        self._view = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_view'] = None
+        return state
+
+    @property
+    def size(self) -> int:
+        """
+        Accessor for the capacity of the buffer in bytes
+        """
+        return self._size
+
+    @property
+    def generation(self) -> int:
+        """
+        Accessor for the generation counter, incremented each time the buffer is reset
+        """
+        return self._state[_GENERATION]
+
+    @property
+    def delivered(self) -> int:
+        """
+        Accessor for the number of frames read since the last reset
+        """
+        return self._state[_DELIVERED]
+
+    @property
+    def pending(self) -> int:
+        """
+        Accessor for the number of frames waiting to be read
+        """
+        return self._state[_WRITTEN] - self._state[_DELIVERED]
+
+    @property
+    def queued(self) -> int:
+        """
+        Accessor for the number of messages held for the receiver outside of the buffer
+        """
+        return self._state[_QUEUED]
+
+    def add_queued(self, count: int) -> None:
+        """
+        Adjust the number of messages held for the receiver outside of the buffer
+        """
+        with self._lock:
+            self._state[_QUEUED] = max(self._state[_QUEUED] + count, 0)
+
+    @property
+    def expired(self) -> int:
+        """
+        Accessor for the number of frames read and discarded by the receiver
+        because their deadline had passed
+        """
+        return self._state[_EXPIRED]
+
+    def add_expired(self, count: int) -> None:
+        """
+        Record frames discarded by the receiver because their deadline had passed
+        """
+        with self._lock:
+            self._state[_EXPIRED] += count
+
+    def record_waits(self, waits: Sequence[int]) -> None:
+        """
+        Record the time in microseconds that frames spent waiting to be read
+        """
+        with self._lock:
+            for wait in waits:
+                self._waits[histogram_bucket(wait)] += 1
+                if wait > self._state[_MAX_WAIT]:
+                    self._state[_MAX_WAIT] = wait
+
+    def telemetry(self) -> tuple:
+        """
+        Collect the measurements recorded since the last reset
+
+        Returns:
+            a tuple of the largest number of pending frames, a :class:`Histogram`
+            of the frame sizes and a :class:`Histogram` of the wait times
+        """
+        sizes = Histogram()
+        waits = Histogram()
+        with self._lock:
+            sizes.merge(self._sizes, self._state[_MAX_SIZE])
+            waits.merge(self._waits, self._state[_MAX_WAIT])
+            return self._state[_MAX_PENDING], sizes, waits
+
+    @property
+    def used(self) -> int:
+        """
+        Accessor for the number of bytes currently held in the buffer
+        """
+        return self._state[_TAIL] - self._state[_HEAD]
+
+    def _get_view(self) -> memoryview:
+        if self._view is None:
+            self._view = memoryview(self._buf).cast('B')
+        return self._view
+
+    def _write(self, pos: int, data) -> None:
+        view = self._get_view()
+        start = pos % self._size
+        first = min(len(data), self._size - start)
+        view[start:start + first] = data[:first]
+        if first < len(data):
+            view[0:len(data) - first] = data[first:]
+
+    def _read(self, pos: int, length: int) -> bytes:
+        view = self._get_view()
+        start = pos % self._size
+        first = min(length, self._size - start)
+        if first == length:
+            return view[start:start + length].tobytes()
+        return view[start:start + first].tobytes() + view[0:length - first].tobytes()
+
+    def put(self, frames: Sequence[bytes], generation: int = None,
+            max_pending: int = None):
+        """
+        Append frames to the buffer, stopping at the first frame that does not fit.
+        Nothing is written while messages are queued outside of the buffer, so that
+        the receiver sees them in the order they were sent
+
+        Args:
+            frames: the encoded frames to be added
+            generation: if provided, only write when the buffer generation matches
+            max_pending: if provided, the number of unread frames not to be exceeded
+
+        Returns:
+            None if the generation did not match, otherwise a tuple of the number of
+            frames written and the number of receivers waiting on the buffer
+        """
+        state = self._state
+        with self._lock:
+            if generation is not None and state[_GENERATION] != generation:
+                return None
+            if state[_QUEUED]:
+                return 0, state[_WAITERS]
+            if max_pending is not None:
+                room = max_pending - (state[_WRITTEN] - state[_DELIVERED])
+                frames = frames[:max(room, 0)]
+            tail = state[_TAIL]
+            free = self._size - (tail - state[_HEAD])
+            count = 0
+            for frame in frames:
+                need = _HEADER.size + len(frame)
+                if need > free:
+                    break
+                self._write(tail, _HEADER.pack(len(frame)))
+                self._write(tail + _HEADER.size, frame)
+                tail += need
+                free -= need
+                count += 1
+                self._sizes[histogram_bucket(len(frame))] += 1
+                if len(frame) > state[_MAX_SIZE]:
+                    state[_MAX_SIZE] = len(frame)
+            state[_TAIL] = tail
+            state[_WRITTEN] += count
+            pending = state[_WRITTEN] - state[_DELIVERED]
+            if pending > state[_MAX_PENDING]:
+                state[_MAX_PENDING] = pending
+            return count, state[_WAITERS]
+
+    def get(self, limit: int = None, wait: bool = False) -> list:
+        """
+        Remove frames from the buffer
+
+        Args:
+            limit: the maximum number of frames to return
+            wait: register the caller as a waiting receiver if no frames are available
+
+        Returns:
+            a list of the frames removed
+        """
+        state = self._state
+        frames = []
+        with self._lock:
+            head = state[_HEAD]
+            tail = state[_TAIL]
+            while head < tail and (limit is None or len(frames) < limit):
+                (length,) = _HEADER.unpack(self._read(head, _HEADER.size))
+                frames.append(self._read(head + _HEADER.size, length))
+                head += _HEADER.size + length
+            state[_HEAD] = head
+            if frames:
+                state[_DELIVERED] += len(frames)
+            elif wait:
+                state[_WAITERS] += 1
+        return frames
+
+    def remove_waiter(self) -> None:
+        """
+        Deregister a receiver previously registered by `get(wait=True)`
+        """
+        with self._lock:
+            if self._state[_WAITERS]:
+                self._state[_WAITERS] -= 1
+
+    def reset(self) -> int:
+        """
+        Discard the contents of the buffer and advance the generation counter
+
+        Returns:
+            the number of frames delivered before the reset
+        """
+        state = self._state
+        with self._lock:
+            delivered = state[_DELIVERED]
+            generation, waiters = state[_GENERATION] + 1, state[_WAITERS]
+            ctypes.memset(state, 0, ctypes.sizeof(state))
+            ctypes.memset(self._sizes, 0, ctypes.sizeof(self._sizes))
+            ctypes.memset(self._waits, 0, ctypes.sizeof(self._waits))
+            state[_GENERATION] = generation
+            state[_WAITERS] = waiters
+            return delivered
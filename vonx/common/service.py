@@ -21,13 +21,15 @@ Basic implementation and message classes for services running on the exchange
 
 import asyncio
 import logging
-from typing import Mapping
+from typing import Callable, Mapping
 
 from .exchange import (
     Exchange,
     ExchangeFail,
     ExchangeMessage,
+    message_expired,
     MessageWrapper,
+    PRIORITY_CONTROL,
     RequestExecutor)
 from .util import Stats
 
@@ -62,7 +64,8 @@ class ServiceStatusReq(ServiceRequest):
     """
     Request the status of a service
     """
-    pass
+    _priority = PRIORITY_CONTROL
+    _coalesce = True
 
 class ServiceStatus(ServiceResponse):
     """
@@ -76,7 +79,7 @@ class ServiceStopReq(ServiceRequest):
     """
     Request a service to stop running
     """
-    pass
+    _priority = PRIORITY_CONTROL
 
 class ServiceSyncReq(ServiceRequest):
     """
@@ -99,7 +102,11 @@ class ServiceBase(RequestExecutor):
     """
 
     def __init__(self, pid: str, exchange: Exchange, env: Mapping):
-        super(ServiceBase, self).__init__(pid, exchange)
+        # services given a capacity may share their identifier with instances on other nodes
+        super(ServiceBase, self).__init__(
+            pid, exchange, capacity=int((env or {}).get("SERVICE_CAPACITY") or 0) or None,
+            helper_threads=int((env or {}).get("SERVICE_HELPER_THREADS") or 4),
+            shutdown_timeout=float((env or {}).get("SHUTDOWN_TIMEOUT") or 30))
         self._env = env
         self._status = {
             "id": self._pid,
@@ -109,6 +116,9 @@ class ServiceBase(RequestExecutor):
             "started": False,
         }
         self._stats = Stats()
+        self._expired = 0
+        self._handling = {}
+        self._coalesced_count = 0
         self._sync_again = False
         self._sync_lock = None
 
@@ -148,7 +158,12 @@ class ServiceBase(RequestExecutor):
         async with self._sync_lock:
             await self._service_stop()
             self._update_status(started=False)
-        LOGGER.info("Stopped service: %s", self.pid)
+        stats = self._shutdown_stats
+        if stats:
+            LOGGER.info("Stopped service: %s in %.2fs, %s requests completed, %s abandoned",
+                        self.pid, stats["duration"], stats["completed"], stats["abandoned"])
+        else:
+            LOGGER.info("Stopped service: %s", self.pid)
 
     async def _service_stop(self) -> None:
         """
@@ -206,6 +221,10 @@ class ServiceBase(RequestExecutor):
         """
         result = self._status.copy()
         result["stats"] = self._stats.results()
+        result["expired"] = self._expired
+        result["coalesced"] = self._coalesced_count
+        result["threads"] = self.thread_stats()
+        result["local"] = self.local_stats()
         return ServiceStatus(result)
 
     async def _handle_message(self, received: MessageWrapper) -> bool:
@@ -225,7 +244,17 @@ class ServiceBase(RequestExecutor):
         if await super(ServiceBase, self)._handle_message(received):
             return True
 
+        elif isinstance(request, ServiceRequest) and \
+                not isinstance(request, ServiceStopReq) and message_expired(received):
+            # the requester has stopped waiting for a reply
+            LOGGER.debug("Skipped expired request from %s: %s", from_pid, request)
+            self._expired += 1
+            return True
+
         elif isinstance(request, ServiceStopReq):
+            # stop accepting requests and let those in progress finish,
+            # while still receiving the responses they may be waiting for
+            await self._drain_tasks()
             # run service shutdown in async thread
             await self._stop()
             # finish polling
@@ -248,11 +277,11 @@ class ServiceBase(RequestExecutor):
                 reply = ServiceAck()
 
         elif isinstance(request, ServiceStatusReq):
-            reply = await self._get_status()
+            reply = await self._coalesce_handler(request, lambda _req: self._get_status())
 
         elif isinstance(request, ServiceRequest):
             try:
-                reply = await self._service_request(request)
+                reply = await self._coalesce_handler(request, self._service_request)
             except Exception:
                 LOGGER.exception("Exception while handling request:")
                 reply = ServiceFail("Exception while handling request")
@@ -269,9 +298,32 @@ class ServiceBase(RequestExecutor):
                 )
             return True
 
-        self.send_noreply(from_pid, reply, ident)
+        # reply with the same priority as the request
+        self.send_noreply(from_pid, reply, ident, priority=received.priority)
         return True
 
+    async def _coalesce_handler(self, request: ServiceRequest,
+                                handler: Callable) -> ServiceResponse:
+        """
+        Handle a request, sharing the result with identical requests received
+        while it is being processed when the request may be coalesced
+
+        Args:
+            request: the request to be handled
+            handler: the coroutine function producing the response
+        """
+        key = request.coalesce_key()
+        if key is None:
+            return await handler(request)
+        task = self._handling.get(key)
+        if task is None:
+            task = asyncio.ensure_future(handler(request))
+            self._handling[key] = task
+            task.add_done_callback(lambda _task: self._handling.pop(key, None))
+        else:
+            self._coalesced_count += 1
+        return await asyncio.shield(task)
+
     async def _service_request(self, request: ServiceRequest) -> ServiceResponse:
         """
         Handle a request from another service
@@ -0,0 +1,196 @@
+#
+# Copyright 2017-2018 Government of Canada
+# Public Services and Procurement Canada - buyandsell.gc.ca
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Lightweight measurements of the message queues and consumers of the :class:`Exchange`
+"""
+
+from typing import Sequence
+
+# the number of power-of-two buckets in each histogram
+HISTOGRAM_BUCKETS = 40
+
+PERCENTILES = (50, 90, 99)
+
+# the period in seconds over which queue delivery rates are measured
+RATE_WINDOW = 10.0
+
+
+def histogram_bucket(value: int) -> int:
+    """
+    Find the histogram bucket for a non-negative integer sample. Bucket `n`
+    holds the values from `2 ** (n - 1)` up to `2 ** n - 1`
+
+    Args:
+        value: the sample value
+    """
+    if value <= 0:
+        return 0
+    return min(int(value).bit_length(), HISTOGRAM_BUCKETS - 1)
+
+
+class Histogram:
+    """
+    A histogram of non-negative integer samples in power-of-two buckets.
+    Adding a sample takes constant time, and percentiles are reported as the
+    upper bound of the bucket containing them
+    """
+
+    __slots__ = ('counts', 'count', 'max')
+
+    def __init__(self):
+        self.counts = [0] * HISTOGRAM_BUCKETS
+        self.count = 0
+        self.max = 0
+
+    def add(self, value: int) -> None:
+        """
+        Record a sample
+        """
+        self.counts[histogram_bucket(value)] += 1
+        self.count += 1
+        if value > self.max:
+            self.max = value
+
+    def merge(self, counts: Sequence[int], maximum: int = 0) -> None:
+        """
+        Add the bucket counts collected by another histogram
+
+        Args:
+            counts: the count for each bucket
+            maximum: the largest sample recorded
+        """
+        for idx, count in enumerate(counts):
+            if count:
+                self.counts[idx] += count
+                self.count += count
+        if maximum > self.max:
+            self.max = maximum
+
+    def percentile(self, pct: float) -> int:
+        """
+        Estimate a percentile of the recorded samples
+
+        Args:
+            pct: the percentile, between 0 and 100
+        """
+        if not self.count:
+            return None
+        target = self.count * pct / 100.0
+        seen = 0
+        for idx, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= target:
+                return min((1 << idx) - 1, self.max)
+        return self.max
+
+    def results(self, scale: float = 1) -> dict:
+        """
+        Summarize the recorded samples
+
+        Args:
+            scale: a multiplier applied to the reported values
+        """
+        result = {"count": self.count}
+        if self.count:
+            for pct in PERCENTILES:
+                result["p{}".format(pct)] = self.percentile(pct) * scale
+            result["max"] = self.max * scale
+        return result
+
+
+class QueueTelemetry:
+    """
+    Measurements collected for the message queue of a single recipient. The
+    delivery rate is measured over fixed windows, closed by :meth:`sample` as
+    messages are delivered, so reading it does not change the result seen by
+    other readers
+    """
+
+    __slots__ = ('max_depth', 'sizes', 'waits', 'window_count', 'window_time', 'window_rate')
+
+    def __init__(self, now: float):
+        self.max_depth = 0
+        self.sizes = Histogram()
+        self.waits = Histogram()
+        self.window_count = 0
+        self.window_time = now
+        self.window_rate = None
+
+    def sample(self, count: int, now: float) -> None:
+        """
+        Record the total number of messages delivered, closing the current rate
+        window once it has lasted :data:`RATE_WINDOW` seconds
+
+        Args:
+            count: the total number of messages delivered
+            now: the current time
+        """
+        elapsed = now - self.window_time
+        if elapsed >= RATE_WINDOW:
+            self.window_rate = (count - self.window_count) / elapsed
+            self.window_count = count
+            self.window_time = now
+
+    def rate(self, count: int, now: float) -> float:
+        """
+        Calculate the number of messages delivered per second over the last
+        complete window, or since the start of the current window when the last
+        one is not recent
+
+        Args:
+            count: the total number of messages delivered
+            now: the current time
+        """
+        elapsed = now - self.window_time
+        if self.window_rate is not None and elapsed < RATE_WINDOW:
+            return self.window_rate
+        return (count - self.window_count) / elapsed if elapsed > 0 else 0.0
+
+
+class ConsumerLoad:
+    """
+    The load reported by one of the consumers sharing a recipient identifier
+    """
+
+    __slots__ = ('capacity', 'in_flight', 'delivered')
+
+    def __init__(self, capacity: int):
+        self.capacity = max(capacity or 1, 1)
+        self.in_flight = 0
+        self.delivered = 0
+
+    @property
+    def free(self) -> int:
+        """
+        The number of additional messages the consumer can accept
+        """
+        return max(self.capacity - self.in_flight, 0)
+
+    def results(self, total: int) -> dict:
+        """
+        Summarize the consumer's load
+
+        Args:
+            total: the number of messages delivered to all consumers of the recipient
+        """
+        return {
+            "capacity": self.capacity,
+            "in_flight": self.in_flight,
+            "delivered": self.delivered,
+            "share": self.delivered / total if total else 0.0,
+        }
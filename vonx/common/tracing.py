@@ -0,0 +1,386 @@
+#
+# Copyright 2017-2018 Government of Canada
+# Public Services and Procurement Canada - buyandsell.gc.ca
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Request tracing across the web server, the :class:`Exchange` and the services.
+A trace context is carried by each message, and the spans recorded for sampled
+traces are exported to a rotating file in the OTLP JSON format, one batch per line
+"""
+
+import atexit
+import binascii
+import json
+import logging
+import logging.handlers
+import os
+import random
+from threading import Lock
+import time
+from typing import Mapping, NamedTuple
+
+try:
+    import contextvars
+except ImportError:
+    # the active span is not tracked implicitly before Python 3.7
+    contextvars = None
+
+LOGGER = logging.getLogger(__name__)
+
+SPAN_KIND_INTERNAL = 1
+SPAN_KIND_SERVER = 2
+SPAN_KIND_CLIENT = 3
+SPAN_KIND_PRODUCER = 4
+SPAN_KIND_CONSUMER = 5
+
+STATUS_OK = 1
+STATUS_ERROR = 2
+
+
+TraceContext = NamedTuple('TraceContext', [
+    ('trace_id', str),
+    ('span_id', str)])
+TraceContext.__doc__ = """
+    The identifiers of a sampled span, passed along with a message so that
+    spans recorded by the recipient belong to the same trace
+
+    Attributes:
+        trace_id (str): The trace identifier as 32 hex digits
+        span_id (str): The identifier of the parent span as 16 hex digits
+    """
+
+
+_CURRENT = contextvars.ContextVar('vonx_trace', default=None) if contextvars else None
+
+
+def current_context() -> TraceContext:
+    """
+    Get the context of the active span in the current task, if any
+    """
+    return _CURRENT.get() if _CURRENT else None
+
+
+def format_traceparent(context: TraceContext) -> str:
+    """
+    Format a trace context as a W3C `traceparent` HTTP header value
+    """
+    return '00-{}-{}-01'.format(context.trace_id, context.span_id)
+
+
+def parse_traceparent(value: str) -> TraceContext:
+    """
+    Parse a W3C `traceparent` HTTP header value
+
+    Returns:
+        the trace context, or None if the value is missing or invalid
+    """
+    parts = (value or '').strip().split('-')
+    if len(parts) < 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    try:
+        int(parts[1], 16)
+        int(parts[2], 16)
+    except ValueError:
+        return None
+    return TraceContext(parts[1].lower(), parts[2].lower())
+
+
+def _random_id(size: int) -> str:
+    return binascii.hexlify(os.urandom(size)).decode('ascii')
+
+
+def _attribute_value(value) -> dict:
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        return {'intValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': str(value)}
+
+
+class Span:
+    """
+    A timed operation within a trace. Spans may be used as context managers,
+    making them the active span of the current task until they are ended
+    """
+
+    __slots__ = ('context', 'parent_id', 'name', 'kind', 'start_time', 'end_time',
+                 'attributes', 'status', '_tracer', '_token')
+
+    def __init__(self, tracer: 'Tracer', context: TraceContext, parent_id: str,
+                 name: str, kind: int, start_time: float, attributes: dict):
+        self._tracer = tracer
+        self._token = None
+        self.context = context
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind
+        self.start_time = start_time
+        self.end_time = None
+        self.attributes = attributes
+        self.status = None
+
+    @property
+    def recording(self) -> bool:
+        """
+        Whether the span will be exported
+        """
+        return True
+
+    def set_attribute(self, key: str, value) -> None:
+        """
+        Add an attribute to the span
+        """
+        self.attributes[key] = value
+
+    def set_error(self, message: str) -> None:
+        """
+        Mark the operation as failed
+        """
+        self.status = (STATUS_ERROR, message)
+
+    def end(self, end_time: float = None) -> None:
+        """
+        Finish the span and pass it to the exporter
+
+        Args:
+            end_time: an optional end time, as returned by `time.time()`
+        """
+        if self.end_time is None:
+            self.end_time = time.time() if end_time is None else end_time
+            self._tracer.export(self)
+
+    def __enter__(self):
+        if _CURRENT:
+            self._token = _CURRENT.set(self.context)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None and self.status is None:
+            self.set_error('{}: {}'.format(exc_type.__name__, exc_value))
+        if self._token is not None:
+            _CURRENT.reset(self._token)
+            self._token = None
+        self.end()
+
+    def to_otlp(self) -> dict:
+        """
+        Convert the span to the OTLP JSON representation
+        """
+        result = {
+            'traceId': self.context.trace_id,
+            'spanId': self.context.span_id,
+            'parentSpanId': self.parent_id or '',
+            'name': self.name,
+            'kind': self.kind,
+            'startTimeUnixNano': str(int(self.start_time * 1e9)),
+            'endTimeUnixNano': str(int(self.end_time * 1e9)),
+            'attributes': [
+                {'key': key, 'value': _attribute_value(value)}
+                for key, value in self.attributes.items()],
+        }
+        if self.status:
+            result['status'] = {'code': self.status[0], 'message': self.status[1]}
+        return result
+
+
+class NullSpan:
+    """
+    A placeholder for a span which is not sampled, ignoring all updates
+    """
+
+    __slots__ = ()
+
+    context = None
+    recording = False
+
+    def set_attribute(self, key: str, value) -> None:
+        pass
+
+    def set_error(self, message: str) -> None:
+        pass
+
+    def end(self, end_time: float = None) -> None:
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+NULL_SPAN = NullSpan()
+
+
+class Tracer:
+    """
+    Start spans and export them in batches to a rotating file. Each process
+    writes its own file, named by formatting the path with the process ID
+    """
+
+    def __init__(self, path: str = None, sample_rate: float = 0.0,
+                 service_name: str = 'vonx', max_bytes: int = 10 << 20,
+                 backup_count: int = 3, batch_size: int = 64, flush_interval: float = 1.0):
+        """
+        Initialize the tracer
+
+        Args:
+            path: the export file path, which may contain a `{pid}` placeholder.
+                Tracing is disabled when no path is given
+            sample_rate: the fraction of new traces to be recorded, between 0 and 1
+            service_name: the service name recorded with the exported spans
+            max_bytes: the size at which the export file is rotated
+            backup_count: the number of rotated export files to keep
+            batch_size: the number of spans collected before writing a batch
+            flush_interval: the maximum time in seconds between writes
+        """
+        self._path = path
+        self._sample_rate = sample_rate if path else 0.0
+        self._service_name = service_name
+        self._max_bytes = max_bytes
+        self._backup_count = backup_count
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._pending = []
+        self._lock = Lock()
+        self._last_flush = time.time()
+        self._handler = None
+        self._handler_pid = None
+
+    @property
+    def enabled(self) -> bool:
+        """
+        Whether any traces may be recorded
+        """
+        return self._sample_rate > 0
+
+    def start_span(self, name: str, parent: TraceContext = None,
+                   kind: int = SPAN_KIND_INTERNAL, start_time: float = None,
+                   attributes: dict = None, root: bool = False):
+        """
+        Start a new span
+
+        Args:
+            name: the name of the operation
+            parent: the context of the parent span, otherwise the active span is used
+            kind: the OTLP span kind
+            start_time: an optional start time, as returned by `time.time()`
+            attributes: optional attributes for the span
+            root: start a new trace, subject to sampling, when there is no parent
+
+        Returns:
+            a :class:`Span`, or :data:`NULL_SPAN` if the trace is not sampled
+        """
+        if not self._sample_rate:
+            return NULL_SPAN
+        if parent is None:
+            parent = current_context()
+        if parent is None:
+            if not root or random.random() >= self._sample_rate:
+                return NULL_SPAN
+            trace_id = _random_id(16)
+            parent_id = None
+        else:
+            trace_id, parent_id = parent
+        return Span(
+            self, TraceContext(trace_id, _random_id(8)), parent_id, name, kind,
+            time.time() if start_time is None else start_time, attributes or {})
+
+    def export(self, span: Span) -> None:
+        """
+        Queue a finished span for export
+        """
+        with self._lock:
+            self._pending.append(span)
+            now = time.time()
+            if len(self._pending) >= self._batch_size or \
+                    now - self._last_flush >= self._flush_interval:
+                self._flush(now)
+
+    def flush(self) -> None:
+        """
+        Write any spans waiting for export
+        """
+        with self._lock:
+            self._flush(time.time())
+
+    def _flush(self, now: float) -> None:
+        self._last_flush = now
+        if not self._pending:
+            return
+        spans, self._pending = self._pending, []
+        pid = os.getpid()
+        try:
+            if self._handler_pid != pid:
+                # open a separate export file in each process
+                self._handler = logging.handlers.RotatingFileHandler(
+                    self._path.format(pid=pid), maxBytes=self._max_bytes,
+                    backupCount=self._backup_count, delay=True)
+                self._handler.setFormatter(logging.Formatter('%(message)s'))
+                self._handler_pid = pid
+            batch = {'resourceSpans': [{
+                'resource': {'attributes': [
+                    {'key': 'service.name', 'value': {'stringValue': self._service_name}},
+                    {'key': 'process.pid', 'value': {'intValue': str(pid)}},
+                ]},
+                'scopeSpans': [{
+                    'scope': {'name': __name__},
+                    'spans': [span.to_otlp() for span in spans],
+                }],
+            }]}
+            self._handler.emit(logging.makeLogRecord({
+                'msg': json.dumps(batch, separators=(',', ':')),
+                'levelno': logging.INFO, 'levelname': 'INFO'}))
+        except Exception:
+            LOGGER.exception('Error exporting trace spans:')
+
+
+_TRACER = Tracer()
+
+
+def get_tracer() -> Tracer:
+    """
+    Get the shared tracer instance
+    """
+    return _TRACER
+
+
+def init_tracing(env: Mapping) -> Tracer:
+    """
+    Configure the shared tracer using the settings in the environment:
+    `TRACE_EXPORT_PATH`, `TRACE_SAMPLE_RATE` and `TRACE_SERVICE_NAME`
+    """
+    global _TRACER
+    path = env.get('TRACE_EXPORT_PATH')
+    rate = float(env.get('TRACE_SAMPLE_RATE') or (1.0 if path else 0.0))
+    if rate and path and contextvars is None:
+        LOGGER.warning('Spans within a service are not linked before Python 3.7')
+    _TRACER.flush()
+    _TRACER = Tracer(path, min(max(rate, 0.0), 1.0), env.get('TRACE_SERVICE_NAME') or 'vonx')
+    return _TRACER
+
+
+def start_span(name: str, parent: TraceContext = None, kind: int = SPAN_KIND_INTERNAL,
+               start_time: float = None, attributes: dict = None, root: bool = False):
+    """
+    Start a new span using the shared tracer, see :meth:`Tracer.start_span`
+    """
+    return _TRACER.start_span(name, parent, kind, start_time, attributes, root)
+
+
+atexit.register(lambda: _TRACER.flush())
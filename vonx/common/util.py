@@ -19,9 +19,12 @@
 Utility functions and classes
 """
 
+import asyncio
+from collections import OrderedDict
 import json
 import logging
 import time
+from typing import Callable, Sequence
 
 from .exchange import ExchangeMessage
 
@@ -172,3 +175,91 @@ class Stats:
             "min": self.min.copy(),
             "total": self.total.copy(),
         }
+
+
+class TaskGraph:
+    """
+    Run a set of coroutines in dependency order. Each task starts once the tasks
+    it depends on have finished, and independent tasks run concurrently up to a
+    limit. A task returning `False` is treated as incomplete, and the tasks
+    depending on an incomplete or failed task are skipped
+    """
+
+    def __init__(self, concurrency: int = 8):
+        """
+        Initialize the graph
+
+        Args:
+            concurrency: the maximum number of tasks running at once
+        """
+        self._concurrency = max(concurrency or 1, 1)
+        self._tasks = OrderedDict()
+        self.timings = OrderedDict()
+
+    def add(self, name: str, func: Callable, deps: Sequence[str] = (),
+            after: Sequence[str] = ()) -> str:
+        """
+        Add a task to the graph. Dependencies must be added before the tasks
+        depending on them, so the graph cannot contain cycles
+
+        Args:
+            name: a unique name for the task
+            func: a coroutine function called without arguments to perform the task
+            deps: the names of the tasks which must complete before this one
+            after: the names of tasks which must finish before this one, whether
+                or not they completed
+
+        Returns:
+            the name of the task
+        """
+        if name in self._tasks:
+            raise ValueError("Duplicate task: {}".format(name))
+        for dep in tuple(deps) + tuple(after):
+            if dep not in self._tasks:
+                raise ValueError("Unknown dependency of {}: {}".format(name, dep))
+        self._tasks[name] = (func, tuple(deps), tuple(after))
+        return name
+
+    async def run(self) -> dict:
+        """
+        Run all of the tasks in the graph, recording the status and duration of
+        each in :attr:`timings`
+
+        Returns:
+            a dict of the result of each task, which is `False` for skipped tasks
+
+        Raises:
+            the first exception raised by a task, once all of the tasks have finished
+        """
+        limit = asyncio.Semaphore(self._concurrency)
+        futures = OrderedDict()
+        self.timings = OrderedDict((name, {"status": "pending"}) for name in self._tasks)
+
+        async def _run(name, func, deps, after):
+            if deps or after:
+                results = await asyncio.gather(
+                    *(futures[dep] for dep in deps + after), return_exceptions=True)
+                if any(result is False or isinstance(result, BaseException)
+                       for result in results[:len(deps)]):
+                    self.timings[name] = {"status": "skipped"}
+                    return False
+            async with limit:
+                start = time.perf_counter()
+                status = "failed"
+                try:
+                    result = await func()
+                    status = "incomplete" if result is False else "complete"
+                    return result
+                finally:
+                    self.timings[name] = {
+                        "status": status,
+                        "duration": time.perf_counter() - start,
+                    }
+
+        for name, (func, deps, after) in self._tasks.items():
+            futures[name] = asyncio.ensure_future(_run(name, func, deps, after))
+        results = await asyncio.gather(*futures.values(), return_exceptions=True)
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+        return OrderedDict(zip(futures, results))
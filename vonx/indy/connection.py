@@ -26,7 +26,8 @@ from typing import Sequence
 
 import aiohttp
 
-from ..common.exchange import RequestTarget
+from ..common import tracing
+from ..common.exchange import PRIORITY_BULK, RequestTarget
 from .errors import IndyConfigError, IndyConnectionError
 from .messages import (
     IndyServiceFail,
@@ -253,6 +254,30 @@ class HolderConnection(ConnectionBase):
             raise IndyConnectionError("Unexpected result: {}".format(result), 500)
         return result
 
+    async def store_credential_batch(
+            self, indy_creds: Sequence[Credential]) -> StoredCredentialBatch:
+        """
+        Ask the target to store a list of credentials, submitting the requests together
+
+        Args:
+            indy_creds: the prepared list of credentials
+        """
+        responses = await asyncio.gather(
+            *self.target.request_many(
+                [StoreCredentialReq(self.holder_id, cred) for cred in indy_creds],
+                priority=PRIORITY_BULK),
+            return_exceptions=True)
+        stored = []
+        errors = []
+        for result in responses:
+            if isinstance(result, StoredCredential):
+                stored.append(result)
+            elif isinstance(result, IndyServiceFail):
+                errors.append(result.value)
+            else:
+                errors.append("Unexpected result: {}".format(result))
+        return StoredCredentialBatch(stored, errors)
+
     async def construct_proof(self, request: ProofRequest,
                               cred_ids: set = None, params: dict = None) -> ConstructedProof:
         """
@@ -444,8 +469,14 @@ class HttpConnection(ConnectionBase):
         """
         url = self.get_api_url(path)
         LOGGER.debug("post_json: %s", url)
-        async with HttpSession("post_json", self._http_client) as handler:
-            response = await handler.client.post(url, json=data)
-            self._response_headers = response.headers
-            await handler.check_status(response)
-            return await response.json()
+        with tracing.start_span(
+                "POST {}".format(path), kind=tracing.SPAN_KIND_CLIENT,
+                attributes={"http.url": url}) as span:
+            headers = {"traceparent": tracing.format_traceparent(span.context)} \
+                if span.recording else None
+            async with HttpSession("post_json", self._http_client) as handler:
+                response = await handler.client.post(url, json=data, headers=headers)
+                span.set_attribute("http.status_code", response.status)
+                self._response_headers = response.headers
+                await handler.check_status(response)
+                return await response.json()
@@ -21,6 +21,7 @@ Message classes used to communicate with the :class:`IndyService`
 
 from typing import Sequence
 
+from ..common.exchange import PRIORITY_BULK
 from ..common.service import (
     ServiceAck,
     ServiceFail,
@@ -190,6 +191,7 @@ class IssueCredentialBatchReq(IndyServiceReq):
         ("origin_did", str),
         ("cred_data", Sequence),
     )
+    _priority = PRIORITY_BULK
 
 
 class CredentialOffer(IndyServiceRep):
@@ -280,6 +282,7 @@ class ResolveSchemaReq(IndyServiceReq):
         ("schema_version", str),
         ("origin_did", str),
     )
+    _coalesce = True
 
 
 class ResolvedSchema(IndyServiceRep):
@@ -396,6 +399,7 @@ class ResolveNymReq(IndyServiceReq):
         ("did", str),
         ("agent_id", str, None),
     )
+    _coalesce = True
 
 class ResolvedNym(IndyServiceRep):
     """
@@ -22,6 +22,8 @@ agents and connections, and handles the core logic for working with credentials
 
 import asyncio
 import base64
+from collections import OrderedDict
+from functools import partial
 import json
 import hashlib
 import logging
@@ -37,6 +39,7 @@ from von_anchor.nodepool import NodePool
 from von_anchor.util import cred_def_id, revealed_attrs, schema_id, schema_key, \
     proof_req_infos2briefs, proof_req_briefs2req_creds
 
+from ..common import tracing
 from ..common.service import (
     Exchange,
     ServiceBase,
@@ -44,7 +47,7 @@ from ..common.service import (
     ServiceResponse,
     ServiceSyncError,
 )
-from ..common.util import log_json
+from ..common.util import log_json, TaskGraph
 from .config import (
     AgentType,
     AgentCfg,
@@ -190,6 +193,7 @@ class IndyService(ServiceBase):
         self._pool = None
         self._proof_specs = {}
         self._storage_lock = None
+        self._sync_concurrency = int(env.get("SYNC_CONCURRENCY") or 8)
         self._wallets = {}
         self._verifier = None
         self._update_config(spec)
@@ -220,24 +224,53 @@ class IndyService(ServiceBase):
     async def _service_sync(self) -> bool:
         """
         Perform the initial setup of the ledger connection, including downloading the
-        genesis transaction file
-        """
-        await self._setup_pool()
+        genesis transaction file, then sync the wallets, agents, credential types,
+        connections and proof specs. These are run as a dependency graph, so that
+        steps which do not depend on each other are performed concurrently
+        """
+        graph = TaskGraph(self._sync_concurrency)
+        pool = graph.add("pool", self._setup_pool)
+        wallets = {}
+        for wallet_id, wallet in self._wallets.items():
+            wallets[wallet_id] = graph.add(
+                "wallet:{}".format(wallet_id), partial(self._sync_wallet, wallet))
+        agents = {}
+        for agent_id, agent in self._agents.items():
+            opened = graph.add(
+                "agent:{}:open".format(agent_id), partial(self._open_agent, agent),
+                (pool, wallets[agent.wallet_id]))
+            published = []
+            if not agent.synced:
+                # the credential types sharing a schema are published in turn
+                schemas = OrderedDict()
+                for cred_type in agent.cred_types:
+                    defn = cred_type.get("definition")
+                    key = (defn.name, defn.version) if defn else (None, None)
+                    schemas.setdefault(key, []).append(cred_type)
+                for (name, version), cred_types in schemas.items():
+                    published.append(graph.add(
+                        "agent:{}:schema:{}:{}".format(agent_id, name, version),
+                        partial(self._publish_schemas, agent, cred_types), (opened,)))
+            agents[agent_id] = graph.add(
+                "agent:{}".format(agent_id), partial(self._complete_agent, agent),
+                [opened] + published)
+        for connection_id, connection in self._connections.items():
+            graph.add(
+                "connection:{}".format(connection_id),
+                partial(self._sync_connection, connection), (agents[connection.agent_id],))
+        for spec_id, spec in self._proof_specs.items():
+            # schemas are resolved using any of the agents which could be synced
+            graph.add(
+                "proof_spec:{}".format(spec_id), partial(self._sync_proof_spec, spec),
+                (pool,), tuple(agents.values()))
+        try:
+            results = await graph.run()
+        finally:
+            self._update_status(sync_tasks=dict(graph.timings))
         synced = True
-        for wallet in self._wallets.values():
-            if not wallet.created:
-                await wallet.create()
-        for agent in self._agents.values():
-            if not await self._sync_agent(agent):
-                LOGGER.debug("Agent not yet synced: %s", agent.agent_id)
-                synced = False
-        for connection in self._connections.values():
-            if not await self._sync_connection(connection):
-                LOGGER.debug("Connection not yet synced: %s", connection.connection_id)
-                synced = False
-        for spec in self._proof_specs.values():
-            if not await self._sync_proof_spec(spec):
-                LOGGER.debug("Proof spec not synced: %s", spec.spec_id)
+        for name, result in results.items():
+            if result is False:
+                LOGGER.debug("Not yet synced: %s", name)
                 synced = False
         return synced
 
@@ -371,10 +404,20 @@ class IndyService(ServiceBase):
             msg = IndyServiceFail("Unregistered wallet: {}".format(wallet_id))
         return msg
 
-    async def _sync_agent(self, agent: AgentCfg) -> bool:
+    async def _sync_wallet(self, wallet: WalletCfg) -> bool:
         """
-        Perform agent synchronization, registering the DID and publishing schemas
-        and credential definitions as required
+        Create a wallet if necessary
+
+        Args:
+            wallet: the Indy wallet configuration
+        """
+        if not wallet.created:
+            await wallet.create()
+        return True
+
+    async def _open_agent(self, agent: AgentCfg) -> bool:
+        """
+        Create and open an agent, registering the DID as required
 
         Args:
             agent: the Indy agent configuration
@@ -396,14 +439,31 @@ class IndyService(ServiceBase):
                 # check endpoint is registered (if any)
                 # await self._check_endpoint(agent.instance, agent.endpoint)
                 agent.registered = True
+        return True
 
-            # publish schemas
-            for cred_type in agent.cred_types:
-                await self._publish_schema(agent, cred_type)
+    async def _publish_schemas(self, issuer: AgentCfg, cred_types: Sequence[dict]) -> bool:
+        """
+        Publish the schemas and credential definitions for credential types in turn
+
+        Args:
+            issuer: the initialized and opened issuer instance publishing the schemas
+            cred_types: the credential types to be published
+        """
+        for cred_type in cred_types:
+            await self._publish_schema(issuer, cred_type)
+        return True
+
+    async def _complete_agent(self, agent: AgentCfg) -> bool:
+        """
+        Mark an agent as synced, once it has been opened and its schemas published
 
+        Args:
+            agent: the Indy agent configuration
+        """
+        if not agent.synced:
             agent.synced = True
             LOGGER.info("Indy agent synced: %s", agent.agent_id)
-        return agent.synced
+        return True
 
     async def _sync_connection(self, connection: ConnectionCfg) -> bool:
         """
@@ -761,12 +821,16 @@ class IndyService(ServiceBase):
             request: a credential request returned from the holder service
             cred_data: the raw credential attributes
         """
-        async with self._storage_lock:
-            (cred_json, cred_revoc_id, _epoch_creation) = await issuer.instance.create_cred(
-                json.dumps(request.cred_offer.data),
-                request.data,
-                cred_data,
-            )
+        with tracing.start_span("create_cred") as span:
+            lock_start = time.time()
+            async with self._storage_lock:
+                span.set_attribute("vonx.lock_wait", time.time() - lock_start)
+                (cred_json, cred_revoc_id, _epoch_creation) = \
+                    await issuer.instance.create_cred(
+                        json.dumps(request.cred_offer.data),
+                        request.data,
+                        cred_data,
+                    )
         return Credential(
             json.loads(cred_json),
             request.metadata,
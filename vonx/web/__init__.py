@@ -27,10 +27,41 @@ from aiohttp import web
 import aiohttp_jinja2
 from jinja2 import ChoiceLoader, FileSystemLoader, PackageLoader
 
+from ..common import tracing
+from ..common.exchange import ExchangeFullError
 from ..common.manager import ConfigServiceManager
 from .routes import get_routes
 
 
+@web.middleware
+async def _exchange_full_middleware(request: web.Request, handler):
+    """
+    Respond with a 503 error when a request cannot be queued because the
+    target service is overloaded
+    """
+    try:
+        return await handler(request)
+    except ExchangeFullError:
+        raise web.HTTPServiceUnavailable(
+            reason="Service is busy, please try again later",
+            headers={"Retry-After": "1"})
+
+
+@web.middleware
+async def _tracing_middleware(request: web.Request, handler):
+    """
+    Start a trace for sampled requests, or continue the trace of the caller
+    """
+    span = tracing.start_span(
+        "{} {}".format(request.method, request.path),
+        tracing.parse_traceparent(request.headers.get("traceparent")),
+        tracing.SPAN_KIND_SERVER, attributes={"http.method": request.method}, root=True)
+    with span:
+        response = await handler(request)
+        span.set_attribute("http.status_code", response.status)
+        return response
+
+
 def _setup_jinja(manager: ConfigServiceManager, app: web.Application):
     """
     Initialize aiohttp-jinja2 for template rendering
@@ -58,7 +89,7 @@ async def init_web(manager: ConfigServiceManager):
     """
     base = manager.env.get('WEB_BASE_HREF', '/')
 
-    app = web.Application()
+    app = web.Application(middlewares=[_tracing_middleware, _exchange_full_middleware])
     app['base_href'] = base
     app['manager'] = manager
     app['static_root_url'] = base + 'assets'